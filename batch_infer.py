@@ -0,0 +1,371 @@
+"""
+Offline batch inference: complete every prompt of a JSONL file.
+
+Each input line is a JSON object with a "prompt" and optionally an "id" (the
+line number otherwise) and a "max_new_tokens". The prompts are sorted by
+length and cut into chunks of similar lengths, which a pool of worker
+processes (one per core by default) decodes batch_size rows at a time with a
+PagedKVCache. A row leaves the batch as soon as it emits a stop sequence or
+reaches its max_new_tokens, and the next prompt of the chunk takes its place,
+so the batch stays full and no compute goes to padding or finished rows.
+
+Results are appended to the output JSONL as chunks finish (in no particular
+order; "id" says which prompt a line is for) and flushed, so the output file
+is also the checkpoint: rerunning the same command skips the ids it already
+has and completes the rest. Sampling is seeded per prompt (--seed plus its
+line number), so a resumed run samples what an uninterrupted one would have.
+
+$ python batch_infer.py prompts.jsonl completions.jsonl --model=out/model.pt
+$ python batch_infer.py in.jsonl out.jsonl --model=out-void --stop="\\n" --workers=4
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import pickle
+import time
+from collections import deque
+
+import torch
+from torch.nn import functional as F
+
+from bpe import load_vocab
+from eval_ppl import load_model
+from kv_cache import PagedKVCache
+
+
+class Codec:
+    """
+    Text <-> token ids: the vocab of a dataset (vocab.pkl, tokenizer.json, or a
+    meta.pkl with either) or GPT-2 BPE.
+    """
+
+    def __init__(self, path=None):
+        self.tokenizer = None
+        if path and path.endswith(".json"):
+            self.tokenizer = load_vocab(path)
+        elif path and os.path.exists(path):
+            with open(path, "rb") as f:
+                vocab = pickle.load(f)
+            # a meta.pkl of a GPT-2 BPE dataset has neither
+            if isinstance(vocab, tuple) or "stoi" in vocab or "tokenizer" in vocab:
+                self.tokenizer = load_vocab(path)
+        if self.tokenizer is None:
+            import tiktoken
+
+            self.enc = tiktoken.get_encoding("gpt2")
+
+    def encode(self, text):
+        if self.tokenizer is None:
+            return self.enc.encode(text, allowed_special={"<|endoftext|>"})
+        # chars outside the vocab are dropped, as chat_api does
+        return self.tokenizer.encode(text)
+
+    def decode(self, ids):
+        if self.tokenizer is None:
+            return self.enc.decode(ids)
+        return self.tokenizer.decode(ids)
+
+
+def load_codec(meta_path, vocab_path):
+    """
+    The dataset's BPE tokenizer when its meta.pkl names one (prepare.py
+    --bpe_vocab_size), the vocab at vocab_path otherwise, as chat_api does.
+    """
+    if meta_path and os.path.exists(meta_path):
+        with open(meta_path, "rb") as f:
+            meta = pickle.load(f)
+        if isinstance(meta, dict) and "tokenizer" in meta:
+            return Codec(meta_path)
+    return Codec(vocab_path)
+
+
+def find_stop(text, stop):
+    """The index of the earliest stop string in text, -1 if there is none."""
+    found = [i for i in (text.find(s) for s in stop if s) if i >= 0]
+    return min(found, default=-1)
+
+
+def _sample(logits, temperature, top_k, generators):
+    if temperature == 0:
+        return logits.argmax(dim=-1).tolist()
+    logits = logits / temperature
+    if top_k is not None:
+        v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
+        logits[logits < v[:, [-1]]] = -float("Inf")
+    probs = F.softmax(logits, dim=-1)
+    return [
+        torch.multinomial(p, num_samples=1, generator=g).item()
+        for p, g in zip(probs, generators)
+    ]
+
+
+def generate(
+    model,
+    prompts,
+    max_new_tokens,
+    batch_size=32,
+    temperature=1.0,
+    top_k=None,
+    stop=(),
+    decode=None,
+    seeds=None,
+    shift=None,
+    page_size=16,
+):
+    """
+    Complete prompts (lists of token ids), batch_size rows at a time. Yields
+    (i, generated ids, finish_reason) as each row finishes: "stop" when
+    decode(generated ids) contains one of the stop strings, "length" at
+    max_new_tokens (an int, or one per prompt). Stops are matched on the text,
+    as a BPE can spell it with other ids than those of the stop alone; a
+    "stop" row's ids end with the token that completed the stop, and the
+    caller cuts its text at find_stop(). A freed row is refilled with the next
+    pending prompt, and prompts of the same length are prefilled together.
+    Past block_size a row drops its oldest `shift` tokens (default a quarter
+    of the window) and re-encodes the rest, like GPT.generate_rolling.
+    """
+    config = model.config
+    block_size = config.block_size
+    shift = block_size // 4 if shift is None else shift
+    assert 0 < shift < block_size
+    assert decode is not None or not stop, "stop strings need a decode"
+    limits = (
+        max_new_tokens
+        if isinstance(max_new_tokens, (list, tuple))
+        else [max_new_tokens] * len(prompts)
+    )
+    seeds = range(len(prompts)) if seeds is None else seeds
+    device = next(model.parameters()).device
+    # a full window for every row, so admitting a prompt never runs out
+    blocks = batch_size * -(-block_size // page_size)
+    cache = PagedKVCache(config, blocks, page_size, device=device)
+    tag = object()  # sequence ids of this call, apart from any other user's
+    pending = deque(range(len(prompts)))
+    active = {}  # i -> {"tokens", "generated", "generator", "logits"}
+
+    def prefill(rows):
+        # rows of the same length forward as one batch
+        by_length = {}
+        for i in rows:
+            by_length.setdefault(len(active[i]["tokens"]), []).append(i)
+        for n, group in by_length.items():
+            for i in group:
+                cache.add_sequence((tag, i))
+            idx = torch.tensor(
+                [active[i]["tokens"] for i in group], dtype=torch.long, device=device
+            )
+            logits, _ = model(idx, kv=cache.step([(tag, i) for i in group], n))
+            for i, row_logits in zip(group, logits[:, -1]):
+                active[i]["logits"] = row_logits
+
+    try:
+        while pending or active:
+            admitted = []
+            while pending and len(active) < batch_size:
+                i = pending.popleft()
+                if limits[i] <= 0:
+                    yield i, [], "length"
+                    continue
+                # an empty prompt has nothing to condition on; that's the
+                # caller's to fix, so it's completed from a zero token
+                tokens = list(prompts[i][-block_size:]) or [0]
+                active[i] = {
+                    "tokens": tokens,
+                    "generated": [],
+                    "generator": torch.Generator().manual_seed(seeds[i]),
+                }
+                admitted.append(i)
+            prefill(admitted)
+
+            rows = list(active)
+            next_ids = _sample(
+                torch.stack([active[i]["logits"] for i in rows]).float().cpu(),
+                temperature,
+                top_k,
+                [active[i]["generator"] for i in rows],
+            )
+            stepping, reencode = [], []
+            for i, token in zip(rows, next_ids):
+                row = active[i]
+                row["generated"].append(token)
+                row["tokens"].append(token)
+                generated, reason = row["generated"], None
+                if stop and find_stop(decode(generated), stop) >= 0:
+                    reason = "stop"
+                if reason is None and len(generated) >= limits[i]:
+                    reason = "length"
+                if reason is not None:
+                    cache.free((tag, i))
+                    del active[i]
+                    yield i, generated, reason
+                elif cache.lengths[(tag, i)] == block_size:
+                    cache.free((tag, i))
+                    row["tokens"] = row["tokens"][-(block_size - shift) :]
+                    reencode.append(i)
+                else:
+                    stepping.append(i)
+            prefill(reencode)
+            if stepping:
+                idx = torch.tensor(
+                    [[active[i]["tokens"][-1]] for i in stepping], device=device
+                )
+                logits, _ = model(idx, kv=cache.step([(tag, i) for i in stepping], 1))
+                for i, row_logits in zip(stepping, logits[:, -1]):
+                    active[i]["logits"] = row_logits
+    finally:
+        for seq_id in list(cache.tables):
+            cache.free(seq_id)
+
+
+def read_prompts(path):
+    """(line number, id, prompt object) for every non-empty line."""
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f):
+            if line.strip():
+                obj = json.loads(line)
+                yield line_no, obj.get("id", line_no), obj
+
+
+def completed_ids(path):
+    """
+    The ids already in the output file. A last line cut short by an interrupted
+    write is truncated away, so that appending continues a valid file.
+    """
+    done = set()
+    if not os.path.exists(path):
+        return done
+    good = 0  # bytes up to the end of the last complete line
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                done.add(json.loads(line)["id"])
+            except (ValueError, KeyError):
+                break
+            good += len(line)
+    if good < os.path.getsize(path):
+        with open(path, "r+b") as f:
+            f.truncate(good)
+    return done
+
+
+_worker = {}
+
+
+def _init_worker(options):
+    # the cores are shared out between the workers
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // options["workers"]))
+    model = load_model(options["model"], options["meta"])
+    _worker["model"] = model.to(options["device"]).eval()
+    _worker["codec"] = load_codec(options["meta"], options["vocab"])
+    _worker["options"] = options
+
+
+def _run_chunk(chunk):
+    """Complete a chunk of (id, prompt ids, max_new_tokens, seed)."""
+    options, codec = _worker["options"], _worker["codec"]
+    completions = generate(
+        _worker["model"],
+        [prompt for _, prompt, _, _ in chunk],
+        [limit for _, _, limit, _ in chunk],
+        batch_size=options["batch_size"],
+        temperature=options["temperature"],
+        top_k=options["top_k"],
+        stop=options["stop"],
+        decode=codec.decode,
+        seeds=[seed for _, _, _, seed in chunk],
+        shift=options["shift"],
+    )
+    results = []
+    with torch.no_grad():
+        for i, generated, reason in completions:
+            completion = codec.decode(generated)
+            if reason == "stop":
+                completion = completion[: find_stop(completion, options["stop"])]
+            results.append(
+                {
+                    "id": chunk[i][0],
+                    "completion": completion,
+                    "finish_reason": reason,
+                    "prompt_tokens": len(chunk[i][1]),
+                    "completion_tokens": len(generated),
+                }
+            )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("input", help="JSONL with a prompt per line")
+    parser.add_argument("output", help="JSONL of completions, appended to")
+    parser.add_argument("--model", type=str, default="out/model.pt")
+    parser.add_argument("--meta", type=str, default="data/void/meta.pkl")
+    parser.add_argument("--vocab", type=str, default="data/void/vocab.pkl")
+    parser.add_argument("--max_new_tokens", type=int, default=200)
+    parser.add_argument("--temperature", type=float, default=0.8, help="0: greedy")
+    parser.add_argument("--top_k", type=int, default=200)
+    parser.add_argument("--stop", type=str, action="append", default=[])
+    parser.add_argument("--shift", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=1337)
+    parser.add_argument("--batch_size", type=int, default=32, help="rows per worker")
+    parser.add_argument("--chunk_size", type=int, default=0, help="0: 4 batches")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--device", type=str, default="cpu")
+    args = parser.parse_args()
+    # --stop="\n" from a shell is a backslash and an n
+    args.stop = [s.encode().decode("unicode_escape") for s in args.stop]
+
+    codec = load_codec(args.meta, args.vocab)
+    done = completed_ids(args.output)
+    work = []
+    for line_no, id_, obj in read_prompts(args.input):
+        if id_ not in done:
+            limit = obj.get("max_new_tokens", args.max_new_tokens)
+            work.append((id_, codec.encode(obj["prompt"]), limit, args.seed + line_no))
+    print(f"{len(done)} prompts already done, {len(work)} to go")
+    if not work:
+        return
+
+    # similar lengths together; the longest chunks first, so that no worker is
+    # left with a long one at the end
+    work.sort(key=lambda w: len(w[1]), reverse=True)
+    chunk_size = args.chunk_size or 4 * args.batch_size
+    chunks = [work[i : i + chunk_size] for i in range(0, len(work), chunk_size)]
+    workers = max(1, min(args.workers, len(chunks)))
+    options = dict(vars(args), workers=workers)
+
+    t0 = time.time()
+    n_done = n_tokens = 0
+    with open(args.output, "a", encoding="utf-8") as out:
+
+        def write(results):
+            nonlocal n_done, n_tokens
+            for result in results:
+                out.write(json.dumps(result) + "\n")
+            out.flush()
+            os.fsync(out.fileno())
+            n_done += len(results)
+            n_tokens += sum(r["completion_tokens"] for r in results)
+            print(
+                f"{n_done}/{len(work)} prompts, "
+                f"{n_tokens / (time.time() - t0):.0f} tokens/s"
+            )
+
+        if workers == 1:
+            _init_worker(options)
+            for chunk in chunks:
+                write(_run_chunk(chunk))
+        else:
+            # spawn: forking a process that already runs torch's thread pools
+            # can deadlock
+            context = multiprocessing.get_context("spawn")
+            with context.Pool(workers, _init_worker, (options,)) as pool:
+                for results in pool.imap_unordered(_run_chunk, chunks):
+                    write(results)
+
+
+if __name__ == "__main__":
+    main()
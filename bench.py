@@ -1,8 +1,32 @@
 """
-A much shorter version of train.py for benchmarking
+Benchmark suite for training and inference, runs on CPU as well as GPU.
+
+Every combination of the swept parameters (model size, block_size, batch_size,
+dtype, compile on/off) is run through the selected benches:
+- train:        forward + backward + optimizer step on a (batch_size, block_size) batch
+- prefill:      forward over a full (batch_size, block_size) prompt, no grad
+- decode:       per-token latency of generate() at batch size 1
+- decode_batch: tokens/s of generate() at batch_size rows
+- decode_cached: tokens/s of generate_rolling() (KV cache) at batch_size rows,
+                and the KV cache bytes per token
+Attention variants are swept with --n_kv_head (0: multi-head attention).
+
+Results are printed and can be written as JSON (--out). With --baseline, the
+results are compared against an earlier JSON file and the script exits with
+status 1 if anything regressed by more than --tolerance.
+
+$ python bench.py --device=cpu --model tiny gpt2 --batch_size 1 8 --out bench.json
+$ python bench.py --device=cpu --model tiny gpt2 --batch_size 1 8 --baseline bench.json
+$ python bench.py --model small --n_kv_head 0 2 1 --benches decode_cached
 """
 
+import argparse
+import itertools
+import json
 import os
+import platform
+import statistics
+import sys
 import time
 from contextlib import nullcontext
 
@@ -11,149 +35,337 @@ import torch
 
 from model import GPT, GPTConfig
 
-# -----------------------------------------------------------------------------
-batch_size = 12
-block_size = 1024
-bias = False
-real_data = True
-seed = 1337
-device = "cuda"  # examples: 'cpu', 'cuda', 'cuda:0', 'cuda:1', etc.
-dtype = (
-    "bfloat16"
-    if torch.cuda.is_available() and torch.cuda.is_bf16_supported()
-    else "float16"
-)  # 'float32' or 'bfloat16' or 'float16'
-compile = True  # use PyTorch 2.0 to compile the model to be faster
-profile = False  # use pytorch profiler, or just simple benchmarking?
-exec(open("configurator.py").read())  # overrides from command line or config file
-# -----------------------------------------------------------------------------
-
-torch.manual_seed(seed)
-torch.cuda.manual_seed(seed)
-torch.backends.cuda.matmul.allow_tf32 = True  # allow tf32 on matmul
-torch.backends.cudnn.allow_tf32 = True  # allow tf32 on cudnn
-device_type = "cuda" if "cuda" in device else "cpu"  # for later use in torch.autocast
-ptdtype = {
-    "float32": torch.float32,
-    "bfloat16": torch.bfloat16,
-    "float16": torch.float16,
-}[dtype]
-ctx = (
-    nullcontext()
-    if device_type == "cpu"
-    else torch.amp.autocast(device_type=device_type, dtype=ptdtype)
-)
-
-# data loading init
-if real_data:
-    dataset = "openwebtext"
-    data_dir = os.path.join("data", dataset)
-    train_data = np.memmap(
-        os.path.join(data_dir, "train.bin"), dtype=np.uint16, mode="r"
+MODEL_PRESETS = {
+    "tiny": dict(n_layer=4, n_head=4, n_embd=128),  # data/void sized
+    "small": dict(n_layer=6, n_head=6, n_embd=384),  # shakespeare_char sized
+    "gpt2": dict(n_layer=12, n_head=12, n_embd=768),  # 124M params
+    "gpt2-medium": dict(n_layer=24, n_head=16, n_embd=1024),  # 350M params
+    "gpt2-large": dict(n_layer=36, n_head=20, n_embd=1280),  # 774M params
+    "gpt2-xl": dict(n_layer=48, n_head=25, n_embd=1600),  # 1558M params
+}
+# the metric each bench is judged on, and whether higher is better
+METRICS = {
+    "train": ("ms_per_iter", False),
+    "prefill": ("ms_per_iter", False),
+    "decode": ("ms_per_token", False),
+    "decode_batch": ("tokens_per_s", True),
+    "decode_cached": ("tokens_per_s", True),
+}
+CASE_KEYS = [
+    "bench",
+    "model",
+    "n_kv_head",
+    "block_size",
+    "batch_size",
+    "dtype",
+    "compile",
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark training and inference.")
+    parser.add_argument("--benches", nargs="+", default=list(METRICS), choices=METRICS)
+    parser.add_argument("--model", nargs="+", default=["gpt2"], choices=MODEL_PRESETS)
+    parser.add_argument("--n_kv_head", type=int, nargs="+", default=[0])
+    parser.add_argument("--block_size", type=int, nargs="+", default=[1024])
+    parser.add_argument("--batch_size", type=int, nargs="+", default=[12])
+    parser.add_argument("--dtype", nargs="+", default=["float32"])
+    parser.add_argument("--compile", type=int, nargs="+", default=[0], choices=[0, 1])
+    parser.add_argument("--vocab_size", type=int, default=50304)
+    parser.add_argument("--bias", action="store_true")
+    parser.add_argument("--loss_chunk_size", type=int, default=0)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--real_data", action="store_true", help="openwebtext batches")
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--steps", type=int, default=5)
+    parser.add_argument("--prompt_len", type=int, default=64, help="decode prompt")
+    parser.add_argument("--new_tokens", type=int, default=32, help="decode length")
+    parser.add_argument("--seed", type=int, default=1337)
+    parser.add_argument("--profile", action="store_true", help="profile train steps")
+    parser.add_argument("--out", type=str, default=None)
+    parser.add_argument("--baseline", type=str, default=None)
+    parser.add_argument("--tolerance", type=float, default=0.10)
+    return parser.parse_args()
+
+
+def synchronize(device):
+    if "cuda" in device:
+        torch.cuda.synchronize(device)
+
+
+def timed(fn, device, warmup, steps):
+    """Run fn warmup + steps times, return the per-call seconds of the timed steps."""
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(steps):
+        synchronize(device)
+        t0 = time.perf_counter()
+        fn()
+        synchronize(device)
+        times.append(time.perf_counter() - t0)
+    return times
+
+
+def make_get_batch(args, batch_size, block_size):
+    if args.real_data:
+        data_dir = os.path.join("data", "openwebtext")
+        data = np.memmap(os.path.join(data_dir, "train.bin"), dtype=np.uint16, mode="r")
+
+        def get_batch():
+            ix = torch.randint(len(data) - block_size, (batch_size,))
+            rows = [data[i : i + 1 + block_size].astype(np.int64) for i in ix]
+            xy = torch.from_numpy(np.stack(rows))
+            return xy[:, :-1].to(args.device), xy[:, 1:].to(args.device)
+
+    else:
+        # fixed data, to not care about data loading
+        x = torch.randint(args.vocab_size, (batch_size, block_size), device=args.device)
+        y = torch.randint(args.vocab_size, (batch_size, block_size), device=args.device)
+
+        def get_batch():
+            return x, y
+
+    return get_batch
+
+
+def bench_train(args, model, ctx, case):
+    get_batch = make_get_batch(args, case["batch_size"], case["block_size"])
+    device_type = "cuda" if "cuda" in args.device else "cpu"
+    optimizer = model.configure_optimizers(
+        weight_decay=1e-2,
+        learning_rate=1e-4,
+        betas=(0.9, 0.95),
+        device_type=device_type,
     )
+    model.train()
+
+    def step():
+        X, Y = get_batch()
+        with ctx:
+            _, loss = model(X, Y)
+        optimizer.zero_grad(set_to_none=True)
+        loss.backward()
+        optimizer.step()
+
+    if args.profile:
+        # useful docs on pytorch profiler:
+        # - tutorial
+        #   https://pytorch.org/tutorials/intermediate/tensorboard_profiler_tutorial.html
+        # - api
+        #   https://pytorch.org/docs/stable/profiler.html#torch.profiler.profile
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if device_type == "cuda":
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        with torch.profiler.profile(
+            activities=activities,
+            on_trace_ready=torch.profiler.tensorboard_trace_handler("./bench_log"),
+            with_flops=True,
+        ) as prof:
+            for _ in range(args.steps):
+                step()
+                prof.step()
+
+    times = timed(step, args.device, args.warmup, args.steps)
+    dt = statistics.median(times)
+    tokens = case["batch_size"] * case["block_size"]
+    # MFU against A100 bf16 peak, only meaningful as a relative number on CPU
+    mfu = getattr(model, "_orig_mod", model).estimate_mfu(case["batch_size"], dt)
+    return {
+        "ms_per_iter": dt * 1000,
+        "tokens_per_s": tokens / dt,
+        "mfu_a100": mfu,
+    }
+
+
+@torch.no_grad()
+def bench_prefill(args, model, ctx, case):
+    x, _ = make_get_batch(args, case["batch_size"], case["block_size"])()
+    model.eval()
+
+    def step():
+        with ctx:
+            model(x)
+
+    dt = statistics.median(timed(step, args.device, args.warmup, args.steps))
+    tokens = case["batch_size"] * case["block_size"]
+    return {"ms_per_iter": dt * 1000, "tokens_per_s": tokens / dt}
 
-    def get_batch(split):
-        # note ignore split in benchmarking script
-        data = train_data
-        ix = torch.randint(len(data) - block_size, (batch_size,))
-        x = torch.stack(
-            [torch.from_numpy((data[i : i + block_size]).astype(np.int64)) for i in ix]
+
+@torch.no_grad()
+def run_decode(args, model, ctx, batch_size):
+    prompt_len = min(args.prompt_len, model.config.block_size - 1)
+    idx = torch.randint(args.vocab_size, (batch_size, prompt_len), device=args.device)
+    model.eval()
+
+    # generate() is what serving calls. It runs the uncompiled module, so compile
+    # only affects the train and prefill benches
+    generate = getattr(model, "_orig_mod", model).generate
+
+    def step():
+        with ctx:
+            generate(idx, args.new_tokens, top_k=200)
+
+    return statistics.median(timed(step, args.device, args.warmup, args.steps))
+
+
+def bench_decode(args, model, ctx, case):
+    dt = run_decode(args, model, ctx, 1)
+    return {
+        "ms_per_token": dt * 1000 / args.new_tokens,
+        "tokens_per_s": args.new_tokens / dt,
+    }
+
+
+def bench_decode_batch(args, model, ctx, case):
+    dt = run_decode(args, model, ctx, case["batch_size"])
+    return {
+        "ms_per_token": dt * 1000 / args.new_tokens,
+        "tokens_per_s": case["batch_size"] * args.new_tokens / dt,
+    }
+
+
+@torch.no_grad()
+def bench_decode_cached(args, model, ctx, case):
+    prompt_len = min(args.prompt_len, model.config.block_size - 1)
+    shape = (case["batch_size"], prompt_len)
+    idx = torch.randint(args.vocab_size, shape, device=args.device)
+    model.eval()
+    generate = getattr(model, "_orig_mod", model).generate_rolling
+
+    def step():
+        with ctx:
+            generate(idx, args.new_tokens, top_k=200)
+
+    dt = statistics.median(timed(step, args.device, args.warmup, args.steps))
+    config = model.config
+    kv_heads = config.n_kv_head or config.n_head
+    head_size = config.n_embd // config.n_head
+    element_size = torch.finfo(getattr(torch, case["dtype"])).bits // 8
+    return {
+        "ms_per_token": dt * 1000 / args.new_tokens,
+        "tokens_per_s": case["batch_size"] * args.new_tokens / dt,
+        # keys and values of every layer, per position of a sequence
+        "kv_bytes_per_token": 2 * config.n_layer * kv_heads * head_size * element_size,
+    }
+
+
+BENCHES = {
+    "train": bench_train,
+    "prefill": bench_prefill,
+    "decode": bench_decode,
+    "decode_batch": bench_decode_batch,
+    "decode_cached": bench_decode_cached,
+}
+
+
+def run_suite(args):
+    device_type = "cuda" if "cuda" in args.device else "cpu"
+    results = []
+    sweep = itertools.product(
+        args.model,
+        args.n_kv_head,
+        args.block_size,
+        args.batch_size,
+        args.dtype,
+        args.compile,
+    )
+    for model_name, n_kv_head, block_size, batch_size, dtype, compile in sweep:
+        torch.manual_seed(args.seed)
+        gptconf = GPTConfig(
+            block_size=block_size,
+            vocab_size=args.vocab_size,
+            dropout=0,  # for determinism
+            bias=args.bias,
+            loss_chunk_size=args.loss_chunk_size,
+            n_kv_head=n_kv_head,
+            **MODEL_PRESETS[model_name],
+        )
+        model = GPT(gptconf).to(args.device)
+        if compile:
+            print("Compiling model...")
+            model = torch.compile(model)  # pytorch 2.0
+        ptdtype = getattr(torch, dtype)
+        ctx = (
+            nullcontext()
+            if ptdtype == torch.float32
+            else torch.amp.autocast(device_type=device_type, dtype=ptdtype)
         )
-        y = torch.stack(
-            [
-                torch.from_numpy((data[i + 1 : i + 1 + block_size]).astype(np.int64))
-                for i in ix
-            ]
+        for bench in args.benches:
+            case = {
+                "bench": bench,
+                "model": model_name,
+                "n_kv_head": n_kv_head,
+                "block_size": block_size,
+                # single sequence decode is the same for every batch_size
+                "batch_size": 1 if bench == "decode" else batch_size,
+                "dtype": dtype,
+                "compile": bool(compile),
+            }
+            if any(all(r[k] == case[k] for k in CASE_KEYS) for r in results):
+                continue
+            result = dict(case, **BENCHES[bench](args, model, ctx, case))
+            metric, _ = METRICS[bench]
+            print(
+                " ".join(f"{k}={case[k]}" for k in CASE_KEYS)
+                + f": {metric} {result[metric]:.3f}, "
+                + f"{result['tokens_per_s']:.1f} tokens/s"
+            )
+            results.append(result)
+        del model
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Print a comparison against baseline results, return the regressions."""
+    # results from before n_kv_head was swept are multi-head attention
+    key = lambda r: tuple(r.get(k, 0) for k in CASE_KEYS)  # noqa: E731
+    old = {key(r): r for r in baseline["results"]}
+    regressions = []
+    for r in results:
+        if key(r) not in old:
+            continue
+        metric, higher_is_better = METRICS[r["bench"]]
+        before, after = old[key(r)][metric], r[metric]
+        change = (after - before) / before
+        worse = -change if higher_is_better else change
+        status = "REGRESSION" if worse > tolerance else "ok"
+        print(
+            f"{status:>10} {' '.join(str(k) for k in key(r))}: {metric} "
+            f"{before:.3f} -> {after:.3f} ({change * 100:+.1f}%)"
         )
-        x = x.pin_memory().to(device, non_blocking=True)
-        y = y.pin_memory().to(device, non_blocking=True)
-        return x, y
-
-else:
-    # alternatively, if fixed data is desired to not care about data loading
-    x = torch.randint(50304, (batch_size, block_size), device=device)
-    y = torch.randint(50304, (batch_size, block_size), device=device)
-
-    def get_batch(split):
-        return x, y
-
-
-# model init
-gptconf = GPTConfig(
-    block_size=block_size,  # how far back does the model look? i.e. context size
-    n_layer=12,
-    n_head=12,
-    n_embd=768,  # size of the model
-    dropout=0,  # for determinism
-    bias=bias,
-)
-model = GPT(gptconf)
-model.to(device)
-
-optimizer = model.configure_optimizers(
-    weight_decay=1e-2, learning_rate=1e-4, betas=(0.9, 0.95), device_type=device_type
-)
-
-if compile:
-    print("Compiling model...")
-    model = torch.compile(model)  # pytorch 2.0
-
-if profile:
-    # useful docs on pytorch profiler:
-    # - tutorial
-    #   https://pytorch.org/tutorials/intermediate/tensorboard_profiler_tutorial.html
-    # - api
-    #   https://pytorch.org/docs/stable/profiler.html#torch.profiler.profile
-    wait, warmup, active = 5, 5, 5
-    num_steps = wait + warmup + active
-    with torch.profiler.profile(
-        activities=[
-            torch.profiler.ProfilerActivity.CPU,
-            torch.profiler.ProfilerActivity.CUDA,
-        ],
-        schedule=torch.profiler.schedule(
-            wait=wait, warmup=warmup, active=active, repeat=1
-        ),
-        on_trace_ready=torch.profiler.tensorboard_trace_handler("./bench_log"),
-        record_shapes=False,
-        profile_memory=False,
-        with_stack=False,  # incurs an additional overhead, disable if not needed
-        with_flops=True,
-        with_modules=False,  # only for torchscript models atm
-    ) as prof:
-
-        X, Y = get_batch("train")
-        for k in range(num_steps):
-            with ctx:
-                logits, loss = model(X, Y)
-            X, Y = get_batch("train")
-            optimizer.zero_grad(set_to_none=True)
-            loss.backward()
-            optimizer.step()
-            lossf = loss.item()
-            print(f"{k}/{num_steps} loss: {lossf:.4f}")
-
-            prof.step()  # notify the profiler at end of each step
-
-else:
-
-    # simple benchmarking
-    torch.cuda.synchronize()
-    for stage, num_steps in enumerate([10, 20]):  # burnin, then benchmark
-        t0 = time.time()
-        X, Y = get_batch("train")
-        for k in range(num_steps):
-            with ctx:
-                logits, loss = model(X, Y)
-            X, Y = get_batch("train")
-            optimizer.zero_grad(set_to_none=True)
-            loss.backward()
-            optimizer.step()
-            lossf = loss.item()
-            print(f"{k}/{num_steps} loss: {lossf:.4f}")
-        torch.cuda.synchronize()
-        t1 = time.time()
-        dt = t1 - t0
-        mfu = model.estimate_mfu(batch_size * 1 * num_steps, dt)
-        if stage == 1:
-            print(f"time per iteration: {dt/num_steps*1000:.4f}ms, MFU: {mfu*100:.2f}%")
+        if worse > tolerance:
+            regressions.append(r)
+    return regressions
+
+
+def main():
+    args = parse_args()
+    torch.backends.cuda.matmul.allow_tf32 = True  # allow tf32 on matmul
+    torch.backends.cudnn.allow_tf32 = True  # allow tf32 on cudnn
+    results = run_suite(args)
+    if args.out:
+        report = {
+            "meta": {
+                "torch": torch.__version__,
+                "device": args.device,
+                "threads": torch.get_num_threads(),
+                "platform": platform.platform(),
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            },
+            "results": results,
+        }
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"wrote {len(results)} results to {args.out}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regression(s) above {args.tolerance:.0%}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Quality and latency benchmark of the memory embeddings (GPTEmbedder).
+
+Quality is measured as retrieval: the text is cut into passages, each query is
+a random span of half a passage, and we check whether its own passage is the
+nearest (recall@1) or among the 5 nearest (recall@5) by cosine similarity. The
+same is done for an untrained model of the same shape and for a bag of char
+trigrams, as reference points.
+
+$ python bench_embed.py --ckpt=out/ckpt.pt --vocab=data/void/vocab.pkl
+"""
+
+import argparse
+import pickle
+import resource
+import time
+import zlib
+
+import numpy as np
+import torch
+
+from embedder import GPTEmbedder
+from model import GPT, GPTConfig
+
+
+def load_model(ckpt_path):
+    checkpoint = torch.load(ckpt_path, map_location="cpu")
+    model = GPT(GPTConfig(**checkpoint["model_args"]))
+    state_dict = checkpoint["model"]
+    unwanted_prefix = "_orig_mod."
+    for k, v in list(state_dict.items()):
+        if k.startswith(unwanted_prefix):
+            state_dict[k[len(unwanted_prefix) :]] = state_dict.pop(k)
+    model.load_state_dict(state_dict)
+    model.eval()
+    return model
+
+
+def trigram_encode(texts, dim=4096):
+    out = np.zeros((len(texts), dim), dtype=np.float32)
+    for i, t in enumerate(texts):
+        for j in range(len(t) - 2):
+            out[i, zlib.crc32(t[j : j + 3].encode()) % dim] += 1
+    return out / np.maximum(np.linalg.norm(out, axis=1, keepdims=True), 1e-12)
+
+
+def recall(encode, passages, queries):
+    p, q = encode(passages), encode(queries)
+    ranks = np.argsort(-(q @ p.T), axis=1)
+    truth = np.arange(len(queries))[:, None]
+    return (ranks[:, :1] == truth).any(1).mean(), (ranks[:, :5] == truth).any(1).mean()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--ckpt", type=str, default="out/ckpt.pt")
+    parser.add_argument("--vocab", type=str, default="data/void/vocab.pkl")
+    parser.add_argument("--text", type=str, default="data/input.txt")
+    parser.add_argument("--passages", type=int, default=500)
+    parser.add_argument("--passage_len", type=int, default=128)
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--seed", type=int, default=1337)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    torch.manual_seed(args.seed)
+    with open(args.text, encoding="utf-8") as f:
+        text = f.read()
+    with open(args.vocab, "rb") as f:
+        _, stoi = pickle.load(f)
+    n = min(args.passages, len(text) // args.passage_len)
+    starts = rng.choice(len(text) // args.passage_len, size=n, replace=False)
+    passages = [text[s * args.passage_len : (s + 1) * args.passage_len] for s in starts]
+    queries = []
+    for p in passages:
+        s = rng.integers(0, len(p) // 2 + 1)
+        queries.append(p[s : s + len(p) // 2])
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    model = load_model(args.ckpt)
+    trained = GPTEmbedder(model, stoi, batch_size=args.batch_size)
+    untrained = GPTEmbedder(GPT(model.config).eval(), stoi, batch_size=args.batch_size)
+    print(f"{n} passages of {args.passage_len} chars, queries are half-passage spans")
+    for name, encode in [
+        ("trained GPT", trained.encode),
+        ("untrained GPT", untrained.encode),
+        ("char trigrams", trigram_encode),
+    ]:
+        r1, r5 = recall(encode, passages, queries)
+        print(f"{name:>14}: recall@1 {r1:.3f}, recall@5 {r5:.3f}")
+
+    # latency of a single prompt (what chat() does) and batch throughput
+    times = []
+    for q in queries[:50]:
+        t0 = time.perf_counter()
+        trained.encode(q)
+        times.append(time.perf_counter() - t0)
+    print(f"single text: {1000 * np.median(times):.2f} ms (median)")
+    t0 = time.perf_counter()
+    trained.encode(passages)
+    dt = time.perf_counter() - t0
+    print(f"batched ({args.batch_size}): {len(passages) / dt:.0f} texts/s")
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(
+        f"embedding parameters beyond the chat model: 0, "
+        f"peak RSS growth incl. both models: {(rss - rss_before) / 1024:.0f}MB"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Benchmark the training loss head: lm_head + cross-entropy, forward and backward.
+Compares the plain path (full logits, F.cross_entropy) against the fused,
+chunked ChunkedLMHeadLoss at several chunk sizes. Each variant runs in its own
+subprocess so that its peak RSS can be measured in isolation.
+
+$ python bench_loss.py --batch_size=12 --block_size=1024 --chunk_sizes 1024 4096
+"""
+
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+
+import torch
+from torch.nn import functional as F
+
+from model import ChunkedLMHeadLoss
+
+
+def current_rss():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+def run_variant(args, chunk_size):
+    torch.manual_seed(1337)
+    torch.set_num_threads(args.threads or torch.get_num_threads())
+    N = args.batch_size * args.block_size
+    # realistic scales: x comes out of ln_f, the weight is initialized at std 0.02.
+    # (unit-scale weights give huge logits whose softmax is mostly denormals,
+    # which is pathologically slow on CPU and says nothing about real training)
+    x = torch.randn(N, args.n_embd, requires_grad=True)
+    weight = (0.02 * torch.randn(args.vocab_size, args.n_embd)).requires_grad_()
+    targets = torch.randint(args.vocab_size, (N,))
+    rss_before = current_rss()
+    times = []
+    for _ in range(args.warmup + args.steps):
+        t0 = time.perf_counter()
+        if chunk_size == 0:
+            logits = x @ weight.t()
+            loss = F.cross_entropy(logits, targets, ignore_index=-1)
+        else:
+            loss = ChunkedLMHeadLoss.apply(x, weight, targets, chunk_size, True)
+        loss.backward()
+        del loss
+        logits = None
+        x.grad = weight.grad = None
+        times.append(time.perf_counter() - t0)
+    # ru_maxrss is in KiB on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return {
+        "chunk_size": chunk_size,
+        "ms_per_step": 1000 * sum(times[args.warmup :]) / args.steps,
+        "peak_extra_mb": (peak - rss_before) / 2**20,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--batch_size", type=int, default=12)
+    parser.add_argument("--block_size", type=int, default=1024)
+    parser.add_argument("--n_embd", type=int, default=768)
+    parser.add_argument("--vocab_size", type=int, default=50304)
+    parser.add_argument("--chunk_sizes", type=int, nargs="+", default=[0, 1024, 4096])
+    parser.add_argument("--steps", type=int, default=3)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=0)
+    parser.add_argument("--variant", type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.variant is not None:
+        print(json.dumps(run_variant(args, args.variant)))
+        return
+
+    N = args.batch_size * args.block_size
+    print(
+        f"loss head: {N} rows x {args.vocab_size} vocab, n_embd {args.n_embd}; "
+        f"full fp32 logits are {N * args.vocab_size * 4 / 2**20:.0f}MB"
+    )
+    for chunk_size in args.chunk_sizes:
+        cmd = [sys.executable, __file__, "--variant", str(chunk_size)] + sys.argv[1:]
+        proc = subprocess.run(cmd, capture_output=True, text=True)
+        name = "full logits" if chunk_size == 0 else f"chunked {chunk_size}"
+        if proc.returncode != 0:
+            # most likely killed by the OOM killer
+            print(f"{name:>14}: failed (exit code {proc.returncode})")
+            continue
+        r = json.loads(proc.stdout.strip().splitlines()[-1])
+        print(
+            f"{name:>14}: {r['ms_per_step']:9.1f} ms/step, "
+            f"peak extra memory {r['peak_extra_mb']:8.0f}MB"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""
+Byte pair encoding over the chars of a corpus, to shorten the void sequences.
+
+The char-level vocab makes every char a token, so prompts, KV caches and
+decode steps are as long as the text. BPE starts from the same vocab (the
+corpus' chars, ids 0..n-1 in sorted order, as prepare.py numbers them) and
+adds tokens for the most frequent adjacent pairs, merge after merge, until the
+vocab has vocab_size tokens. A tokenizer without merges is the char vocab.
+
+Text is first split into chunks (words with their leading space, numbers,
+punctuation, whitespace; the GPT-2 split), merges never cross a chunk, and the
+trainer counts every distinct chunk once, weighted by its frequency. The pair
+counts are kept up to date incrementally: a merge only revisits the chunks
+that contain the pair (`where`), subtracts their old pairs and adds their new
+ones, and a heap with lazy deletion finds the next most frequent pair.
+
+Saved as JSON: the chars, the merges (pairs of ids, merge k makes id n + k)
+and the split pattern. prepare.py records it in meta.pkl ("tokenizer"), which
+is how train_void.py, chat_api and sample.py find it; load_vocab() also reads
+the pickled char vocabs.
+
+$ python bpe.py --input=data/input.txt --vocab_size=256 --out=tokenizer.json
+"""
+
+import argparse
+import heapq
+import json
+import os
+import pickle
+import re
+import time
+from collections import Counter, defaultdict
+
+PATTERN = r"'(?:s|t|re|ve|m|ll|d)| ?[^\W\d_]+| ?\d+| ?(?:[^\s\w]|_)+|\s+(?!\S)|\s+"
+
+
+def merge(ids, pair, new_id):
+    """ids with every occurrence of pair, left to right, replaced by new_id."""
+    out = []
+    i = 0
+    while i < len(ids):
+        if i < len(ids) - 1 and ids[i] == pair[0] and ids[i + 1] == pair[1]:
+            out.append(new_id)
+            i += 2
+        else:
+            out.append(ids[i])
+            i += 1
+    return out
+
+
+class Tokenizer:
+
+    def __init__(self, chars, merges=(), pattern=PATTERN):
+        self.chars = list(chars)
+        self.stoi = {c: i for i, c in enumerate(self.chars)}
+        self.merges = [tuple(pair) for pair in merges]
+        n = len(self.chars)
+        self.ranks = {pair: n + k for k, pair in enumerate(self.merges)}
+        self.itos = dict(enumerate(self.chars))
+        for pair, new_id in self.ranks.items():
+            self.itos[new_id] = self.itos[pair[0]] + self.itos[pair[1]]
+        self.pattern = pattern
+        self._split = re.compile(pattern)
+        self._cache = {}  # chunk -> ids
+
+    @property
+    def vocab_size(self):
+        return len(self.itos)
+
+    def _encode_chunk(self, chunk):
+        ids = self._cache.get(chunk)
+        if ids is not None:
+            return ids
+        # chars outside the vocab are dropped, as with the char vocab
+        ids = [self.stoi[c] for c in chunk if c in self.stoi]
+        while len(ids) > 1:
+            # the earliest learned of the pairs present merges first
+            pair = min(zip(ids, ids[1:]), key=lambda p: self.ranks.get(p, 1 << 62))
+            if pair not in self.ranks:
+                break
+            ids = merge(ids, pair, self.ranks[pair])
+        if len(self._cache) > 100_000:
+            self._cache.clear()
+        self._cache[chunk] = ids
+        return ids
+
+    def encode(self, text):
+        if not self.merges:
+            return [self.stoi[c] for c in text if c in self.stoi]
+        ids = []
+        for chunk in self._split.findall(text):
+            ids.extend(self._encode_chunk(chunk))
+        return ids
+
+    def decode(self, ids):
+        return "".join(self.itos[i] for i in ids)
+
+    def save(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(
+                {"chars": self.chars, "merges": self.merges, "pattern": self.pattern},
+                f,
+                ensure_ascii=False,
+            )
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding="utf-8") as f:
+            state = json.load(f)
+        return cls(state["chars"], state["merges"], state["pattern"])
+
+    @classmethod
+    def from_stoi(cls, stoi):
+        return cls(sorted(stoi, key=stoi.get))
+
+
+def as_tokenizer(vocab):
+    """A Tokenizer, or a char stoi dict as one."""
+    return vocab if isinstance(vocab, Tokenizer) else Tokenizer.from_stoi(vocab)
+
+
+def load_vocab(path):
+    """A tokenizer.json, a (chars, stoi) vocab.pkl or a meta.pkl with stoi."""
+    if path.endswith(".json"):
+        return Tokenizer.load(path)
+    with open(path, "rb") as f:
+        vocab = pickle.load(f)
+    if isinstance(vocab, tuple):
+        return Tokenizer(vocab[0])
+    if "tokenizer" in vocab:  # a meta.pkl of a BPE dataset
+        return Tokenizer.load(os.path.join(os.path.dirname(path), vocab["tokenizer"]))
+    return Tokenizer.from_stoi(vocab["stoi"])
+
+
+def train(text, vocab_size, pattern=PATTERN, min_frequency=2):
+    """A Tokenizer of at most vocab_size tokens, merging pairs seen >= min_frequency."""
+    chars = sorted(set(text))
+    stoi = {c: i for i, c in enumerate(chars)}
+    chunks = Counter(re.findall(pattern, text))
+    words = [[stoi[c] for c in chunk] for chunk in chunks]
+    freqs = list(chunks.values())
+    counts = Counter()  # pair -> occurrences in the text
+    where = defaultdict(set)  # pair -> the words it may occur in
+    for w, (ids, freq) in enumerate(zip(words, freqs)):
+        for pair in zip(ids, ids[1:]):
+            counts[pair] += freq
+            where[pair].add(w)
+    heap = [(-count, pair) for pair, count in counts.items()]
+    heapq.heapify(heap)
+
+    merges = []
+    while heap and len(chars) + len(merges) < vocab_size:
+        neg_count, pair = heapq.heappop(heap)
+        count = counts.get(pair, 0)
+        if count != -neg_count:
+            # stale: a fresher entry was pushed if the count went up, push one
+            # now if it went down
+            if 0 < count < -neg_count:
+                heapq.heappush(heap, (-count, pair))
+            continue
+        if count < min_frequency:
+            break
+        new_id = len(chars) + len(merges)
+        merges.append(pair)
+        changed = set()
+        for w in where.pop(pair):
+            ids, freq = words[w], freqs[w]
+            new = merge(ids, pair, new_id)
+            if len(new) == len(ids):
+                continue
+            for old_pair in zip(ids, ids[1:]):
+                counts[old_pair] -= freq
+            for new_pair in zip(new, new[1:]):
+                counts[new_pair] += freq
+                where[new_pair].add(w)
+                changed.add(new_pair)
+            words[w] = new
+        del counts[pair]
+        for p in changed:
+            if counts[p] > 0:
+                heapq.heappush(heap, (-counts[p], p))
+    return Tokenizer(chars, merges, pattern)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--input", type=str, default="data/input.txt")
+    parser.add_argument("--vocab_size", type=int, default=256)
+    parser.add_argument("--min_frequency", type=int, default=2)
+    parser.add_argument("--out", type=str, default="tokenizer.json")
+    args = parser.parse_args()
+
+    with open(args.input, encoding="utf-8") as f:
+        text = f.read()
+    t0 = time.time()
+    tokenizer = train(text, args.vocab_size, min_frequency=args.min_frequency)
+    dt = time.time() - t0
+    tokenizer.save(args.out)
+    n_tokens = len(tokenizer.encode(text))
+    print(
+        f"{len(tokenizer.chars)} chars + {len(tokenizer.merges)} merges in "
+        f"{dt:.2f}s, {n_tokens / len(text):.3f} tokens per char "
+        f"({len(text)} chars -> {n_tokens} tokens), wrote {args.out}"
+    )
+
+
+if __name__ == "__main__":
+    main()
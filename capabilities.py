@@ -0,0 +1,126 @@
+"""
+Background, cached probe of what the remote services support.
+
+Each capability is a check: a callable returning True (supported) or False (not
+supported), or raising if it could not tell, e.g. because the network is down.
+The results are cached in a JSON file together with the probe version and a
+fingerprint of the target (e.g. the Supabase URL), so a restart against the same
+database reuses them without any round trip. Bump PROBE_VERSION when the checks
+change meaning, to invalidate old caches.
+
+Probing never blocks startup: start() returns at once, the checks run in a
+daemon thread, and status() tells a readiness endpoint where they are at.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger("void-z1")
+
+PROBE_VERSION = 1
+
+
+class CapabilityProbe:
+
+    def __init__(self, checks, cache_path, fingerprint="", ttl=24 * 3600, retry=60):
+        self.checks = checks  # capability name -> check callable
+        self.cache_path = cache_path
+        self.fingerprint = fingerprint
+        self.ttl = ttl
+        self.retry = retry
+        self.capabilities = {}  # name -> bool, only checks that gave an answer
+        self.errors = {}  # name -> error message of checks that could not tell
+        self.checked_at = None
+        self.source = None  # "cache" or "probe"
+        self._done = threading.Event()
+        self._thread = None
+
+    def _cache_key(self):
+        return {
+            "version": PROBE_VERSION,
+            "fingerprint": self.fingerprint,
+            "checks": sorted(self.checks),
+        }
+
+    def _load_cache(self):
+        try:
+            with open(self.cache_path) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if cache.get("key") != self._cache_key():
+            return False
+        if time.time() - cache.get("checked_at", 0) > self.ttl:
+            return False
+        self.capabilities = cache["capabilities"]
+        self.checked_at = cache["checked_at"]
+        self.source = "cache"
+        return True
+
+    def _save_cache(self):
+        os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+        tmp = self.cache_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(
+                {
+                    "key": self._cache_key(),
+                    "checked_at": self.checked_at,
+                    "capabilities": self.capabilities,
+                },
+                f,
+            )
+        os.replace(tmp, self.cache_path)
+
+    def probe(self):
+        """Run the checks that have no answer yet. Returns True once all have one."""
+        for name, check in self.checks.items():
+            if name in self.capabilities:
+                continue
+            try:
+                self.capabilities[name] = bool(check())
+                self.errors.pop(name, None)
+            except Exception as e:
+                self.errors[name] = str(e)
+                logger.warning(f"Capability check '{name}' failed: {e}")
+        self.checked_at = time.time()
+        self.source = "probe"
+        if self.errors:
+            return False
+        self._save_cache()
+        logger.info(f"Capabilities: {self.capabilities}")
+        return True
+
+    def _run(self):
+        if self._load_cache():
+            logger.info(f"Capabilities (cached): {self.capabilities}")
+            self._done.set()
+            return
+        while not self.probe():
+            # ready with what we know, keep trying the checks that could not tell
+            self._done.set()
+            time.sleep(self.retry)
+        self._done.set()
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name="capability-probe", daemon=True
+        )
+        self._thread.start()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def get(self, name, default=False):
+        return self.capabilities.get(name, default)
+
+    def status(self):
+        return {
+            "done": self._done.is_set(),
+            "source": self.source,
+            "checked_at": self.checked_at,
+            "capabilities": dict(self.capabilities),
+            "errors": dict(self.errors),
+        }
@@ -1,12 +1,15 @@
 # Core imports
-import hashlib
+import gc
 import logging
+import math
 import os
 import pickle
 import signal
 import sys
+import threading
 import time
-from collections import defaultdict
+import uuid
+from contextlib import contextmanager, nullcontext
 from datetime import datetime
 from functools import wraps
 from logging.handlers import RotatingFileHandler
@@ -21,10 +24,22 @@ from dotenv import load_dotenv
 from supabase import create_client, Client
 
 # Flask imports
-from flask import Flask, jsonify, request, send_from_directory
+from flask import Flask, Response, g, jsonify, request
 from flask_cors import CORS
 
+from bpe import load_vocab
+from capabilities import CapabilityProbe
+from embedder import GPTEmbedder
+from finetune import FinetuneQueue
+from lora import AdapterStore, base_of, inject
+from memory_index import MemoryStore, MemorySync
+from memory_policy import MemoryPolicy, memory_limit
+from metrics import CONTENT_TYPE, MetricsRegistry
+from write_behind import SupabaseSink, WriteBehindQueue
 from model import GPT, GPTConfig
+from model_registry import ModelRegistry, ModelVersion
+from rate_limit import LocalLimiter, SharedLimiter
+from static_assets import StaticAssets
 
 # --> NEW: Load environment variables for Supabase
 load_dotenv()
@@ -53,6 +68,8 @@ MODEL_PATH = os.getenv('MODEL_PATH', 'out/model.pt')
 VOCAB_PATH = os.getenv('VOCAB_PATH', 'data/void/vocab.pkl')
 META_PATH = os.getenv('META_PATH', 'data/void/meta.pkl')
 PORT = int(os.getenv('PORT', 10000))
+MODEL_WATCH_INTERVAL = float(os.getenv('MODEL_WATCH_INTERVAL', '5'))  # 0: off
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')  # enables POST /admin/reload
 INPUT_PATH = 'data/input.txt'
 
 # Fast failure for missing required files
@@ -70,36 +87,212 @@ for required_file, description in [
 # --> NEW: Supabase and AI Memory settings
 SUPABASE_URL = os.getenv("VITE_SUPABASE_URL")
 SUPABASE_KEY = os.getenv("VITE_SUPABASE_ANON_KEY")
-EMBEDDING_MODEL = 'all-MiniLM-L6-v2'  # Produces 384-dim vectors
-# Note: The SQL schema was updated for 768 dims. Let's adjust it in code for now.
-# A better fix would be to align the model and schema.
-# For example, use 'all-mpnet-base-v2' for 768-dim.
+CHAT_WRITE_BATCH_SIZE = int(os.getenv("CHAT_WRITE_BATCH_SIZE", "50"))
+CHAT_WRITE_FLUSH_INTERVAL = float(os.getenv("CHAT_WRITE_FLUSH_INTERVAL", "1.0"))
+CHAT_WRITE_MAX_PENDING = int(os.getenv("CHAT_WRITE_MAX_PENDING", "10000"))
+CAPABILITY_CACHE_PATH = os.getenv("CAPABILITY_CACHE_PATH", "out/capabilities.json")
+
+# --- Fine-tuning settings ---
+FINETUNE_DATA_DIR = os.getenv("FINETUNE_DATA_DIR", "data/finetune")
+FINETUNE_WORKERS = int(os.getenv("FINETUNE_WORKERS", "1"))
+FINETUNE_MAX_PENDING = int(os.getenv("FINETUNE_MAX_PENDING", "16"))
+FINETUNE_ITERS = int(os.getenv("FINETUNE_ITERS", "50"))
+# 'lora': /train fits a low-rank adapter per user, which their chats then use
+# (lora.py); 'full': it fine-tunes the served weights, for everyone
+FINETUNE_MODE = os.getenv("FINETUNE_MODE", "lora")
+FINETUNE_LEARNING_RATE = float(
+    os.getenv("FINETUNE_LEARNING_RATE", "1e-3" if FINETUNE_MODE == "lora" else "1e-4")
+)
+ADAPTER_DIR = os.getenv("ADAPTER_DIR", "out/adapters")
+ADAPTER_CACHE_SIZE = int(os.getenv("ADAPTER_CACHE_SIZE", "256"))
+MEMORY_INDEX_DIR = os.getenv("MEMORY_INDEX_DIR", "out/memory")
+MEMORY_MATCH_THRESHOLD = float(os.getenv("MEMORY_MATCH_THRESHOLD", "0.75"))
+MEMORY_MATCH_COUNT = int(os.getenv("MEMORY_MATCH_COUNT", "5"))
+MEMORY_SYNC_INTERVAL = float(os.getenv("MEMORY_SYNC_INTERVAL", "60"))
+
+# --- Inference settings ---
+# generations running at once in a process, torch already spreads one over all
+# cores; later requests wait for a slot (void_queue_wait_seconds)
+GENERATION_CONCURRENCY = int(os.getenv("GENERATION_CONCURRENCY", "1"))
+# past block_size, the oldest CONTEXT_SHIFT tokens are dropped and the window
+# re-encoded (default block_size / 4); 0 keeps decoding at the last position
+# without re-encoding (see GPT.generate_rolling)
+CONTEXT_SHIFT = os.getenv("CONTEXT_SHIFT")
+CONTEXT_SHIFT = int(CONTEXT_SHIFT) if CONTEXT_SHIFT else None
+# POST /score: texts per request, chars per text, windows per forward
+SCORE_MAX_TEXTS = int(os.getenv("SCORE_MAX_TEXTS", "1000"))
+SCORE_MAX_CHARS = int(os.getenv("SCORE_MAX_CHARS", "10000"))
+SCORE_BATCH_SIZE = int(os.getenv("SCORE_BATCH_SIZE", "32"))
+
+# --- Memory settings ---
+# full collections only above this RSS (default: 80% of the container limit)
+# or after GC_IDLE_SECONDS without requests
+GC_HIGH_WATERMARK_MB = os.getenv("GC_HIGH_WATERMARK_MB")
+GC_IDLE_SECONDS = float(os.getenv("GC_IDLE_SECONDS", "30"))
 
 # --- Security settings ---
 RATE_LIMIT_REQUESTS = int(os.getenv("RATE_LIMIT_REQUESTS", "100"))
 RATE_LIMIT_WINDOW = int(os.getenv("RATE_LIMIT_WINDOW", "3600"))
 MAX_PROMPT_LENGTH = int(os.getenv("MAX_PROMPT_LENGTH", "1000"))
 
-# Rate limiting
-request_counts = defaultdict(lambda: {"count": 0, "window_start": time.time()})
+# 'local': per process, 'shared': one limit across all workers of the host
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "local")
+RATE_LIMIT_MAX_CLIENTS = int(os.getenv("RATE_LIMIT_MAX_CLIENTS", "100000"))
+
+# Rate limiting: a token bucket per client, memory bounded by max_keys
+if RATE_LIMIT_BACKEND == "shared":
+    rate_limiter = SharedLimiter(
+        RATE_LIMIT_REQUESTS,
+        RATE_LIMIT_WINDOW,
+        max_keys=RATE_LIMIT_MAX_CLIENTS,
+        path=os.getenv("RATE_LIMIT_SHM_PATH"),
+    )
+else:
+    rate_limiter = LocalLimiter(
+        RATE_LIMIT_REQUESTS, RATE_LIMIT_WINDOW, max_keys=RATE_LIMIT_MAX_CLIENTS
+    )
 
 # Global state
-model = None
-stoi = None
-itos = None
 training_status = {'status': 'idle', 'message': ''}
-# --> NEW: Supabase client and embedding model
+finetune_queue = None
+# users' adapters, the ADAPTER_CACHE_SIZE last used ones in memory
+adapter_store = (
+    AdapterStore(ADAPTER_DIR, ADAPTER_CACHE_SIZE) if FINETUNE_MODE == "lora" else None
+)
+# --> NEW: Supabase client
 supabase: Client = None
-embedding_model = None
+# local index of past chats, replaces the match_relevant_chats RPC
+memory_store = MemoryStore(MEMORY_INDEX_DIR)
+memory_sync = None
+# write-behind queue of rows for the 'chats' table
+chat_writer = None
+# what the database supports, probed in the background (see /ready)
+capability_probe = None
+
+# --- Metrics (GET /metrics) ---
+
+
+def model_memory_bytes():
+    active = model_registry.current
+    if active is None:
+        return {}
+    tensors = list(active.model.parameters()) + list(active.model.buffers())
+    return {(active.version,): sum(t.numel() * t.element_size() for t in tensors)}
+
+
+metrics = MetricsRegistry()
+request_seconds = metrics.histogram(
+    "void_request_seconds", "Time to handle a request.", ["endpoint"]
+)
+queue_wait_seconds = metrics.histogram(
+    "void_queue_wait_seconds", "Time a chat waited for a generation slot."
+)
+prompt_encode_seconds = metrics.histogram(
+    "void_prompt_encode_seconds",
+    "Time to build the model input: memory recall and tokenization.",
+)
+prefill_seconds = metrics.histogram(
+    "void_prefill_seconds", "Time of the first generation step, over the prompt."
+)
+decode_token_seconds = metrics.histogram(
+    "void_decode_token_seconds", "Time of each later generation step."
+)
+decode_seconds = metrics.histogram(
+    "void_decode_seconds", "Time of all generation steps after the first."
+)
+scored_tokens_total = metrics.counter(
+    "void_scored_tokens_total", "Tokens scored by /score."
+)
+generated_tokens = metrics.histogram(
+    "void_generated_tokens",
+    "Tokens generated per chat.",
+    buckets=(1, 5, 10, 25, 50, 100, 200, 500, 1000),
+)
+rate_limited_total = metrics.counter(
+    "void_rate_limited_total", "Requests rejected by the rate limiter."
+)
+timeouts_total = metrics.counter(
+    "void_timeouts_total", "Chats that hit the generation time limit."
+)
+cache_requests_total = metrics.counter(
+    "void_cache_requests_total",
+    "Lookups of the memory index (a hit recalled memories), of static files "
+    "(a hit is a 304) and of users' adapters (a hit was in memory).",
+    ["cache", "result"],
+)
+generation_active = metrics.gauge("void_generation_active", "Generations running.")
+generation_waiting = metrics.gauge(
+    "void_generation_waiting", "Chats waiting for a generation slot."
+)
+metrics.gauge(
+    "void_generation_occupancy", "Fraction of the generation slots in use."
+).set_function(lambda: generation_active.get() / GENERATION_CONCURRENCY)
+metrics.gauge(
+    "void_model_memory_bytes",
+    "Parameters and buffers of the served model.",
+    ["version"],
+).set_function(model_memory_bytes)
+metrics.gauge(
+    "void_adapters_loaded", "Users' adapters held in memory."
+).set_function(lambda: len(adapter_store) if adapter_store is not None else 0)
+metrics.gauge(
+    "void_process_resident_memory_bytes", "Resident set size of the process."
+).set_function(lambda: memory_policy.snapshot()["rss_bytes"])
+metrics.counter(
+    "void_gc_collections_total",
+    "Full collections run by the memory policy.",
+    ["reason"],
+).set_function(
+    lambda: {(k,): v for k, v in memory_policy.stats["collections"].items()}
+)
+metrics.counter(
+    "void_gc_pause_seconds_total", "Time spent in those collections."
+).set_function(lambda: memory_policy.stats["pause_seconds_total"])
+
+generation_slots = threading.BoundedSemaphore(GENERATION_CONCURRENCY)
+
+
+@contextmanager
+def generation_slot():
+    """Hold one of the GENERATION_CONCURRENCY generation slots."""
+    t0 = time.perf_counter()
+    generation_waiting.inc()
+    try:
+        generation_slots.acquire()
+    finally:
+        generation_waiting.dec()
+    queue_wait_seconds.observe(time.perf_counter() - t0)
+    generation_active.inc()
+    try:
+        yield
+    finally:
+        generation_active.dec()
+        generation_slots.release()
+
 
 # --> NEW: Function to initialize Supabase client
 
 
 def init_supabase():
-    global supabase
+    global supabase, memory_sync, chat_writer, capability_probe
     if SUPABASE_URL and SUPABASE_KEY:
         logger.info("Initializing Supabase client...")
         supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+        chat_writer = WriteBehindQueue(
+            SupabaseSink(supabase, "chats"),
+            batch_size=CHAT_WRITE_BATCH_SIZE,
+            flush_interval=CHAT_WRITE_FLUSH_INTERVAL,
+            max_pending=CHAT_WRITE_MAX_PENDING,
+            name="chat-writer",
+        )
+        capability_probe = CapabilityProbe(
+            {"chats.embedding": check_chats_embedding},
+            CAPABILITY_CACHE_PATH,
+            fingerprint=SUPABASE_URL,
+        )
+        capability_probe.start()
+        memory_sync = MemorySync(memory_store, supabase, MEMORY_SYNC_INTERVAL)
+        memory_sync.start()
     else:
         logger.warning(
             "Supabase environment variables not set. "
@@ -107,10 +300,20 @@ def init_supabase():
         )
 
 # --> NEW: Function to load the embedding model
-def load_embedding_model():
-    global embedding_model
-    embedding_model = None
-    logger.info("Embedding model loading is disabled for low-memory deployment.")
+def use_for_memory(version):
+    """
+    sentence-transformers is too heavy for the deployment box, so the memory
+    embeddings come from the trunk of the chat model itself: the version just
+    published. The memory index is kept per model version and rebuilt from the
+    previous one's texts (see MemoryStore), so no copy of older weights has to
+    stay resident for the embeddings to remain comparable.
+    """
+    embedder = GPTEmbedder(version.model, version.tokenizer)
+    memory_store.set_version(version.version, embedder.encode)
+    logger.info(
+        f"Embedding memories with model version {version.version} "
+        f"({embedder.dim} dims)"
+    )
 
 
 def check_required_files():
@@ -132,38 +335,11 @@ def check_required_files():
         raise RuntimeError(error_msg)
 
 
-def load_model():
-    """Load the model and its configuration."""
-    global model, stoi, itos
-    try:
-        logger.info("Loading model configuration...")
-        with open(META_PATH, 'rb') as f:
-            meta = pickle.load(f)
-
-        with open(VOCAB_PATH, 'rb') as f:
-            chars, stoi = pickle.load(f)
-
-        logger.info("Initializing model...")
-        config = GPTConfig(**meta)
-        model = GPT(config)
-
-        logger.info("Loading model weights...")
-        model.load_state_dict(torch.load(MODEL_PATH, map_location='cpu'))
-        model.eval()
-
-        itos = {i: ch for ch, i in stoi.items()}
-        logger.info("Model loaded successfully")
-    except Exception as e:
-        logger.error(f"Failed to load model: {str(e)}")
-        model = None
-        stoi = None
-        itos = None
-
-
 def get_client_identifier():
     """Get a unique identifier for the client."""
-    identifier = str(request.headers.get("X-Forwarded-For", request.remote_addr))
-    return hashlib.sha256(identifier.encode()).hexdigest()
+    identifier = request.headers.get("X-Forwarded-For", request.remote_addr) or ""
+    # the first address is the client's, the length cap bounds the key size
+    return identifier.split(",")[0].strip()[:64]
 
 
 def rate_limit(f):
@@ -171,29 +347,20 @@ def rate_limit(f):
 
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        client_id = get_client_identifier()
-        current_time = time.time()
-        client_data = request_counts[client_id]
-
-        # Reset window if expired
-        if current_time - client_data["window_start"] > RATE_LIMIT_WINDOW:
-            client_data["count"] = 0
-            client_data["window_start"] = current_time
-
-        # Check rate limit
-        if client_data["count"] >= RATE_LIMIT_REQUESTS:
+        allowed, retry_after = rate_limiter.allow(get_client_identifier())
+        if not allowed:
+            rate_limited_total.inc()
             response = jsonify(
                 {
                     "error": "Rate limit exceeded",
                     "reset_time": datetime.fromtimestamp(
-                        client_data["window_start"] + RATE_LIMIT_WINDOW
+                        time.time() + retry_after
                     ).isoformat(),
                 }
             )
             response.status_code = 429
+            response.headers["Retry-After"] = str(int(retry_after) + 1)
             return response
-
-        client_data["count"] += 1
         return f(*args, **kwargs)
 
     return decorated_function
@@ -248,50 +415,80 @@ class time_limit:
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 FRONTEND_BUILD_DIR = os.path.join(BASE_DIR, 'frontend', 'dist', 'public')
 
-app = Flask(
-    __name__,
-    static_folder=FRONTEND_BUILD_DIR,
-    static_url_path=''
-)
+# the frontend is served by serve_static, from memory
+app = Flask(__name__, static_folder=None)
 CORS(app)
 app.after_request(add_security_headers)
 
 # --- Model and vocab loading ---
 
 
-def try_load_model():
-    try:
-        logger.info("Loading model and vocabulary...")
-        with open(VOCAB_PATH, "rb") as f:
-            chars, stoi = pickle.load(f)
-        itos = {i: ch for i, ch in stoi.items()}
-        vocab_size = len(chars)
-        logger.info(f"Loaded vocabulary with size {vocab_size}")
-        with open(META_PATH, "rb") as f:
-            meta = pickle.load(f)
-        logger.info("Loaded meta configuration")
-        config = GPTConfig(
-            vocab_size=vocab_size,
-            block_size=meta.get("block_size", 64),
-            n_layer=meta.get("n_layer", 4),
-            n_head=meta.get("n_head", 4),
-            n_embd=meta.get("n_embd", 128),
-            dropout=0.0,
-            bias=meta.get("bias", True),
-        )
-        logger.info("Loading model weights...")
-        model = GPT(config)
-        model.load_state_dict(torch.load(MODEL_PATH, map_location="cpu"))
-        model.eval()
-        logger.info("Model loaded successfully")
-        return model, stoi, itos
-    except Exception as e:
-        logger.error(f"Error during initialization: {str(e)}")
-        logger.error("Stack trace:", exc_info=True)
-        return None, None, None
+def load_model_version(path, version):
+    """Load the weights at path with the current vocab and meta configuration."""
+    logger.info(f"Loading model version {version} from {path}...")
+    with open(META_PATH, "rb") as f:
+        meta = pickle.load(f)
+    # the BPE tokenizer of the dataset (prepare.py --bpe_vocab_size), or chars
+    tokenizer = load_vocab(META_PATH if "tokenizer" in meta else VOCAB_PATH)
+    vocab_size = tokenizer.vocab_size
+    logger.info(f"Loaded vocabulary with size {vocab_size}")
+    config = GPTConfig(
+        vocab_size=vocab_size,
+        block_size=meta.get("block_size", 64),
+        n_layer=meta.get("n_layer", 4),
+        n_head=meta.get("n_head", 4),
+        n_kv_head=meta.get("n_kv_head", 0),
+        n_embd=meta.get("n_embd", 128),
+        dropout=0.0,
+        bias=meta.get("bias", True),
+    )
+    model = GPT(config)
+    model.load_state_dict(torch.load(path, map_location="cpu"))
+    model.eval()
+    adapter_base = None
+    if adapter_store is not None:
+        inject(model)
+        adapter_base = base_of(model)
+    return ModelVersion(
+        model,
+        tokenizer.stoi,
+        tokenizer.itos,
+        version,
+        path,
+        tokenizer=tokenizer,
+        adapter_base=adapter_base,
+    )
+
+
+def warmup_model(candidate):
+    """A short generation, so the first request is not the one paying for it."""
+    idx = torch.zeros((1, 1), dtype=torch.long)
+    with torch.no_grad():
+        candidate.model.generate_rolling(idx, max_new_tokens=2, top_k=1)
 
 
-model, stoi, itos = try_load_model()
+model_registry = ModelRegistry(
+    load_model_version, warmup=warmup_model, on_publish=use_for_memory
+)
+if os.path.exists(MODEL_PATH):
+    # the first version is loaded before serving, later ones in the background
+    model_registry.load(MODEL_PATH)
+if MODEL_WATCH_INTERVAL > 0:
+    model_registry.watch(MODEL_PATH, MODEL_WATCH_INTERVAL)
+if model_registry.current is None:
+    logger.info("Chat model not loaded, AI memory is disabled.")
+
+if GC_HIGH_WATERMARK_MB:
+    gc_high_watermark = int(GC_HIGH_WATERMARK_MB) * 2**20
+else:
+    limit = memory_limit()
+    gc_high_watermark = int(0.8 * limit) if limit else None
+memory_policy = MemoryPolicy(gc_high_watermark, idle_seconds=GC_IDLE_SECONDS)
+memory_policy.start()
+# everything allocated so far (modules, the model) lives as long as the process,
+# keep it out of the collector's way
+gc.collect()
+gc.freeze()
 
 
 # --- Health check ---
@@ -306,37 +503,141 @@ def health_check():
     return jsonify({"status": "ok", "message": "Void Z1 is running."}), 200
 
 
+@app.route("/metrics")
+def metrics_endpoint():
+    """Prometheus metrics of this process."""
+    return Response(metrics.render(), content_type=CONTENT_TYPE)
+
+
+@app.route("/ready")
+def ready():
+    """Readiness: the model is loaded and the capability probe has run."""
+    probe = capability_probe.status() if capability_probe else None
+    loaded = model_registry.current is not None
+    is_ready = loaded and (probe is None or probe["done"])
+    body = {
+        "ready": is_ready,
+        "model_loaded": loaded,
+        "model": model_registry.info(),
+        "capabilities": probe,
+        "memory": memory_policy.snapshot(),
+    }
+    return jsonify(body), 200 if is_ready else 503
+
+
+@app.route("/admin/reload", methods=["POST"])
+def admin_reload():
+    """Reload MODEL_PATH now, without waiting for the file watcher."""
+    if not ADMIN_TOKEN:
+        return jsonify({"error": "Not found"}), 404
+    if request.headers.get("X-Admin-Token") != ADMIN_TOKEN:
+        return jsonify({"error": "Forbidden"}), 403
+    active = model_registry.load(MODEL_PATH)
+    body = model_registry.info()
+    return jsonify(body), 200 if active is not None else 500
+
+
+def swap_model(new_model):
+    """Serve fine-tuned weights. Requests in flight finish on the old model."""
+    # written atomically, the registry then loads it like any new checkpoint
+    tmp_path = MODEL_PATH + ".tmp"
+    torch.save(new_model.state_dict(), tmp_path)
+    os.replace(tmp_path, MODEL_PATH)
+    model_registry.load(MODEL_PATH)
+
+
+def report_training_status(job):
+    """Mirror a fine-tuning job into training_status and 'training_sessions'."""
+    training_status.update(
+        status=job.status,
+        message=job.message,
+        job_id=job.id,
+        pending=finetune_queue.pending() if finetune_queue else 0,
+    )
+    if supabase and job.user_id != "anonymous":
+        supabase.table('training_sessions').upsert({
+            'id': job.session_id or job.id,
+            'user_id': job.user_id,
+            'text': job.text,
+            'status': job.status,
+            'updated_at': datetime.utcnow().isoformat(),
+        }).execute()
+
+
+def init_finetune():
+    global finetune_queue
+    active = model_registry.current
+    if active is None:
+        logger.warning("Chat model not loaded, fine-tuning is disabled.")
+        return
+    finetune_queue = FinetuneQueue(
+        FINETUNE_DATA_DIR,
+        active.tokenizer,
+        get_model=lambda: model_registry.current.model,
+        on_model=swap_model,
+        on_status=report_training_status,
+        max_workers=FINETUNE_WORKERS,
+        max_pending=FINETUNE_MAX_PENDING,
+        iters=FINETUNE_ITERS,
+        learning_rate=FINETUNE_LEARNING_RATE,
+        adapters=adapter_store,
+    )
+
+
 @app.route("/train", methods=["POST"])
+@rate_limit
 def train():
     data = request.get_json()
     text = data.get("text", "")
-    user_id = data.get("user_id", None)
+    user_id = data.get("user_id") or "anonymous"
     if not text:
         return jsonify({"error": "No training text provided."}), 400
-    # Simulate training (no-op for dummy model)
+    # session_id: the training_sessions row the client created, if any
+    session_id = data.get("session_id")
+    if session_id is not None:
+        try:
+            session_id = str(uuid.UUID(str(session_id)))
+        except ValueError:
+            return jsonify({"error": "session_id must be a UUID."}), 400
+    if finetune_queue is None:
+        return jsonify({"error": "Training is not available."}), 503
     logger.info(f"Received training text from user {user_id}: {text[:50]}...")
-    return jsonify({"status": "ok", "message": "Training started (simulated)."})
+    job = finetune_queue.submit(user_id, text, session_id)
+    if job is None:
+        return jsonify({"error": "Too many training jobs queued, retry later."}), 503
+    body = {"status": "ok", "message": "Training queued.", "job": job.to_dict()}
+    return jsonify(body), 202
+
+
+@app.route("/status")
+def status():
+    """Status of the latest fine-tuning job, or of the one given as ?job_id=."""
+    job_id = request.args.get("job_id")
+    if job_id:
+        job = finetune_queue.jobs.get(job_id) if finetune_queue else None
+        if job is None:
+            return jsonify({"error": "Unknown job"}), 404
+        return jsonify(job.to_dict())
+    return jsonify(training_status)
+
+
+static_assets = StaticAssets(FRONTEND_BUILD_DIR)
+logger.info(f"Indexed {len(static_assets)} frontend files")
 
 
 @app.route("/")
 def serve_index():
     """Serve the main frontend for Void Z1."""
-    return send_from_directory(FRONTEND_BUILD_DIR, "index.html")
+    return serve_static("index.html")
 
 
 @app.route("/<path:path>")
 def serve_static(path):
-    file_path = os.path.join(FRONTEND_BUILD_DIR, path)
-    if not os.path.isfile(file_path):
-        # For SPA routing, fallback to index.html
-        return send_from_directory(FRONTEND_BUILD_DIR, "index.html")
-    response = send_from_directory(FRONTEND_BUILD_DIR, path)
-    if path.endswith((".js", ".css", ".html")):
-        response.headers["Cache-Control"] = (
-            "no-cache, no-store, must-revalidate"
-        )
-        response.headers["Pragma"] = "no-cache"
-        response.headers["Expires"] = "0"
+    response = static_assets.response(path, request.headers)
+    if response is None:
+        return jsonify({"error": "Not found"}), 404
+    result = "hit" if response.status_code == 304 else "miss"
+    cache_requests_total.labels("static", result).inc()
     return response
 
 
@@ -347,7 +648,9 @@ def serve_static(path):
 @rate_limit
 def chat():
     """Handle chat requests with AI memory."""
-    if not model or not stoi or not itos:
+    # this request's model, a reload in the meantime does not affect it
+    active = model_registry.current
+    if active is None:
         # Dummy response if model is not loaded
         logger.warning(
             "Model not loaded, returning dummy response."
@@ -365,98 +668,192 @@ def chat():
     if not user_id:
         return jsonify({"error": "User not authenticated"}), 401
 
+    model, tokenizer = active.model, active.tokenizer
     try:
+        t_encode = time.perf_counter()
         # --> NEW: AI Memory Logic
         memory_context = ""
-        # Remove or comment out embedding model usage
-        # if supabase and embedding_model:
-        #     try:
-        #         # 1. Create an embedding for the user's prompt
-        #         prompt_embedding = embedding_model.encode(prompt).tolist()
-
-        #         # 2. Find relevant past conversations
-        #         matches = supabase.rpc('match_relevant_chats', {
-        #             'query_embedding': prompt_embedding,
-        #             'match_threshold': 0.75,
-        #             'match_count': 5,
-        #             'request_user_id': user_id
-        #         }).execute()
-
-        #         if matches.data:
-        #             logger.info(f"Found {len(matches.data)} relevant memories for user {user_id}")
-        #             # Create a context string from the memories
-        #             memory_context = "Relevant past conversations:\n"
-        #             for match in reversed(matches.data):  # reversed to keep chronological order
-        #                 memory_context += f"User: {match['message']}\nAI: {match['response']}\n"
-        #             memory_context += "\n---\nCurrent Conversation:\n"
-
-        #     except Exception as e:
-        #         logger.error(f"Error fetching AI memory: {e}", exc_info=True)
-
-        # Combine memory with the current prompt
-        final_prompt = memory_context + prompt
+        prompt_embedding = memory_version = None
+        if memory_store.version is not None:
+            try:
+                # 1. Create an embedding for the user's prompt
+                memory_version, prompt_embedding = memory_store.encode(prompt)
+
+                # 2. Find relevant past conversations in the local index
+                matches = memory_store.search(
+                    user_id,
+                    prompt_embedding,
+                    threshold=MEMORY_MATCH_THRESHOLD,
+                    count=MEMORY_MATCH_COUNT,
+                    version=memory_version,
+                )
+                result = "hit" if matches else "miss"
+                cache_requests_total.labels("memory", result).inc()
+
+                if matches:
+                    logger.info(f"Found {len(matches)} relevant memories for user {user_id}")
+                    # Create a context string from the memories
+                    memory_context = "Relevant past conversations:\n"
+                    for match in reversed(matches):  # reversed to keep chronological order
+                        memory_context += f"User: {match['message']}\nAI: {match['response']}\n"
+                    memory_context += "\n---\nCurrent Conversation:\n"
+
+            except Exception as e:
+                logger.error(f"Error fetching AI memory: {e}", exc_info=True)
+
+        # Combine memory with the current prompt. Chars outside the vocab (e.g.
+        # in recalled memories) are dropped
+        memory_ids = tokenizer.encode(memory_context)
+        prompt_ids = tokenizer.encode(prompt)
+
+        encoded_prompt = torch.tensor(
+            memory_ids + prompt_ids, dtype=torch.long, device='cpu'
+        ).unsqueeze(0)
+        prompt_encode_seconds.observe(time.perf_counter() - t_encode)
+
+        # the user's own model: the served one with their adapter, if any
+        adapter = None
+        if adapter_store is not None:
+            result = "hit" if adapter_store.in_memory(user_id) else "miss"
+            try:
+                # none if trained on other weights than the served ones
+                adapter = adapter_store.get(user_id, base=active.adapter_base)
+            except Exception as e:
+                logger.error(f"Error loading adapter of {user_id}: {e}", exc_info=True)
+            if adapter is not None:
+                cache_requests_total.labels("adapter", result).inc()
+        applied = adapter.bank.rows(1) if adapter is not None else nullcontext()
 
         # Generate response from the model
         with time_limit(30):
-            encoded_prompt = torch.tensor([
-                stoi[c] for c in final_prompt
-            ], dtype=torch.long, device='cpu').unsqueeze(0)
-            with torch.no_grad():
-                generated_encoded = model.generate(
+            timings = {}
+            with generation_slot(), torch.no_grad(), applied:
+                generated_encoded = model.generate_rolling(
                     encoded_prompt,
                     max_new_tokens=data.get("max_new_tokens", 100),
                     temperature=data.get("temperature", 0.8),
-                    top_k=data.get("top_k", 200)
+                    top_k=data.get("top_k", 200),
+                    shift=CONTEXT_SHIFT,
+                    timings=timings,
+                )
+            if "prefill" in timings:
+                prefill_seconds.observe(timings["prefill"])
+            for seconds in timings["decode"]:
+                decode_token_seconds.observe(seconds)
+            decode_seconds.observe(sum(timings["decode"]))
+            generated_tokens.observe(
+                generated_encoded.size(1) - encoded_prompt.size(1)
+            )
+            # the memory context is not part of the response
+            response_text = tokenizer.decode(
+                generated_encoded[0, len(memory_ids):].tolist()
+            )
+
+        # the same id is used for the database row, so that the memory sync
+        # recognizes the chat as already indexed
+        chat_id = str(uuid.uuid4())
+        if prompt_embedding is not None:
+            try:
+                memory_store.add(
+                    user_id,
+                    chat_id,
+                    prompt_embedding,
+                    prompt,
+                    response_text,
+                    version=memory_version,
                 )
-            response_text = "".join([
-                itos[i] for i in generated_encoded[0].tolist()
-            ])
-
-        # --> NEW: Save the new conversation and its embedding to the database
-        # if supabase and embedding_model:
-        #     try:
-        #         # We use the original prompt's embedding
-        #         supabase.table('chats').insert({
-        #             'user_id': user_id,
-        #             'message': prompt,
-        #             'response': response_text,
-        #             'embedding': prompt_embedding
-        #         }).execute()
-        #     except Exception as e:
-        #         logger.error(
-        #             f"Error saving chat to Supabase: {e}", exc_info=True
-        #         )
-        #         if 'embedding' in str(e):
-        #             return jsonify({
-        #                 "error": (
-        #                     "Database is missing the 'embedding' column. "
-        #                     "Please update your schema."
-        #                 )
-        #             }), 500
-
-        return jsonify({"text": response_text})
+            except Exception as e:
+                logger.error(f"Error indexing chat: {e}", exc_info=True)
+
+        # --> NEW: Save the new conversation and its embedding to the database.
+        # Queued only, a background worker does the (batched) insert
+        if chat_writer is not None:
+            row = {
+                'id': chat_id,
+                'user_id': user_id,
+                'message': prompt,
+                'response': response_text,
+            }
+            # the column is an unsized float8[]: the model's n_embd dims are
+            # stored as they are, and MemorySync on the other workers pulls them
+            if prompt_embedding is not None and capability_probe.get("chats.embedding"):
+                row['embedding'] = prompt_embedding.tolist()
+            chat_writer.put(row)
+
+        return jsonify({"text": response_text, "model_version": active.version})
 
     except TimeoutException:
+        timeouts_total.inc()
         return jsonify({"error": "Request timed out"}), 504
     except Exception as e:
         logger.error(f"Error during chat generation: {str(e)}", exc_info=True)
         return jsonify({"error": "Internal server error"}), 500
 
 
-def cleanup_memory():
-    """Clean up memory after each request."""
+@app.route("/score", methods=["POST"])
+@rate_limit
+def score():
+    """
+    Log-likelihood of many texts under the model, e.g. to rank candidate
+    replies or filter data by perplexity. One forward per batch of texts, no
+    generation. Chars outside the vocab are dropped (and counted).
+    """
+    active = model_registry.current
+    if active is None:
+        return jsonify({"error": "Model not loaded"}), 503
+    data = request.get_json(silent=True) or {}
+    texts = data.get("texts")
+    if (
+        not isinstance(texts, list)
+        or not 0 < len(texts) <= SCORE_MAX_TEXTS
+        or not all(isinstance(t, str) and len(t) <= SCORE_MAX_CHARS for t in texts)
+    ):
+        return jsonify({
+            "error": f"'texts' must be a list of 1 to {SCORE_MAX_TEXTS} strings "
+            f"of at most {SCORE_MAX_CHARS} chars"
+        }), 400
+    per_token = bool(data.get("per_token", False))
+
+    tokenizer = active.tokenizer
+    sequences = [tokenizer.encode(text) for text in texts]
     try:
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-        import gc
-        gc.collect()
-    except Exception as e:
-        logger.error(f"Error during cleanup: {str(e)}")
+        with time_limit(30):
+            with generation_slot():
+                scores = active.model.score(sequences, batch_size=SCORE_BATCH_SIZE)
+    except TimeoutException:
+        timeouts_total.inc()
+        return jsonify({"error": "Request timed out"}), 504
+
+    results = []
+    for text, seq, logprobs in zip(texts, sequences, scores):
+        n = len(logprobs)
+        nll = -logprobs.sum().item() if n else 0.0
+        result = {
+            "tokens": len(seq),
+            "unknown_chars": sum(c not in tokenizer.stoi for c in text),
+            "nll": nll,  # of the n = tokens - 1 predicted tokens, in nats
+            "mean_nll": nll / n if n else None,
+            "perplexity": math.exp(nll / n) if n else None,
+        }
+        if per_token:
+            result["logprobs"] = logprobs.tolist()
+        results.append(result)
+        scored_tokens_total.inc(n)
+    return jsonify({"results": results, "model_version": active.version})
+
+
+@app.before_request
+def before_request():
+    g.request_start = time.perf_counter()
 
 
 @app.after_request
 def after_request(response):
-    cleanup_memory()
+    memory_policy.after_request()
+    if "request_start" in g:
+        request_seconds.labels(request.endpoint or "none").observe(
+            time.perf_counter() - g.request_start
+        )
     response.headers['X-Content-Type-Options'] = 'nosniff'
     response.headers['X-Frame-Options'] = 'DENY'
     response.headers['X-XSS-Protection'] = '1; mode=block'
@@ -472,69 +869,31 @@ def server_error(e):
 
 
 # --- Utility to check Supabase function existence ---
-def check_supabase_function_exists():
-    if not supabase:
-        return False
-    try:
-        # Try a dry run of the function with dummy data
-        # dummy_embedding = [0.0] * 384
-        # result = supabase.rpc('match_relevant_chats', {
-        #     'query_embedding': dummy_embedding,
-        #     'match_threshold': 0.0,
-        #     'match_count': 1,
-        #     'request_user_id': (
-        #         '00000000-0000-0000-0000-000000000000'
-        #     )
-        # }).execute()
-        # if hasattr(result, 'status_code') and result.status_code == 404:
-        #     logger.warning(
-        #         "Supabase function 'match_relevant_chats' does not exist or "
-        #         "is not accessible."
-        #     )
-        #     return False
-        return True
-    except Exception as e:
-        logger.warning(
-            f"Supabase function 'match_relevant_chats' check failed: {e}"
-        )
-        return False
+# PostgREST/Postgres error codes meaning "no such column/table/function"
+MISSING_ERROR_CODES = {"42703", "42P01", "42883", "PGRST202", "PGRST204", "PGRST205"}
 
 
-def check_embedding_column():
-    if not supabase:
-        return False
+def check_chats_embedding():
+    """Whether 'chats' has the 'embedding' column. Reads at most one row."""
     try:
-        # Try to insert a dummy row with embedding, rollback immediately
-        from uuid import uuid4
-        dummy_id = str(uuid4())
-        dummy = {
-            'id': dummy_id,
-            'user_id': '00000000-0000-0000-0000-000000000000',
-            'message': 'test',
-            'response': 'test',
-            'embedding': [0.0] * 384
-        }
-        # Use upsert to avoid duplicate errors, and delete after
-        supabase.table('chats').upsert(dummy).execute()
-        supabase.table('chats').delete().eq('id', dummy_id).execute()
+        supabase.table('chats').select('id, embedding').limit(1).execute()
         return True
     except Exception as e:
-        logger.error(
-            "Supabase 'chats' table is missing the 'embedding' column or it "
-            "is misconfigured: %s",
-            e
-        )
-        return False
+        if getattr(e, 'code', None) in MISSING_ERROR_CODES:
+            logger.error(
+                "Supabase 'chats' table is missing the 'embedding' column, "
+                "chats are saved without embeddings"
+            )
+            return False
+        raise  # could not tell, the probe retries
+
+
+# here rather than in __main__, so that it also happens under gunicorn
+init_supabase()
+init_finetune()
 
 
 if __name__ == '__main__':
     check_required_files()
-    init_supabase()  # --> NEW: Initialize Supabase
-    load_embedding_model()  # --> NEW: Load the embedding model
-    load_model()
-    # Check for match_relevant_chats function
-    if supabase:
-        check_supabase_function_exists()
-        check_embedding_column()
     logger.info(f"Starting server on port {PORT}")
     app.run(host="0.0.0.0", port=PORT, debug=False)
@@ -0,0 +1,97 @@
+"""
+Convert a multi-head attention checkpoint to grouped-query attention.
+
+The query heads are kept as they are; the key and value heads of every group
+of n_head // n_kv_head consecutive heads are mean-pooled into the group's one
+key/value head (the initialization of the GQA paper, Ainslie et al. 2023).
+The converted model is worse than the original until it is uptrained for a
+few percent of the original steps, which is what the output is for: a
+train.py checkpoint with a fresh optimizer, to resume from.
+
+$ python convert_gqa.py --ckpt=out/ckpt.pt --n_kv_head=2 --out_dir=out-gqa
+$ python train.py --init_from=resume --out_dir=out-gqa --dataset=void ...
+"""
+
+import argparse
+import os
+
+import torch
+
+from model import GPT, GPTConfig
+
+
+def pool_kv_heads(weight, n_embd, n_head, n_kv_head):
+    """
+    The c_attn weight (or bias) of a multi-head attention layer, rows q | k | v,
+    with the k and v heads mean-pooled into n_kv_head groups.
+    """
+    head_size = n_embd // n_head
+    group = n_head // n_kv_head
+    q, k, v = weight.split(n_embd, dim=0)
+    rest = weight.shape[1:]  # (n_embd,) for the weight, () for the bias
+
+    def pool(t):
+        t = t.view(n_kv_head, group, head_size, *rest).mean(dim=1)
+        return t.reshape(n_kv_head * head_size, *rest)
+
+    return torch.cat([q, pool(k), pool(v)], dim=0)
+
+
+def convert(state_dict, model_args, n_kv_head):
+    n_head, n_embd = model_args["n_head"], model_args["n_embd"]
+    if model_args.get("n_kv_head", 0) not in (0, n_head):
+        raise ValueError("the checkpoint already uses grouped-query attention")
+    if n_head % n_kv_head:
+        raise ValueError(f"n_kv_head={n_kv_head} does not divide n_head={n_head}")
+    converted = {}
+    for name, tensor in state_dict.items():
+        if name.endswith("attn.c_attn.weight") or name.endswith("attn.c_attn.bias"):
+            tensor = pool_kv_heads(tensor, n_embd, n_head, n_kv_head)
+        converted[name] = tensor
+    return converted, dict(model_args, n_kv_head=n_kv_head)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--ckpt", type=str, default="out/ckpt.pt")
+    parser.add_argument("--n_kv_head", type=int, required=True)
+    parser.add_argument("--out_dir", type=str, required=True)
+    parser.add_argument("--learning_rate", type=float, default=6e-4)
+    parser.add_argument("--weight_decay", type=float, default=1e-1)
+    args = parser.parse_args()
+
+    checkpoint = torch.load(args.ckpt, map_location="cpu")
+    state_dict = {
+        k.removeprefix("_orig_mod."): v for k, v in checkpoint["model"].items()
+    }
+    state_dict, model_args = convert(
+        state_dict, checkpoint["model_args"], args.n_kv_head
+    )
+    model = GPT(GPTConfig(**model_args))
+    model.load_state_dict(state_dict)
+    optimizer = model.configure_optimizers(
+        args.weight_decay, args.learning_rate, (0.9, 0.95), "cpu"
+    )
+    os.makedirs(args.out_dir, exist_ok=True)
+    out_path = os.path.join(args.out_dir, "ckpt.pt")
+    torch.save(
+        {
+            "model": model.state_dict(),
+            "optimizer": optimizer.state_dict(),  # no moments yet
+            "model_args": model_args,
+            "iter_num": 0,
+            "best_val_loss": 1e9,
+            "config": dict(checkpoint.get("config", {}), n_kv_head=args.n_kv_head),
+        },
+        out_path,
+    )
+    before = sum(t.numel() for t in checkpoint["model"].values())
+    after = sum(t.numel() for t in state_dict.values())
+    print(
+        f"{model_args['n_head']} -> {args.n_kv_head} key/value heads, "
+        f"{before / 1e6:.2f}M -> {after / 1e6:.2f}M parameters, wrote {out_path}"
+    )
+
+
+if __name__ == "__main__":
+    main()
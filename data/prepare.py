@@ -1,8 +1,12 @@
 import argparse
 import os
 import pickle
+import sys
 import numpy as np
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import bpe
+
 def encode(s, stoi):
     return [stoi[c] for c in s]
 
@@ -10,6 +14,7 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--input_file', type=str, required=True)
     parser.add_argument('--dataset', type=str, required=True)
+    parser.add_argument('--bpe_vocab_size', type=int, default=0, help='0: chars')
     args = parser.parse_args()
 
     with open(args.input_file, 'r', encoding='utf-8') as f:
@@ -23,6 +28,12 @@ def main():
 
     stoi = { ch:i for i,ch in enumerate(chars) }
     encode_fn = lambda x: [stoi[c] for c in x]
+    tokenizer = None
+    if args.bpe_vocab_size:
+        tokenizer = bpe.train(data, args.bpe_vocab_size)
+        vocab_size = tokenizer.vocab_size
+        encode_fn = tokenizer.encode
+        print(f"BPE vocab size: {vocab_size}")
 
     data_enc = np.array(encode_fn(data), dtype=np.uint16)
 
@@ -42,11 +53,17 @@ def main():
     val_data.tofile(val_file)
     with open(vocab_file, 'wb') as f:
         pickle.dump((chars, stoi), f)
+    meta = {'vocab_size': vocab_size}
+    if tokenizer is not None:
+        tokenizer.save(os.path.join(out_dir, 'tokenizer.json'))
+        # itos for eval_ppl.py's bits per char
+        meta.update(tokenizer='tokenizer.json', itos=tokenizer.itos)
     with open(meta_file, 'wb') as f:
-        pickle.dump({'vocab_size': vocab_size}, f)
+        pickle.dump(meta, f)
 
     print(f"train has {len(train_data):,} tokens")
     print(f"val has {len(val_data):,} tokens")
+    print(f"{len(data_enc) / len(data):.3f} tokens per char")
 
 if __name__ == '__main__':
     main()
@@ -1,7 +1,9 @@
+import argparse
 import os
 import pickle
+import sys
 
-def prepare_void_data():
+def prepare_void_data(bpe_vocab_size=0):
     # Get the absolute path to input.txt
     script_dir = os.path.dirname(os.path.abspath(__file__))
     input_path = os.path.join(script_dir, '..', 'input.txt')
@@ -18,6 +20,17 @@ def prepare_void_data():
     # Save the vocabulary
     with open('vocab.pkl', 'wb') as f:
         pickle.dump((chars, stoi), f)
+
+    # subword tokens on top of the chars (bpe.py), recorded in meta.pkl
+    tokenizer = None
+    if bpe_vocab_size:
+        sys.path.insert(0, os.path.join(script_dir, '..', '..'))
+        import bpe
+        tokenizer = bpe.train(text, bpe_vocab_size)
+        tokenizer.save('tokenizer.json')
+        vocab_size = tokenizer.vocab_size
+        n_tokens = len(tokenizer.encode(text))
+        print(f"BPE: {n_tokens / len(text):.3f} tokens per char")
     
     # Save meta information
     meta = {
@@ -28,13 +41,18 @@ def prepare_void_data():
         'n_embd': 128,
         'dropout': 0.1,
     }
+    if tokenizer is not None:
+        meta['tokenizer'] = 'tokenizer.json'
     
     with open('meta.pkl', 'wb') as f:
         pickle.dump(meta, f)
     
     print(f"Prepared {len(text)} characters of text")
     print(f"Vocabulary size: {vocab_size}")
-    print("Files saved: vocab.pkl, meta.pkl")
+    print("Files saved: vocab.pkl, meta.pkl" + (", tokenizer.json" if tokenizer else ""))
 
 if __name__ == '__main__':
-    prepare_void_data()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bpe_vocab_size', type=int, default=0, help='0: chars')
+    args = parser.parse_args()
+    prepare_void_data(args.bpe_vocab_size)
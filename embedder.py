@@ -0,0 +1,52 @@
+"""
+Text embeddings from the serving GPT itself, for the AI memory.
+
+sentence-transformers does not fit next to the model on our box, so GPTEmbedder
+encodes texts with the model's own vocab and pools the trunk of the already
+loaded model (GPT.embed), in chat_api the version being served. It has the
+encode() interface of a SentenceTransformer, so chat_api can use either.
+"""
+
+import numpy as np
+import torch
+
+from bpe import as_tokenizer
+
+
+class GPTEmbedder:
+
+    def __init__(self, model, tokenizer, batch_size=32, device="cpu"):
+        self.model = model
+        self.tokenizer = as_tokenizer(tokenizer)  # or a char stoi dict
+        self.batch_size = batch_size
+        self.device = device
+
+    @property
+    def dim(self):
+        return self.model.config.n_embd
+
+    def tokenize(self, text):
+        # chars outside the vocab are dropped, long texts keep their beginning
+        ids = self.tokenizer.encode(text)
+        return ids[: self.model.config.block_size]
+
+    def encode(self, texts):
+        """
+        L2-normalized float32 embeddings: shape (n_embd,) for a single string,
+        (len(texts), n_embd) for a list of strings.
+        """
+        if isinstance(texts, str):
+            return self.encode([texts])[0]
+        tokens = [self.tokenize(t) for t in texts]
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        # batch texts of similar length together to waste little on padding
+        order = sorted(range(len(texts)), key=lambda i: len(tokens[i]))
+        for start in range(0, len(order), self.batch_size):
+            rows = order[start : start + self.batch_size]
+            lengths = [len(tokens[i]) for i in rows]
+            idx = torch.zeros((len(rows), max(max(lengths), 1)), dtype=torch.long)
+            for r, i in enumerate(rows):
+                idx[r, : lengths[r]] = torch.tensor(tokens[i], dtype=torch.long)
+            emb = self.model.embed(idx.to(self.device), lengths)
+            out[rows] = emb.cpu().numpy()
+        return out
@@ -0,0 +1,214 @@
+"""
+Exact perplexity of one or more checkpoints over a whole token .bin file.
+
+train.py's estimate_loss samples windows, which is fine to follow a run but is
+neither exact nor comparable between models. This streams the entire file
+through the model in sampler.strided_windows (every token scored exactly once,
+with at least block_size - stride tokens of context), batch_size windows per
+forward. Only one batch is ever read from the memmapped file, so memory does
+not grow with the file. Every batch is forwarded through all the checkpoints
+before the next one is read, so the data is loaded once for all of them.
+
+Reported per checkpoint: mean NLL per token, perplexity, bits per token and,
+when the tokens' lengths are known, bits per char (a meta.pkl with itos, as
+written by the char-level prepare.py scripts) or bits per byte (GPT-2 BPE with
+tiktoken installed).
+
+$ python eval_ppl.py --data=data/shakespeare_char/val.bin out-a/ckpt.pt out-b
+$ python eval_ppl.py --data=data/openwebtext/val.bin gpt2 gpt2-medium --max_tokens=1e6
+"""
+
+import argparse
+import json
+import math
+import os
+import pickle
+import time
+from contextlib import nullcontext
+
+import numpy as np
+import torch
+
+from import_gpt2 import import_gpt2
+from model import GPT, GPTConfig
+from paging import load_paged
+from sampler import strided_windows
+
+
+def load_model(name, meta_path=None):
+    """
+    A train.py checkpoint (file or out dir), a gpt2* name, a HuggingFace GPT-2
+    checkpoint (model.safetensors, pytorch_model.bin or their dir), a paged
+    layout (paging.py) or a state dict.
+    """
+    if name.startswith("gpt2") and not os.path.exists(name):
+        return GPT.from_pretrained(name, {"dropout": 0.0})
+    if os.path.exists(os.path.join(name, "layout.json")):
+        return load_paged(name)
+    hf_files = ("model.safetensors", "pytorch_model.bin")
+    if name.endswith((".safetensors", ".bin")) or (
+        os.path.isdir(name)
+        and any(os.path.exists(os.path.join(name, f)) for f in hf_files)
+    ):
+        return import_gpt2(name)
+    path = os.path.join(name, "ckpt.pt") if os.path.isdir(name) else name
+    checkpoint = torch.load(path, map_location="cpu")
+    if "model_args" in checkpoint:
+        config = GPTConfig(**dict(checkpoint["model_args"], dropout=0.0))
+        state_dict = checkpoint["model"]
+    else:
+        # a bare state dict, like chat_api's MODEL_PATH, configured by meta.pkl
+        with open(meta_path, "rb") as f:
+            meta = pickle.load(f)
+        state_dict = checkpoint
+        config = GPTConfig(
+            vocab_size=state_dict["lm_head.weight"].size(0),
+            block_size=state_dict["transformer.wpe.weight"].size(0),
+            n_layer=meta.get("n_layer", 4),
+            n_head=meta.get("n_head", 4),
+            n_kv_head=meta.get("n_kv_head", 0),
+            n_embd=state_dict["transformer.wpe.weight"].size(1),
+            bias=meta.get("bias", True),
+            dropout=0.0,
+        )
+    state_dict = {k.removeprefix("_orig_mod."): v for k, v in state_dict.items()}
+    model = GPT(config)
+    model.load_state_dict(state_dict)
+    return model
+
+
+def token_lengths(meta_path, vocab_size):
+    """(per-token lengths, unit) for bits per char/byte, or (None, None)."""
+    if meta_path and os.path.exists(meta_path):
+        with open(meta_path, "rb") as f:
+            meta = pickle.load(f)
+        if "itos" in meta:
+            lengths = np.zeros(vocab_size, dtype=np.int64)
+            for i, s in meta["itos"].items():
+                lengths[i] = len(s)
+            return lengths, "char"
+    if vocab_size >= 50257:
+        try:
+            import tiktoken
+        except ImportError:
+            return None, None
+        enc = tiktoken.get_encoding("gpt2")
+        lengths = np.zeros(vocab_size, dtype=np.int64)
+        for i in range(enc.n_vocab):
+            lengths[i] = len(enc.decode_single_token_bytes(i))
+        return lengths, "byte"
+    return None, None
+
+
+def evaluate(
+    models, data, block_size, stride, batch_size, device="cpu", ctx=None, lengths=None
+):
+    """
+    Total NLL (nats) of each model over data, the number of tokens scored and
+    their total length (if lengths, per token id, are given).
+    """
+    ctx = ctx or nullcontext()
+    offsets, skip = strided_windows(len(data), block_size, stride)
+    nll = [0.0] * len(models)  # float64 sums over every scored token
+    n_tokens = n_units = 0
+    window = np.arange(block_size + 1)
+    positions = torch.arange(block_size)
+    t0 = time.time()
+    for b, start in enumerate(range(0, len(offsets), batch_size)):
+        ix = offsets[start : start + batch_size]
+        chunk = torch.from_numpy(data[ix[:, None] + window].astype(np.int64))
+        X, Y = chunk[:, :-1], chunk[:, 1:]
+        # the targets the previous window already scored
+        skipped = torch.from_numpy(skip[start : start + batch_size])
+        Y = Y.masked_fill(positions < skipped[:, None], -1)
+        X, Y = X.to(device), Y.to(device)
+        for k, model in enumerate(models):
+            with torch.no_grad(), ctx:
+                logprobs = model.target_logprobs(X, Y)
+            nll[k] -= logprobs.double().sum().item()
+        scored = Y[Y != -1].cpu().numpy()
+        n_tokens += len(scored)
+        if lengths is not None:
+            n_units += int(lengths[scored].sum())
+        if b % 100 == 99:
+            rate = n_tokens / (time.time() - t0)
+            print(f"{n_tokens}/{len(data) - 1} tokens, {rate:.0f} tokens/s")
+    return nll, n_tokens, n_units
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("models", nargs="+", help="ckpt.pt files, out dirs, gpt2*")
+    parser.add_argument("--data", type=str, required=True, help="uint16 .bin file")
+    parser.add_argument("--meta", type=str, default=None, help="default: data's dir")
+    parser.add_argument("--block_size", type=int, default=0, help="0: the models'")
+    parser.add_argument("--stride", type=int, default=0, help="0: block_size // 2")
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--max_tokens", type=float, default=0, help="0: all of it")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--dtype", type=str, default="float32")
+    parser.add_argument("--out", type=str, default=None, help="results as JSON")
+    args = parser.parse_args()
+
+    meta_path = args.meta or os.path.join(os.path.dirname(args.data), "meta.pkl")
+    models = [load_model(m, meta_path).to(args.device).eval() for m in args.models]
+    # the windows are shared, so they must fit every model
+    block_size = args.block_size or min(m.config.block_size for m in models)
+    assert all(block_size <= m.config.block_size for m in models)
+    stride = args.stride or block_size // 2
+    vocab_size = max(m.config.vocab_size for m in models)
+    lengths, unit = token_lengths(meta_path, vocab_size)
+
+    data = np.memmap(args.data, dtype=np.uint16, mode="r")
+    if args.max_tokens:
+        data = data[: int(args.max_tokens)]
+    print(
+        f"{len(data)} tokens, windows of {block_size} (stride {stride}), "
+        f"{len(models)} model(s)"
+    )
+
+    device_type = "cuda" if "cuda" in args.device else "cpu"
+    ptdtype = getattr(torch, args.dtype)
+    ctx = (
+        nullcontext()
+        if ptdtype == torch.float32
+        else torch.amp.autocast(device_type=device_type, dtype=ptdtype)
+    )
+    nll, n_tokens, n_units = evaluate(
+        models, data, block_size, stride, args.batch_size, args.device, ctx, lengths
+    )
+
+    results = []
+    for name, total in zip(args.models, nll):
+        mean = total / n_tokens
+        result = {
+            "model": name,
+            "tokens": n_tokens,
+            "nll_per_token": mean,
+            "perplexity": math.exp(mean),
+            "bits_per_token": mean / math.log(2),
+        }
+        if lengths is not None:
+            result[f"bits_per_{unit}"] = total / math.log(2) / n_units
+        results.append(result)
+        print(
+            f"{name}: nll {mean:.4f}, ppl {math.exp(mean):.3f}, "
+            f"{mean / math.log(2):.4f} bits/token"
+            + (f", {result[f'bits_per_{unit}']:.4f} bits/{unit}" if unit else "")
+        )
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(
+                {
+                    "data": args.data,
+                    "block_size": block_size,
+                    "stride": stride,
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+"""
+Background fine-tuning of the serving model on text submitted to /train.
+
+A job appends the text to the user's corpus (accounts.get_user_data_file under
+FINETUNE_DATA_DIR), then a worker thread:
+1. encodes the corpus with the serving vocab into a job dir (train.bin, val.bin)
+2. writes the current serving weights there as a ckpt.pt with a fresh optimizer
+3. runs train.py --init_from=resume on it in a subprocess, on CPU, with a single
+   thread and at the lowest scheduling priority (SCHED_IDLE, falling back to
+   nice 19), so it only ever gets CPU time that inference does not want
+4. loads the result and hands it to on_model, which swaps it in
+
+With an AdapterStore (adapters=), step 3 runs lora.py instead, which fits a
+low-rank adapter of the user's own (continuing their earlier one, if any) with
+the serving weights frozen, and step 4 saves it to the store: each user gets
+their model and everyone else keeps theirs. on_model is not used then.
+
+Jobs wait in a bounded queue and at most max_workers of them run at a time.
+Every status change (pending -> training -> completed/failed, the states of the
+training_sessions table) is passed to on_status.
+"""
+
+import logging
+import os
+import pickle
+import queue
+import re
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+import numpy as np
+import torch
+
+from accounts import get_user_data_file
+from bpe import as_tokenizer
+from lora import Adapter
+from model import GPT, GPTConfig
+
+logger = logging.getLogger("void-z1")
+
+TRAIN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "train.py")
+LORA_SCRIPT = os.path.join(os.path.dirname(TRAIN_SCRIPT), "lora.py")
+
+
+class FinetuneJob:
+
+    def __init__(self, user_id, text, session_id=None):
+        # the id names the job's directory, so it is never the client's
+        self.id = str(uuid.uuid4())
+        self.session_id = session_id  # the client's training_sessions row
+        self.user_id = user_id
+        self.text = text
+        self.status = "pending"
+        self.message = "Waiting for a training worker"
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "session_id": self.session_id,
+            "user_id": self.user_id,
+            "status": self.status,
+            "message": self.message,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+        }
+
+
+def lower_priority():
+    # runs in the child between fork and exec
+    try:
+        os.sched_setscheduler(0, os.SCHED_IDLE, os.sched_param(0))
+    except (AttributeError, OSError):
+        os.nice(19)
+
+
+class FinetuneQueue:
+
+    def __init__(
+        self,
+        data_dir,
+        tokenizer,
+        get_model,
+        on_model,
+        on_status=None,
+        max_workers=1,
+        max_pending=16,
+        iters=50,
+        batch_size=8,
+        learning_rate=1e-4,
+        timeout=3600,
+        adapters=None,
+    ):
+        # with several workers, jobs start from the same weights and the one
+        # finishing last wins; a single worker applies them one after the other
+        self.data_dir = data_dir
+        self.tokenizer = as_tokenizer(tokenizer)  # or a char stoi dict
+        self.get_model = get_model
+        self.on_model = on_model
+        self.on_status = on_status
+        self.iters = iters
+        self.batch_size = batch_size
+        self.learning_rate = learning_rate
+        self.timeout = timeout
+        self.adapters = adapters
+        self.jobs = {}  # job id -> FinetuneJob, of this process' lifetime
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._corpus_lock = threading.Lock()
+        self._submit_lock = threading.Lock()
+        os.makedirs(os.path.join(data_dir, "jobs"), exist_ok=True)
+        for i in range(max_workers):
+            threading.Thread(
+                target=self._worker, name=f"finetune-{i}", daemon=True
+            ).start()
+
+    def corpus_path(self, user_id):
+        # user ids are uuids, but never let one escape the directory
+        name = re.sub(r"[^A-Za-z0-9_-]", "_", str(user_id))
+        return os.path.join(self.data_dir, get_user_data_file(name))
+
+    def submit(self, user_id, text, session_id=None):
+        """Queue a fine-tuning job, returns None if the queue is full."""
+        job = FinetuneJob(user_id, text, session_id)
+        # only submit() puts, so under the lock the queue can't fill up before
+        # the job is in it, and the job is complete before a worker can see it
+        with self._submit_lock:
+            if self._queue.full():
+                return None
+            with self._corpus_lock:
+                with open(self.corpus_path(user_id), "a", encoding="utf-8") as f:
+                    f.write(text.rstrip("\n") + "\n")
+            self.jobs[job.id] = job
+            self._set_status(job, "pending", job.message)
+            self._queue.put_nowait(job)
+        return job
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _set_status(self, job, status, message):
+        job.status, job.message, job.updated_at = status, message, time.time()
+        logger.info(f"Fine-tuning job {job.id}: {status} ({message})")
+        if self.on_status is not None:
+            try:
+                self.on_status(job)
+            except Exception as e:
+                logger.error(f"Reporting status of job {job.id} failed: {e}")
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            self._set_status(job, "training", "Fine-tuning")
+            try:
+                self.run(job)
+                self._set_status(job, "completed", "New weights are being served")
+            except Exception as e:
+                logger.error(f"Fine-tuning job {job.id} failed: {e}", exc_info=True)
+                self._set_status(job, "failed", str(e))
+
+    def _prepare(self, job, job_dir, model):
+        block_size = model.config.block_size
+        with self._corpus_lock:
+            with open(self.corpus_path(job.user_id), encoding="utf-8") as f:
+                text = f.read()
+        ids = np.array(self.tokenizer.encode(text), dtype=np.uint16)
+        if len(ids) == 0:
+            raise ValueError("no characters of the text are in the vocabulary")
+        # short corpora are repeated to fill at least a few windows
+        min_len = 4 * (block_size + 1)
+        if len(ids) < min_len:
+            ids = np.tile(ids, -(-min_len // len(ids)))
+        n = len(ids)
+        val_len = max(n // 10, 2 * (block_size + 1))
+        train_ids = ids[: n - val_len] if n - val_len > 2 * (block_size + 1) else ids
+        train_ids.tofile(os.path.join(job_dir, "train.bin"))
+        ids[n - val_len :].tofile(os.path.join(job_dir, "val.bin"))
+        with open(os.path.join(job_dir, "meta.pkl"), "wb") as f:
+            pickle.dump({"vocab_size": model.config.vocab_size}, f)
+
+        # the serving weights, as a checkpoint train.py can resume from
+        model_args = model.config.model_args()
+        optimizer = model.configure_optimizers(
+            1e-1, self.learning_rate, (0.9, 0.99), "cpu"
+        )
+        checkpoint = {
+            "model": model.state_dict(),
+            "optimizer": optimizer.state_dict(),  # no moments yet
+            "model_args": model_args,
+            "iter_num": 0,
+            "best_val_loss": 1e9,
+            "config": {},
+        }
+        torch.save(checkpoint, os.path.join(job_dir, "ckpt.pt"))
+        return model_args
+
+    def run(self, job):
+        job_dir = os.path.abspath(os.path.join(self.data_dir, "jobs", job.id))
+        os.makedirs(job_dir, exist_ok=True)
+        model_args = self._prepare(job, job_dir, self.get_model())
+        if self.adapters is not None:
+            self._train_adapter(job, job_dir)
+        else:
+            self._train_model(job_dir, model_args)
+        shutil.rmtree(job_dir)  # failed jobs keep theirs, for the log
+
+    def _run_script(self, cmd, job_dir):
+        env = dict(os.environ, OMP_NUM_THREADS="1", MKL_NUM_THREADS="1")
+        log_path = os.path.join(job_dir, "train.log")
+        with open(log_path, "w") as log:
+            proc = subprocess.run(
+                cmd,
+                cwd=os.path.dirname(TRAIN_SCRIPT),
+                env=env,
+                stdout=log,
+                stderr=subprocess.STDOUT,
+                preexec_fn=lower_priority,
+                timeout=self.timeout,
+            )
+        if proc.returncode != 0:
+            script = os.path.basename(cmd[1])
+            raise RuntimeError(
+                f"{script} exited with {proc.returncode}, see {log_path}"
+            )
+
+    def _train_adapter(self, job, job_dir):
+        out_path = os.path.join(job_dir, "adapter.pt")
+        cmd = [
+            sys.executable,
+            LORA_SCRIPT,
+            f"--ckpt={os.path.join(job_dir, 'ckpt.pt')}",
+            f"--data_dir={job_dir}",
+            f"--out={out_path}",
+            # the user's earlier adapter, if any, is trained further
+            f"--init={self.adapters.path(job.user_id)}",
+            f"--iters={self.iters}",
+            f"--batch_size={self.batch_size}",
+            f"--learning_rate={self.learning_rate}",
+        ]
+        self._run_script(cmd, job_dir)
+        self.adapters.save(job.user_id, Adapter.load(out_path, self.adapters.device))
+
+    def _train_model(self, job_dir, model_args):
+        cmd = [
+            sys.executable,
+            TRAIN_SCRIPT,
+            "--init_from=resume",
+            f"--out_dir={job_dir}",
+            f"--dataset={job_dir}",  # absolute, so data_dir is the job dir
+            "--device=cpu",
+            "--dtype=float32",
+            "--compile=False",
+            "--wandb_log=False",
+            "--timeline=False",
+            "--always_save_checkpoint=True",
+            f"--block_size={model_args['block_size']}",
+            f"--batch_size={self.batch_size}",
+            "--gradient_accumulation_steps=1",
+            "--dropout=0.0",
+            f"--max_iters={self.iters}",
+            f"--lr_decay_iters={self.iters}",
+            f"--warmup_iters={max(1, self.iters // 10)}",
+            f"--learning_rate={self.learning_rate}",
+            f"--min_lr={self.learning_rate / 10}",
+            # evaluate (and so save) only at the start and at the end
+            f"--eval_interval={self.iters}",
+            "--eval_iters=5",
+            f"--log_interval={max(1, self.iters // 5)}",
+        ]
+        self._run_script(cmd, job_dir)
+
+        checkpoint = torch.load(os.path.join(job_dir, "ckpt.pt"), map_location="cpu")
+        if checkpoint["iter_num"] < self.iters:
+            raise RuntimeError(f"train.py stopped at iter {checkpoint['iter_num']}")
+        state_dict = checkpoint["model"]
+        unwanted_prefix = "_orig_mod."
+        for k, v in list(state_dict.items()):
+            if k.startswith(unwanted_prefix):
+                state_dict[k[len(unwanted_prefix) :]] = state_dict.pop(k)
+        model = GPT(GPTConfig(**checkpoint["model_args"]))
+        model.load_state_dict(state_dict)
+        model.eval()
+        self.on_model(model)
@@ -0,0 +1,207 @@
+"""
+Import GPT-2 weights from a local HuggingFace checkpoint file, tensor by tensor.
+
+GPT.from_pretrained builds a transformers GPT2LMHeadModel and a randomly
+initialized GPT and copies one into the other: about three times the model in
+memory at the peak, 19GB for gpt2-xl, and transformers installed. This reads
+the checkpoint file itself instead:
+- model.safetensors: the JSON header gives each tensor's dtype, shape and byte
+  range, and the tensors are views of the mmapped file;
+- pytorch_model.bin: torch.load(mmap=True), which maps the tensor storages of
+  the zip file the same way.
+The GPT is built on the meta device (no memory, no random init), its storage
+is allocated once, and every tensor is copied from the mapped file into its
+parameter, transposing the Conv1D weights of GPT-2 into Linear ones. The peak
+is the model plus the pages of the file the kernel keeps cached, which it can
+drop at any time. lm_head shares the token embedding, as in GPT-2.
+
+n_head is not in the weights: it comes from a config.json next to the file,
+or from the size of the model for the four GPT-2 sizes.
+
+$ python import_gpt2.py ~/gpt2-xl/model.safetensors --out_dir=out-gpt2-xl
+$ python sample.py --init_from=resume --out_dir=out-gpt2-xl
+"""
+
+import argparse
+import json
+import mmap
+import os
+import struct
+import time
+
+import torch
+
+from model import GPT, GPTConfig
+
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+# n_embd -> n_head of gpt2, gpt2-medium, gpt2-large and gpt2-xl
+GPT2_HEADS = {768: 12, 1024: 16, 1280: 20, 1600: 25}
+# GPT-2 uses Conv1D, weight (in, out), where nn.Linear has (out, in)
+TRANSPOSED = (
+    "attn.c_attn.weight",
+    "attn.c_proj.weight",
+    "mlp.c_fc.weight",
+    "mlp.c_proj.weight",
+)
+
+
+def read_safetensors(path):
+    """The tensors of a .safetensors file by name, as views of the mmapped file."""
+    with open(path, "rb") as f:
+        (header_len,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_len))
+        # a private mapping: writable, so torch takes it without copying, but
+        # nothing is ever written back to the file
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    start = 8 + header_len
+    tensors = {}
+    for name, info in header.items():
+        if name == "__metadata__":
+            continue
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        count = (end - begin) // dtype.itemsize
+        flat = torch.frombuffer(buffer, dtype=dtype, count=count, offset=start + begin)
+        tensors[name] = flat.view(info["shape"])
+    return tensors
+
+
+def read_checkpoint(path):
+    """A .safetensors file, a torch .bin file, or the dir of either."""
+    if os.path.isdir(path):
+        for name in ("model.safetensors", "pytorch_model.bin"):
+            if os.path.exists(os.path.join(path, name)):
+                path = os.path.join(path, name)
+                break
+        else:
+            raise FileNotFoundError(
+                f"no model.safetensors or pytorch_model.bin in {path}"
+            )
+    if path.endswith(".safetensors"):
+        return read_safetensors(path), path
+    try:
+        state_dict = torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+    except RuntimeError:
+        # the legacy (pre zip) format cannot be mapped, it's read whole
+        state_dict = torch.load(path, map_location="cpu", weights_only=True)
+    return state_dict, path
+
+
+def gpt2_name(name):
+    """Our name for a tensor of a GPT2Model or GPT2LMHeadModel, None to skip it."""
+    if name.endswith(".attn.bias") or name.endswith(".attn.masked_bias"):
+        return None  # the causal masks, buffers
+    if name == "lm_head.weight":
+        return None  # tied to wte, which is loaded
+    if not name.startswith("transformer."):
+        name = "transformer." + name  # GPT2Model, as in the hub's safetensors
+    return name
+
+
+def read_gpt2(path, n_head=None, dropout=0.0):
+    """
+    The tensors of the GPT-2 checkpoint at path by our names, oriented for our
+    model (lazy views of the file, nothing is read yet), and its GPTConfig.
+    """
+    tensors, path = read_checkpoint(path)
+    named = {}
+    for name, tensor in tensors.items():
+        ours = gpt2_name(name)
+        if ours is not None:
+            named[ours] = tensor.t() if ours.endswith(TRANSPOSED) else tensor
+    wpe = named["transformer.wpe.weight"]
+    n_embd = wpe.size(1)
+    if n_head is None:
+        config_path = os.path.join(os.path.dirname(path), "config.json")
+        if os.path.exists(config_path):
+            with open(config_path) as f:
+                n_head = json.load(f)["n_head"]
+        elif n_embd in GPT2_HEADS:
+            n_head = GPT2_HEADS[n_embd]
+        else:
+            raise ValueError(f"n_head of a {n_embd} wide model? Pass n_head")
+    config = GPTConfig(
+        n_layer=1 + max(int(k.split(".")[2]) for k in named if ".h." in k),
+        n_head=n_head,
+        n_embd=n_embd,
+        block_size=wpe.size(0),
+        vocab_size=named["transformer.wte.weight"].size(0),
+        bias="transformer.ln_f.bias" in named,
+        dropout=dropout,
+    )
+    return named, config
+
+
+def import_gpt2(path, n_head=None, dropout=0.0):
+    """A GPT with the weights of the GPT-2 checkpoint at path."""
+    named, config = read_gpt2(path, n_head, dropout)
+
+    with torch.device("meta"):
+        model = GPT(config)
+    model.to_empty(device="cpu")
+    model.transformer.wte.weight = model.lm_head.weight  # re-tie, to be sure
+    params = dict(model.named_parameters())
+    missing = set(params) - set(named)
+    unexpected = set(named) - set(params)
+    if missing or unexpected:
+        raise ValueError(
+            f"not a GPT-2 checkpoint: missing {sorted(missing)}, "
+            f"unexpected {sorted(unexpected)}"
+        )
+    with torch.no_grad():
+        for name, tensor in named.items():
+            if tensor.shape != params[name].shape:
+                raise ValueError(
+                    f"{name}: {tuple(tensor.shape)} in the checkpoint, "
+                    f"{tuple(params[name].shape)} in the model"
+                )
+            params[name].copy_(tensor)
+        # the causal masks of the slow attention path were allocated, not
+        # computed, on the meta device
+        T = config.block_size
+        for name, buffer in model.named_buffers():
+            if name.endswith("attn.bias"):
+                buffer.copy_(torch.tril(torch.ones(T, T)).view(1, 1, T, T))
+    return model
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("path", help="model.safetensors, pytorch_model.bin or dir")
+    parser.add_argument("--out_dir", type=str, required=True)
+    parser.add_argument("--n_head", type=int, default=None)
+    args = parser.parse_args()
+
+    t0 = time.time()
+    model = import_gpt2(args.path, args.n_head)
+    dt = time.time() - t0
+    model_args = model.config.model_args()
+    optimizer = model.configure_optimizers(1e-1, 6e-4, (0.9, 0.95), "cpu")
+    os.makedirs(args.out_dir, exist_ok=True)
+    out_path = os.path.join(args.out_dir, "ckpt.pt")
+    # for sample.py, eval_ppl.py, and train.py --init_from=resume to fine-tune
+    torch.save(
+        {
+            "model": model.state_dict(),
+            "optimizer": optimizer.state_dict(),  # no moments yet
+            "model_args": model_args,
+            "iter_num": 0,
+            "best_val_loss": 1e9,
+            "config": {},
+        },
+        out_path,
+    )
+    print(f"imported {args.path} in {dt:.1f}s, wrote {out_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,390 @@
+"""
+KV caches, so that decoding a token costs one position of work instead of a
+forward over the whole context: a paged cache for many sequences of different
+lengths (PagedKVCache), and a ring buffer for decoding past block_size
+(RollingKVCache, used by GPT.generate_rolling).
+
+A contiguous cache gives every sequence room for block_size positions, most of
+which a short chat never uses. PagedKVCache's pool is num_blocks blocks of
+`page_size` positions (for every layer), handed out from a free list as
+sequences grow. A sequence's block table maps its positions to blocks, so the
+memory held is its length rounded up to a page, and a pool sized for the
+typical length holds several times more sequences.
+
+fork() gives a new sequence the blocks of an existing one (a shared prompt,
+several samples of one reply): the blocks are reference counted, and a shared
+block is copied only when one of the sequences writes into it (copy on write).
+
+Usage, with GPT.forward(idx, kv=...):
+    cache = PagedKVCache(model.config, num_blocks=512)
+    cache.add_sequence("a")
+    logits, _ = model(prompt_ids, kv=cache.step(["a"], prompt_ids.size(1)))
+    logits, _ = model(next_ids, kv=cache.step(["a"], 1))  # decode
+    cache.free("a")
+generate() does this for a batch of prompts.
+
+$ python kv_cache.py  # memory of paged vs contiguous caches, decode speed
+"""
+
+import torch
+from torch.nn import functional as F
+
+
+class OutOfBlocks(RuntimeError):
+    pass
+
+
+def cache_dtype(device, dtype=torch.float32):
+    """
+    The dtype to keep keys and values in: under autocast the attention runs in
+    the autocast dtype, so the cache is kept in it too (half the memory of a
+    float32 cache, and no conversion of the whole cache at every step).
+    """
+    device_type = torch.device(device).type
+    if torch.is_autocast_enabled(device_type):
+        return torch.get_autocast_dtype(device_type)
+    return dtype
+
+
+class PagedKVCache:
+
+    def __init__(self, config, num_blocks, page_size=16, dtype=None, device="cpu"):
+        self.page_size = page_size
+        self.num_blocks = num_blocks
+        self.max_positions = config.block_size  # of the position embeddings
+        head_size = config.n_embd // config.n_head
+        n_kv_head = config.n_kv_head or config.n_head
+        # (layer, slot, kv head, head_size); block b holds slots
+        # [b * page_size, (b + 1) * page_size) of every layer
+        shape = (config.n_layer, num_blocks * page_size, n_kv_head, head_size)
+        dtype = dtype or cache_dtype(device)  # float32, or the autocast dtype
+        self.k = torch.zeros(shape, dtype=dtype, device=device)
+        self.v = torch.zeros(shape, dtype=dtype, device=device)
+        self.refcount = [0] * num_blocks
+        self.free_blocks = list(range(num_blocks - 1, -1, -1))  # pop() is lowest
+        self.tables = {}  # sequence id -> block ids
+        self.lengths = {}  # sequence id -> positions stored
+
+    @property
+    def bytes_per_block(self):
+        return 2 * self.k[:, : self.page_size].nbytes
+
+    def stats(self):
+        used = self.num_blocks - len(self.free_blocks)
+        return {
+            "sequences": len(self.tables),
+            "blocks_used": used,
+            "blocks_free": len(self.free_blocks),
+            "bytes_used": used * self.bytes_per_block,
+            "positions": sum(self.lengths.values()),
+        }
+
+    def add_sequence(self, seq_id):
+        if seq_id in self.tables:
+            raise ValueError(f"sequence {seq_id!r} already exists")
+        self.tables[seq_id] = []
+        self.lengths[seq_id] = 0
+
+    def fork(self, parent, child):
+        """A new sequence child that continues parent, sharing its blocks."""
+        if child in self.tables:
+            raise ValueError(f"sequence {child!r} already exists")
+        table = self.tables[parent]
+        for block in table:
+            self.refcount[block] += 1
+        self.tables[child] = list(table)
+        self.lengths[child] = self.lengths[parent]
+
+    def free(self, seq_id):
+        for block in self.tables.pop(seq_id):
+            self._release(block)
+        del self.lengths[seq_id]
+
+    def _release(self, block):
+        self.refcount[block] -= 1
+        if self.refcount[block] == 0:
+            self.free_blocks.append(block)
+
+    def _allocate(self):
+        block = self.free_blocks.pop()
+        self.refcount[block] = 1
+        return block
+
+    def _blocks_needed(self, seq_id, n):
+        length, table = self.lengths[seq_id], self.tables[seq_id]
+        if length + n > self.max_positions:
+            raise ValueError(
+                f"sequence {seq_id!r} would have {length + n} positions, "
+                f"the model has {self.max_positions}"
+            )
+        needed = -(-(length + n) // self.page_size) - len(table)
+        # writing into a shared, partially filled last block copies it
+        if n > 0 and length % self.page_size and self.refcount[table[-1]] > 1:
+            needed += 1
+        return needed
+
+    def _reserve(self, seq_id, n):
+        length, table = self.lengths[seq_id], self.tables[seq_id]
+        if n > 0 and length % self.page_size and self.refcount[table[-1]] > 1:
+            old, new = table[-1], self._allocate()
+            p = self.page_size
+            self.k[:, new * p : (new + 1) * p] = self.k[:, old * p : (old + 1) * p]
+            self.v[:, new * p : (new + 1) * p] = self.v[:, old * p : (old + 1) * p]
+            self._release(old)
+            table[-1] = new
+        while len(table) * self.page_size < length + n:
+            table.append(self._allocate())
+        self.lengths[seq_id] = length + n
+        return length
+
+    def step(self, seq_ids, n):
+        """
+        Reserve room for n new positions of each of seq_ids, and return the
+        PagedStep to forward them with (a (len(seq_ids), n) batch of tokens).
+        Raises OutOfBlocks, with nothing reserved, if the pool is too small.
+        """
+        needed = sum(self._blocks_needed(seq_id, n) for seq_id in seq_ids)
+        if needed > len(self.free_blocks):
+            raise OutOfBlocks(
+                f"{needed} blocks needed, {len(self.free_blocks)} are free"
+            )
+        starts = [self._reserve(seq_id, n) for seq_id in seq_ids]
+        tables = [self.tables[seq_id] for seq_id in seq_ids]
+        return PagedStep(self, tables, starts, n)
+
+
+class PagedStep:
+    """The positions, slots and attention mask of one forward over the cache."""
+
+    def __init__(self, cache, tables, starts, n):
+        self.cache = cache
+        device = cache.k.device
+        p = cache.page_size
+        length = max(starts) + n  # keys of the longest sequence
+        width = -(-length // p)
+        # tables padded with block 0, whose slots the mask hides
+        table = torch.tensor(
+            [t[:width] + [0] * (width - len(t[:width])) for t in tables],
+            dtype=torch.long,
+            device=device,
+        )
+        pos = torch.arange(length, device=device)
+        self.read_slots = table[:, pos // p] * p + pos % p  # (B, L)
+        starts = torch.tensor(starts, dtype=torch.long, device=device)
+        self.positions = starts[:, None] + torch.arange(n, device=device)  # (B, n)
+        self.write_slots = self.read_slots.gather(1, self.positions).view(-1)
+        # the query at position i attends to the keys at positions <= i
+        self.mask = (pos[None, None, :] <= self.positions[:, :, None]).unsqueeze(1)
+
+    def layer(self, i):
+        return PagedLayer(self, i)
+
+
+class PagedLayer:
+
+    def __init__(self, step, i):
+        self.step = step
+        self.mask = step.mask  # (B, 1, n, L)
+        self.k = step.cache.k[i]
+        self.v = step.cache.v[i]
+
+    def update(self, k, v):
+        """
+        Store the keys and values (B, nh, n, hs) of the new positions, return
+        those of all the positions (B, nh, L, hs).
+        """
+        B, nh, n, hs = k.shape
+        slots = self.step.write_slots
+        # in the cache's dtype, returned in the dtype of the new keys (as
+        # RollingLayer.update)
+        k = k.transpose(1, 2).reshape(B * n, nh, hs)
+        v = v.transpose(1, 2).reshape(B * n, nh, hs)
+        self.k.index_copy_(0, slots, k.to(self.k.dtype))
+        self.v.index_copy_(0, slots, v.to(self.v.dtype))
+        read = self.step.read_slots
+        return (
+            self.k[read].transpose(1, 2).to(k.dtype),
+            self.v[read].transpose(1, 2).to(v.dtype),
+        )
+
+
+class RollingKVCache:
+    """
+    The keys and values of the last block_size positions of a batch of
+    sequences, in a ring buffer (see GPT.generate_rolling).
+
+    Positions are absolute (learned position embeddings, baked into the keys),
+    so once the ring is full there is no free position for a new token. With
+    clamp=False step() refuses to go past it and the caller re-encodes a
+    shorter window from position 0 (reset()). With clamp=True new tokens take
+    the last position and overwrite the oldest slot: no recomputation ever,
+    but the positions of the tokens in the window are only approximate.
+    """
+
+    def __init__(
+        self, config, batch_size, clamp=False, dtype=torch.float32, device="cpu"
+    ):
+        self.window = config.block_size
+        self.clamp = clamp
+        head_size = config.n_embd // config.n_head
+        n_kv_head = config.n_kv_head or config.n_head
+        shape = (config.n_layer, batch_size, self.window, n_kv_head, head_size)
+        self.k = torch.zeros(shape, dtype=dtype, device=device)
+        self.v = torch.zeros(shape, dtype=dtype, device=device)
+        self.slot_positions = torch.empty(self.window, dtype=torch.long, device=device)
+        self.reset()
+
+    def reset(self):
+        self.length = 0  # positions written since the reset
+        self.slot_positions.fill_(-1)  # -1: empty
+
+    @property
+    def full(self):
+        return self.length >= self.window
+
+    def step(self, n):
+        """The positions, slots and mask to forward n new tokens with."""
+        device = self.k.device
+        W = self.window
+        if self.length + n <= W:
+            self.positions = torch.arange(self.length, self.length + n, device=device)
+            slots = self.positions
+        elif self.clamp and self.full and n == 1:
+            self.positions = torch.tensor([W - 1], device=device)
+            slots = torch.tensor([self.length % W], device=device)  # the oldest
+        else:
+            raise ValueError(
+                f"{n} more positions do not fit the window of {W}, re-encode"
+            )
+        self.slot_positions[slots] = self.positions
+        self.length += n
+        self.write_slots = slots
+        # only the filled slots, in order, until the ring wraps around
+        self.read_length = min(self.length, W)
+        keys = self.slot_positions[: self.read_length]
+        self.mask = (keys >= 0) & (keys[None, :] <= self.positions[:, None])
+        self.mask = self.mask[None, None]  # (1, 1, n, L)
+        self.positions = self.positions[None]  # (1, n), broadcast over the batch
+        return self
+
+    def layer(self, i):
+        return RollingLayer(self, i)
+
+
+class RollingLayer:
+
+    def __init__(self, cache, i):
+        self.cache = cache
+        self.mask = cache.mask
+        self.k = cache.k[i]
+        self.v = cache.v[i]
+
+    def update(self, k, v):
+        slots = self.cache.write_slots
+        # in the cache's dtype, returned in the dtype of the new keys (the
+        # cache may have been made outside the autocast region it runs in)
+        self.k[:, slots] = k.transpose(1, 2).to(self.k.dtype)
+        self.v[:, slots] = v.transpose(1, 2).to(self.v.dtype)
+        L = self.cache.read_length
+        return (
+            self.k[:, :L].transpose(1, 2).to(k.dtype),
+            self.v[:, :L].transpose(1, 2).to(v.dtype),
+        )
+
+
+@torch.no_grad()
+def generate(
+    model, cache, prompts, max_new_tokens, temperature=1.0, top_k=None, num_samples=1
+):
+    """
+    Sample num_samples continuations of max_new_tokens tokens for each prompt
+    (a list of token ids), decoding all of them as one batch. The samples of a
+    prompt share its blocks. Returns, per prompt, the num_samples sequences
+    (prompt + continuation) as lists of ids.
+    """
+    tag = object()  # sequence ids of this call, apart from the caller's
+    rows, last_logits = [], []
+    try:
+        for i, prompt in enumerate(prompts):
+            cache.add_sequence((tag, i))
+            idx = torch.tensor([prompt], dtype=torch.long, device=cache.k.device)
+            logits, _ = model(idx, kv=cache.step([(tag, i)], len(prompt)))
+            for s in range(num_samples):
+                cache.fork((tag, i), (tag, i, s))
+                rows.append((tag, i, s))
+                last_logits.append(logits[0, -1])
+            cache.free((tag, i))
+        logits = torch.stack(last_logits)
+        generated = []
+        for step in range(max_new_tokens):
+            logits = logits / temperature
+            if top_k is not None:
+                v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
+                logits[logits < v[:, [-1]]] = -float("Inf")
+            idx_next = torch.multinomial(F.softmax(logits, dim=-1), num_samples=1)
+            generated.append(idx_next)
+            if step < max_new_tokens - 1:
+                logits, _ = model(idx_next, kv=cache.step(rows, 1))
+                logits = logits[:, -1, :]
+    finally:
+        for seq_id in list(cache.tables):
+            if isinstance(seq_id, tuple) and seq_id[0] is tag:
+                cache.free(seq_id)
+    out = torch.cat(generated, dim=1).tolist() if generated else [[]] * len(rows)
+    result = [[] for _ in prompts]
+    for (_, i, _), continuation in zip(rows, out):
+        result[i].append(list(prompts[i]) + continuation)
+    return result
+
+
+if __name__ == "__main__":
+    import random
+    import time
+
+    from model import GPT, GPTConfig
+
+    torch.manual_seed(0)
+    rng = random.Random(0)
+    config = GPTConfig(
+        block_size=1024, vocab_size=96, n_layer=6, n_head=6, n_embd=384, dropout=0.0
+    )
+    model = GPT(config).eval()
+
+    # memory: 256 chats of typical lengths (median ~200 of the 1024 positions)
+    lengths = [min(1024, int(rng.lognormvariate(5.3, 0.6))) for _ in range(256)]
+    cache = PagedKVCache(config, num_blocks=1, page_size=16)
+    per_position = cache.bytes_per_block / cache.page_size
+    contiguous = len(lengths) * config.block_size * per_position
+    paged = sum(-(-n // 16) * 16 for n in lengths) * per_position
+    print(
+        f"{len(lengths)} sequences, mean length {sum(lengths) / len(lengths):.0f}: "
+        f"contiguous {contiguous / 2**20:.0f}MB, paged {paged / 2**20:.0f}MB "
+        f"({contiguous / paged:.1f}x as many sequences in the same memory)"
+    )
+
+    # decode: 8 prompts of 200 tokens, 64 new tokens each
+    prompts = [[rng.randrange(96) for _ in range(200)] for _ in range(8)]
+    t0 = time.perf_counter()
+    for prompt in prompts:
+        model.generate(torch.tensor([prompt]), 64, top_k=1)
+    dt_full = time.perf_counter() - t0
+    cache = PagedKVCache(config, num_blocks=8 * 17, page_size=16)
+    t0 = time.perf_counter()
+    generate(model, cache, prompts, 64, top_k=1)
+    dt_paged = time.perf_counter() - t0
+    print(
+        f"8 x 64 tokens: GPT.generate {8 * 64 / dt_full:.0f} tok/s, "
+        f"paged batch {8 * 64 / dt_paged:.0f} tok/s"
+    )
+
+    # past the window: a 1000 token chat, 128 new tokens
+    idx = torch.randint(0, 96, (1, 1000))
+    for name, fn in [
+        ("GPT.generate", lambda: model.generate(idx, 128, top_k=1)),
+        ("rolling", lambda: model.generate_rolling(idx, 128, top_k=1)),
+        ("rolling clamp", lambda: model.generate_rolling(idx, 128, top_k=1, shift=0)),
+    ]:
+        t0 = time.perf_counter()
+        with torch.no_grad():
+            fn()
+        print(f"{name:>14}: {128 / (time.perf_counter() - t0):.0f} tok/s")
@@ -0,0 +1,399 @@
+"""
+Low-rank adapters (LoRA, Hu et al. 2021): per-user models on one base model.
+
+An adapter holds, for every c_attn, c_proj and c_fc Linear of the model, a pair
+A (rank, in), B (out, rank) whose product is added to the frozen base weight:
+W x + (alpha / rank) B A x. At rank 8 that is a few percent of the parameters
+of the model, so thousands of users' adapters fit in the memory a handful of
+full copies would take, and all of them run on the one base model.
+
+inject() turns the target Linears of a model into LoRALinear: the same
+parameters and state dict, and the same output until adapters are applied:
+    bank = AdapterBank([alice, bob])
+    with bank.rows([1, 2, 0]):
+        logits, _ = model(idx)  # row 0 with alice's, row 1 with bob's, row 2 base
+Rows of one batch may use different adapters: every LoRALinear gathers each
+row's A and B and adds the low-rank products with two batched matmuls (ranks
+are zero padded to the largest of the bank, which changes nothing). What is
+applied lives in a context variable, so requests in other threads using the
+same model are not affected.
+
+AdapterStore keeps the users' adapters on disk and the most recently used ones
+in memory. The CLI fits an adapter to a train.bin; finetune.py runs it for the
+/train jobs of a FinetuneQueue that has an AdapterStore.
+
+An adapter only means something on the weights it was trained against, so it
+records them (base_of: the model's shape and a hash of its weights). After a
+reload to other weights, AdapterStore.get(user, base) no longer returns the
+adapters of the old ones, and the next /train of their user fits them again.
+
+$ python lora.py --ckpt=job/ckpt.pt --data_dir=job --out=job/adapter.pt
+"""
+
+import argparse
+import contextvars
+import hashlib
+import math
+import os
+import re
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.nn import functional as F
+
+TARGETS = ("c_attn", "c_proj", "c_fc")
+
+# (bank, per-row slot tensor or None, the slot of every row or None)
+_applied = contextvars.ContextVar("lora_applied", default=None)
+
+
+class LoRALinear(nn.Linear):
+    """An nn.Linear that adds the low-rank update of each row's adapter."""
+
+    name = None  # in the model, the key of this layer's adapter weights
+
+    def forward(self, x):
+        y = super().forward(x)
+        applied = _applied.get()
+        if applied is None:
+            return y
+        bank, index, slot = applied
+        if slot == 0 or self.name not in bank.weights:
+            return y
+        A, B = bank.weights[self.name]  # (slots, rank, in), (slots, out, rank)
+        if slot is not None:
+            return y + (x @ A[slot].mT) @ B[slot].mT
+        # (B, T, in) @ (B, in, rank) @ (B, rank, out)
+        return y + (x @ A[index].mT) @ B[index].mT
+
+
+def inject(model, targets=TARGETS):
+    """Make the target Linears of model LoRALinear, in place (no copies)."""
+    for prefix, module in list(model.named_modules()):
+        for name, child in list(module.named_children()):
+            if name in targets and type(child) is nn.Linear:
+                layer = LoRALinear(
+                    child.in_features,
+                    child.out_features,
+                    bias=child.bias is not None,
+                    device="meta",
+                )
+                layer.weight, layer.bias = child.weight, child.bias
+                layer.name = f"{prefix}.{name}" if prefix else name
+                setattr(module, name, layer)
+    return model
+
+
+def base_of(model):
+    """What adapters of model are trained against: its model_args and weights."""
+    h = hashlib.blake2b(digest_size=12)
+    for name, tensor in model.state_dict().items():
+        h.update(name.encode())
+        data = tensor.detach().cpu().contiguous().reshape(-1)
+        h.update(data.view(torch.uint8).numpy())
+    return {"model_args": model.config.model_args(), "version": h.hexdigest()}
+
+
+class Adapter:
+    """The A and B of each LoRALinear of a model, by its name."""
+
+    def __init__(self, weights, rank, alpha, base=None):
+        self.weights = weights
+        self.rank = rank
+        self.alpha = alpha
+        self.base = base  # base_of() the model it was trained on, None: unknown
+        self._bank = None
+
+    @property
+    def scale(self):
+        return self.alpha / self.rank
+
+    @classmethod
+    def new(cls, model, rank=8, alpha=16, base=None):
+        """A fresh adapter for model, B = 0 so that it changes nothing yet."""
+        weights = {}
+        for module in model.modules():
+            if isinstance(module, LoRALinear):
+                A = torch.empty(rank, module.in_features)
+                nn.init.kaiming_uniform_(A, a=math.sqrt(5))
+                B = torch.zeros(module.out_features, rank)
+                weights[module.name] = (A, B)
+        if not weights:
+            raise ValueError("the model has no LoRALinear layers, inject() it")
+        return cls(weights, rank, alpha, base)
+
+    def fits(self, base):
+        """Whether this adapter is for the model of base (a base_of())."""
+        return self.base is not None and self.base == base
+
+    def parameters(self):
+        for A, B in self.weights.values():
+            yield A
+            yield B
+
+    @property
+    def nbytes(self):
+        return sum(t.nbytes for t in self.parameters())
+
+    @property
+    def bank(self):
+        """A bank of this adapter alone (slot 1), built on first use."""
+        if self._bank is None:
+            self._bank = AdapterBank([self])
+        return self._bank
+
+    def state_dict(self):
+        return {
+            "rank": self.rank,
+            "alpha": self.alpha,
+            "base": self.base,
+            "weights": {
+                name: {"A": A.detach(), "B": B.detach()}
+                for name, (A, B) in self.weights.items()
+            },
+        }
+
+    def save(self, path):
+        # written atomically, a reader never sees half an adapter
+        tmp_path = path + ".tmp"
+        torch.save(self.state_dict(), tmp_path)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, device="cpu"):
+        state = torch.load(path, map_location=device, weights_only=True)
+        weights = {
+            name: (w["A"], w["B"]) for name, w in state["weights"].items()
+        }
+        return cls(weights, state["rank"], state["alpha"], state.get("base"))
+
+
+class AdapterBank:
+    """
+    Adapters stacked layer by layer, to apply to the rows of a batch: slot 0 is
+    the base model, slot i + 1 is adapters[i]. The bank holds copies, with the
+    scales folded into B; build a new one after changing an adapter.
+    """
+
+    def __init__(self, adapters):
+        rank = max(adapter.rank for adapter in adapters)
+        self.size = len(adapters)
+        self.weights = {}
+        names = dict.fromkeys(n for adapter in adapters for n in adapter.weights)
+        for name in names:
+            A0, B0 = next(a.weights[name] for a in adapters if name in a.weights)
+            As = [A0.new_zeros(rank, A0.size(1))]
+            Bs = [B0.new_zeros(B0.size(0), rank)]
+            for adapter in adapters:
+                if name not in adapter.weights:
+                    As.append(As[0])
+                    Bs.append(Bs[0])
+                    continue
+                A, B = adapter.weights[name]
+                pad = rank - adapter.rank
+                As.append(F.pad(A, (0, 0, 0, pad)))
+                Bs.append(F.pad(B * adapter.scale, (0, pad)))
+            self.weights[name] = (torch.stack(As), torch.stack(Bs))
+
+    @contextmanager
+    def rows(self, slots):
+        """
+        Apply slot slots[r] to row r of the batches forwarded in the block, or
+        slot `slots` to all of their rows if it is an int.
+        """
+        if isinstance(slots, int):
+            slot, index = slots, None
+        elif len(set(slots)) == 1:
+            slot, index = slots[0], None
+        else:
+            device = next(iter(self.weights.values()))[0].device
+            slot, index = None, torch.tensor(slots, dtype=torch.long, device=device)
+        if slot is not None and not 0 <= slot <= self.size:
+            raise IndexError(f"slot {slot} of a bank of {self.size} adapters")
+        token = _applied.set((self, index, slot))
+        try:
+            yield
+        finally:
+            _applied.reset(token)
+
+
+class AdapterStore:
+    """Users' adapters as files under root, the `capacity` last used in memory."""
+
+    def __init__(self, root, capacity=256, device="cpu"):
+        self.root = root
+        self.capacity = capacity
+        self.device = device
+        self._cache = OrderedDict()  # user id -> Adapter, least recent first
+        self._lock = threading.Lock()
+
+    def path(self, user_id):
+        # user ids are uuids, but never let one escape the directory
+        name = re.sub(r"[^A-Za-z0-9_-]", "_", str(user_id))
+        return os.path.join(self.root, f"{name}.pt")
+
+    def __len__(self):
+        return len(self._cache)
+
+    def in_memory(self, user_id):
+        return user_id in self._cache
+
+    def _put(self, user_id, adapter):
+        with self._lock:
+            self._cache[user_id] = adapter
+            self._cache.move_to_end(user_id)
+            while len(self._cache) > self.capacity:
+                self._cache.popitem(last=False)
+
+    def get(self, user_id, base=None):
+        """
+        The user's adapter, None if they have none, or, if base is given, none
+        for that model (a base_of()): it was trained on other weights, or
+        before adapters recorded theirs.
+        """
+        with self._lock:
+            adapter = self._cache.get(user_id)
+            if adapter is not None:
+                self._cache.move_to_end(user_id)
+        if adapter is None:
+            path = self.path(user_id)
+            if not os.path.exists(path):
+                return None
+            adapter = Adapter.load(path, self.device)
+            self._put(user_id, adapter)
+        if base is not None and not adapter.fits(base):
+            return None
+        return adapter
+
+    def save(self, user_id, adapter):
+        os.makedirs(self.root, exist_ok=True)
+        adapter.save(self.path(user_id))
+        self._put(user_id, adapter)
+
+
+def get_batch(data, block_size, batch_size):
+    ix = torch.randint(len(data) - block_size, (batch_size,)).tolist()
+    windows = torch.stack(
+        [torch.from_numpy(data[i : i + block_size + 1].astype(np.int64)) for i in ix]
+    )
+    return windows[:, :-1].contiguous(), windows[:, 1:].contiguous()
+
+
+def train(model, adapter, data, iters, batch_size, learning_rate, block_size=None):
+    """
+    Fit adapter to random windows of data (uint16 tokens), the model frozen.
+    Returns the training losses.
+    """
+    block_size = block_size or model.config.block_size
+    for p in model.parameters():
+        p.requires_grad_(False)
+    params = list(adapter.parameters())
+    for p in params:
+        p.requires_grad_(True)
+    optimizer = torch.optim.AdamW(params, lr=learning_rate, weight_decay=0.0)
+    losses = []
+    try:
+        for _ in range(iters):
+            x, y = get_batch(data, block_size, batch_size)
+            # the bank's copies are rebuilt from the updated A and B every step
+            with AdapterBank([adapter]).rows(1):
+                _, loss = model(x, y)
+            optimizer.zero_grad(set_to_none=True)
+            loss.backward()
+            optimizer.step()
+            losses.append(loss.item())
+    finally:
+        for p in params:
+            p.requires_grad_(False)
+        adapter._bank = None  # built from the old weights
+    return losses
+
+
+@torch.no_grad()
+def estimate_loss(model, data, eval_iters, batch_size, adapter=None):
+    torch.manual_seed(0)  # the same windows with and without the adapter
+    block_size = model.config.block_size
+    losses = []
+    for _ in range(eval_iters):
+        x, y = get_batch(data, block_size, batch_size)
+        if adapter is None:
+            _, loss = model(x, y)
+        else:
+            with adapter.bank.rows(1):
+                _, loss = model(x, y)
+        losses.append(loss.item())
+    return sum(losses) / len(losses)
+
+
+def main():
+    from model import GPT, GPTConfig
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--ckpt", type=str, required=True, help="the base model")
+    parser.add_argument("--data_dir", type=str, required=True, help="train/val.bin")
+    parser.add_argument("--out", type=str, required=True)
+    parser.add_argument("--init", type=str, default=None, help="adapter to continue")
+    parser.add_argument("--rank", type=int, default=8)
+    parser.add_argument("--alpha", type=float, default=16)
+    parser.add_argument("--iters", type=int, default=50)
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--learning_rate", type=float, default=1e-3)
+    parser.add_argument("--eval_iters", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1337)
+    args = parser.parse_args()
+
+    checkpoint = torch.load(args.ckpt, map_location="cpu")
+    model = GPT(GPTConfig(**dict(checkpoint["model_args"], dropout=0.0)))
+    model.load_state_dict(
+        {k.removeprefix("_orig_mod."): v for k, v in checkpoint["model"].items()}
+    )
+    inject(model.eval())
+    base = base_of(model)
+    adapter = None
+    if args.init and os.path.exists(args.init):
+        adapter = Adapter.load(args.init)
+        # trained further on this model, unless it does not even fit its layers
+        shapes = {
+            m.name: (m.in_features, m.out_features)
+            for m in model.modules()
+            if isinstance(m, LoRALinear)
+        }
+        trained = {n: (A.size(1), B.size(0)) for n, (A, B) in adapter.weights.items()}
+        if shapes != trained:
+            print(f"{args.init} is for another model shape, starting over")
+            adapter = None
+        else:
+            adapter.base = base
+    if adapter is None:
+        torch.manual_seed(args.seed)
+        adapter = Adapter.new(model, args.rank, args.alpha, base)
+    train_data = np.memmap(
+        os.path.join(args.data_dir, "train.bin"), dtype=np.uint16, mode="r"
+    )
+    val_data = np.memmap(
+        os.path.join(args.data_dir, "val.bin"), dtype=np.uint16, mode="r"
+    )
+
+    base_loss = estimate_loss(model, val_data, args.eval_iters, args.batch_size)
+    before = estimate_loss(model, val_data, args.eval_iters, args.batch_size, adapter)
+    torch.manual_seed(args.seed)
+    losses = train(
+        model, adapter, train_data, args.iters, args.batch_size, args.learning_rate
+    )
+    after = estimate_loss(model, val_data, args.eval_iters, args.batch_size, adapter)
+    adapter.save(args.out)
+    n_params = sum(t.numel() for t in adapter.parameters())
+    print(
+        f"rank {adapter.rank}: {n_params} parameters "
+        f"({n_params / sum(p.numel() for p in model.parameters()):.1%} of the "
+        f"model), train loss {losses[-1]:.4f}, val loss {base_loss:.4f} (base) "
+        f"{before:.4f} -> {after:.4f}, wrote {args.out}"
+    )
+
+
+if __name__ == "__main__":
+    main()
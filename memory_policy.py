@@ -0,0 +1,146 @@
+"""
+Memory-pressure driven garbage collection for the API server.
+
+Python's generational GC already runs on its own as objects are allocated, a
+full gc.collect() after every response only adds a stop-the-world pause to
+every request (static files included). MemoryPolicy instead runs a full
+collection (plus torch.cuda.empty_cache() on CUDA) only when
+- the process RSS is above a high watermark (checked at most every
+  check_interval seconds from after_request, and at most one collection per
+  pressure_interval, as RSS may well stay above it), or
+- the server has been idle for idle_seconds since the last request, where a
+  pause costs nobody anything
+and counts the collections and their pause times for the metrics. Collections
+run on a background thread, never in the request that noticed the pressure.
+"""
+
+import gc
+import logging
+import resource
+import threading
+import time
+
+import torch
+
+logger = logging.getLogger("void-z1")
+
+
+def current_rss():
+    """Resident set size of this process in bytes, None if unknown."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def memory_limit():
+    """The cgroup (container) memory limit in bytes, None if there is none."""
+    for path in (
+        "/sys/fs/cgroup/memory.max",  # cgroup v2
+        "/sys/fs/cgroup/memory/memory.limit_in_bytes",  # cgroup v1
+    ):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        # v1 reports "no limit" as a huge number
+        if value != "max" and int(value) < 1 << 60:
+            return int(value)
+    return None
+
+
+class MemoryPolicy:
+
+    def __init__(
+        self,
+        high_watermark=None,
+        idle_seconds=30.0,
+        check_interval=1.0,
+        pressure_interval=30.0,
+    ):
+        self.high_watermark = high_watermark  # bytes, None disables pressure GC
+        self.idle_seconds = idle_seconds
+        self.check_interval = check_interval
+        self.pressure_interval = pressure_interval
+        self.stats = {
+            "collections": {"pressure": 0, "idle": 0},
+            "pause_seconds_total": 0.0,
+            "pause_seconds_max": 0.0,
+            "last_pause_seconds": 0.0,
+            "objects_collected": 0,
+        }
+        self._last_request = time.monotonic()
+        self._last_check = 0.0
+        self._last_pressure = -pressure_interval
+        self._pressure = threading.Event()
+        self._idle_collected = True  # nothing happened yet to clean up
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def collect(self, reason):
+        with self._lock:
+            t0 = time.perf_counter()
+            collected = gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            pause = time.perf_counter() - t0
+            s = self.stats
+            s["collections"][reason] += 1
+            s["pause_seconds_total"] += pause
+            s["pause_seconds_max"] = max(s["pause_seconds_max"], pause)
+            s["last_pause_seconds"] = pause
+            s["objects_collected"] += collected
+        return pause
+
+    def after_request(self):
+        """Cheap per-request hook: notes activity, collects under pressure."""
+        now = time.monotonic()
+        self._last_request = now
+        self._idle_collected = False
+        if self.high_watermark is None:
+            return
+        if now - self._last_check < self.check_interval:
+            return
+        self._last_check = now
+        if now - self._last_pressure < self.pressure_interval:
+            return
+        rss = current_rss()
+        if rss is not None and rss > self.high_watermark:
+            self._last_pressure = now
+            self._pressure.set()
+
+    def _run(self):
+        while True:
+            if self._pressure.wait(self.idle_seconds / 2):
+                self._pressure.clear()
+                pause = self.collect("pressure")
+                logger.info(
+                    f"RSS above the {self.high_watermark / 2**20:.0f}MB watermark, "
+                    f"collected in {pause * 1000:.1f}ms, "
+                    f"RSS now {current_rss() / 2**20:.0f}MB"
+                )
+                continue
+            idle = time.monotonic() - self._last_request
+            if not self._idle_collected and idle >= self.idle_seconds:
+                self._idle_collected = True
+                self.collect("idle")
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name="memory-gc", daemon=True
+        )
+        self._thread.start()
+
+    def snapshot(self):
+        """The stats plus current memory usage, for the metrics."""
+        s = dict(self.stats, collections=dict(self.stats["collections"]))
+        s["rss_bytes"] = current_rss()
+        s["high_watermark_bytes"] = self.high_watermark
+        s["gc_counts"] = gc.get_count()
+        s["gc_frozen_objects"] = gc.get_freeze_count()
+        if torch.cuda.is_available():
+            s["cuda_allocated_bytes"] = torch.cuda.memory_allocated()
+            s["cuda_reserved_bytes"] = torch.cuda.memory_reserved()
+        return s
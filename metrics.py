@@ -0,0 +1,245 @@
+"""
+Prometheus metrics for the API server, in the text exposition format.
+
+Small on purpose, so that instrumenting the hot path costs next to nothing:
+an observation is a lock, a bisect over the bucket bounds and two additions
+(well under a microsecond, python metrics.py measures it). Metrics with labels
+keep one child per label values, get it once with .labels(...) where the values
+are fixed. Counters and gauges can also be computed when scraped, with
+set_function(), e.g. a counter from a running total kept elsewhere.
+
+Every process has its own registry: under gunicorn with several workers each
+worker reports its own numbers, scrape them separately or aggregate by
+instance.
+"""
+
+import bisect
+import math
+import threading
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# seconds, from sub-millisecond steps to requests hitting the 30s time limit
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        value = value.replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        self._function = None
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def labels(self, *values):
+        values = tuple(str(v) for v in values)
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}")
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._child())
+        return child
+
+    def set_function(self, function):
+        """
+        Compute the value when scraped. function returns the value, or for a
+        metric with labels a dict {label values tuple: value}; None skips it.
+        For a counter, the value must only ever go up.
+        """
+        self._function = function
+
+    def _samples(self):
+        """(suffix, label names, label values, value) tuples."""
+        if self._function is None:
+            for values, child in list(self._children.items()):
+                yield "", self.labelnames, values, child.value
+            return
+        try:
+            result = self._function()
+        except Exception:
+            return  # a broken metric must not break the whole scrape
+        if not self.labelnames:
+            result = {(): result}
+        for values, value in (result or {}).items():
+            if value is not None:
+                yield "", self.labelnames, tuple(values), value
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for suffix, names, values, value in self._samples():
+            labels = _format_labels(names, values)
+            lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class _CounterChild:
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1.0):
+        with self._lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    kind = "counter"
+    _child = _CounterChild
+
+    def inc(self, amount=1.0):
+        self._default.inc(amount)
+
+
+class _GaugeChild(_CounterChild):
+
+    def dec(self, amount=1.0):
+        self.inc(-amount)
+
+    def set(self, value):
+        self.value = value
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+    _child = _GaugeChild
+
+    def inc(self, amount=1.0):
+        self._default.inc(amount)
+
+    def dec(self, amount=1.0):
+        self._default.dec(amount)
+
+    def set(self, value):
+        self._default.set(value)
+
+    def get(self):
+        return self._default.value
+
+
+class _HistogramChild:
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.bounds, value)  # le is inclusive
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.bounds = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _child(self):
+        return _HistogramChild(self.bounds)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def _samples(self):
+        names = self.labelnames + ("le",)
+        for values, child in list(self._children.items()):
+            with child._lock:
+                counts, total = list(child.counts), child.sum
+            cumulative = 0
+            for bound, count in zip(self.bounds + (math.inf,), counts):
+                cumulative += count
+                yield "_bucket", names, values + (_format_value(bound),), cumulative
+            yield "_count", self.labelnames, values, cumulative
+            yield "_sum", self.labelnames, values, total
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self._metrics = {}
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        return "\n".join(m.render() for m in self._metrics.values()) + "\n"
+
+
+if __name__ == "__main__":
+    import time
+
+    n = 1000000
+    registry = MetricsRegistry()
+    histogram = registry.histogram("bench_seconds", "Benchmark.")
+    counter = registry.counter("bench_total", "Benchmark.")
+    for name, fn in [
+        ("perf_counter", lambda: time.perf_counter()),
+        ("counter.inc", counter.inc),
+        ("histogram.observe", lambda: histogram.observe(0.003)),
+    ]:
+        t0 = time.perf_counter()
+        for _ in range(n):
+            fn()
+        dt = time.perf_counter() - t0
+        print(f"{name:>18}: {dt / n * 1e9:5.0f} ns")
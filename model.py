@@ -9,12 +9,16 @@ https://github.com/huggingface/transformers/blob/main/src/transformers/models/gp
 
 import inspect
 import math
+import time
 from dataclasses import dataclass
 
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
 
+from kv_cache import RollingKVCache, cache_dtype
+from sampler import strided_windows
+
 
 class LayerNorm(nn.Module):
     """LayerNorm but with an optional bias. PyTorch doesn't support simply bias=False"""
@@ -28,14 +32,73 @@ class LayerNorm(nn.Module):
         return F.layer_norm(input, self.weight.shape, self.weight, self.bias, 1e-5)
 
 
+class ChunkedLMHeadLoss(torch.autograd.Function):
+    """
+    The lm_head projection fused with cross-entropy. Rows are processed in chunks
+    of chunk_size, so only a (chunk_size, vocab_size) slice of the logits ever
+    exists instead of the full (B*T, vocab_size) tensor, which for GPT-2 is
+    usually the single largest activation. The gradients w.r.t. the hidden states
+    and the weight are computed right away while each chunk's logits are at hand,
+    so nothing has to be recomputed and backward is just a rescale.
+    """
+
+    @staticmethod
+    def forward(ctx, x, weight, targets, chunk_size, grad_enabled):
+        # x: (N, C) hidden states, weight: (V, C), targets: (N,) with -1 = ignore
+        # grad_enabled: torch.is_grad_enabled() of the caller, e.g. False in evals
+        N = x.size(0)
+        needs_grad = grad_enabled and any(ctx.needs_input_grad[:2])
+        num_valid = (targets != -1).sum().clamp(min=1)
+        # the softmax is always done in (at least) float32, also under autocast
+        acc_dtype = torch.promote_types(x.dtype, torch.float32)
+        loss = torch.zeros((), dtype=acc_dtype, device=x.device)
+        grad_x = torch.empty_like(x) if needs_grad else None
+        grad_w = torch.zeros_like(weight) if needs_grad else None
+        for start in range(0, N, chunk_size):
+            xc, tc = x[start : start + chunk_size], targets[start : start + chunk_size]
+            logits = (xc @ weight.t()).to(acc_dtype)  # (n, V), the only big buffer
+            lse = torch.logsumexp(logits, dim=-1)
+            valid = (tc != -1).to(acc_dtype)
+            tc = tc.clamp(min=0)
+            target_logits = logits.gather(1, tc[:, None]).squeeze(1)
+            loss += ((lse - target_logits) * valid).sum()
+            if needs_grad:
+                # d(loss)/d(logits) = softmax - onehot(target), in place
+                grad = logits.sub_(lse[:, None]).exp_()
+                grad[torch.arange(grad.size(0), device=grad.device), tc] -= 1.0
+                grad *= valid[:, None]
+                grad = grad.to(x.dtype)
+                grad_x[start : start + chunk_size] = grad @ weight
+                if grad.dtype == grad_w.dtype:
+                    grad_w.addmm_(grad.t(), xc)  # no (V, C) temporary
+                else:
+                    grad_w += grad.t() @ xc  # autocast, mixed dtypes
+        loss /= num_valid
+        if needs_grad:
+            ctx.save_for_backward(grad_x.div_(num_valid), grad_w.div_(num_valid))
+        return loss
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        # scaled in place to not hold two (V, C) buffers, so unlike most ops this
+        # backward cannot be run twice (retain_graph=True)
+        grad_x, grad_w = ctx.saved_tensors
+        return grad_x.mul_(grad_output), grad_w.mul_(grad_output), None, None, None
+
+
 class CausalSelfAttention(nn.Module):
 
     def __init__(self, config):
         super().__init__()
         assert config.n_embd % config.n_head == 0
+        # grouped-query attention: every n_head // n_kv_head query heads share
+        # one key/value head
+        self.n_kv_head = config.n_kv_head or config.n_head
+        assert config.n_head % self.n_kv_head == 0
+        self.kv_dim = self.n_kv_head * (config.n_embd // config.n_head)
         # key, query, value projections for all heads, but in a batch
         self.c_attn = nn.Linear(
-            config.n_embd, 3 * config.n_embd, bias=config.bias
+            config.n_embd, config.n_embd + 2 * self.kv_dim, bias=config.bias
         )
         # output projection
         self.c_proj = nn.Linear(
@@ -49,6 +112,8 @@ class CausalSelfAttention(nn.Module):
         self.dropout = config.dropout
         # flash attention make GPU go brrrrr but support is only in PyTorch >= 2.0
         self.flash = hasattr(torch.nn.functional, "scaled_dot_product_attention")
+        # and it takes fewer key/value heads than query heads from 2.5 on
+        self.flash_gqa = self.flash and torch.__version__ >= "2.5"
         if not self.flash:
             print(
                 "WARNING: using slow attention. Flash Attention requires PyTorch >= 2.0"
@@ -62,21 +127,42 @@ class CausalSelfAttention(nn.Module):
                 ),
             )
 
-    def forward(self, x):
+    def forward(self, x, cache=None):
         (B, T, C) = x.size()
         # batch size, sequence length, embedding dimensionality (n_embd)
         # calculate query, key, values for all heads in batch and move head
         # forward to be the batch dim
-        q, k, v = self.c_attn(x).split(self.n_embd, dim=2)
-        k = k.view(B, T, self.n_head, C // self.n_head).transpose(1, 2)
-        # (B, nh, T, hs)
+        q, k, v = self.c_attn(x).split([self.n_embd, self.kv_dim, self.kv_dim], dim=2)
+        k = k.view(B, T, self.n_kv_head, C // self.n_head).transpose(1, 2)
+        # (B, nkvh, T, hs)
         q = q.view(B, T, self.n_head, C // self.n_head).transpose(1, 2)
         # (B, nh, T, hs)
-        v = v.view(B, T, self.n_head, C // self.n_head).transpose(1, 2)
-        # (B, nh, T, hs)
+        v = v.view(B, T, self.n_kv_head, C // self.n_head).transpose(1, 2)
+        # (B, nkvh, T, hs)
         # causal self-attention; Self-attend:
         # (B, nh, T, hs) x (B, nh, hs, T) -> (B, nh, T, T)
-        if self.flash:
+        if cache is not None:
+            # the new keys and values join those of the earlier positions, the
+            # queries see all of them up to their own position (cache.mask)
+            k, v = cache.update(k, v)
+            # (B, nkvh, L, hs)
+        gqa = {}
+        if self.n_kv_head != self.n_head:
+            if self.flash_gqa:
+                gqa = {"enable_gqa": True}
+            else:
+                k = k.repeat_interleave(self.n_head // self.n_kv_head, dim=1)
+                v = v.repeat_interleave(self.n_head // self.n_kv_head, dim=1)
+        if cache is not None:
+            if self.flash:
+                y = torch.nn.functional.scaled_dot_product_attention(
+                    q, k, v, attn_mask=cache.mask, **gqa
+                )
+            else:
+                att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
+                att = att.masked_fill(~cache.mask, float("-inf"))
+                y = F.softmax(att, dim=-1) @ v
+        elif self.flash:
             # efficient attention using Flash Attention CUDA kernels
             y = torch.nn.functional.scaled_dot_product_attention(
                 q,
@@ -85,6 +171,7 @@ class CausalSelfAttention(nn.Module):
                 attn_mask=None,
                 dropout_p=self.dropout if self.training else 0,
                 is_causal=True,
+                **gqa,
             )
         else:
             # manual implementation of attention
@@ -128,8 +215,8 @@ class Block(nn.Module):
         self.ln_2 = LayerNorm(config.n_embd, bias=config.bias)
         self.mlp = MLP(config)
 
-    def forward(self, x):
-        x = x + self.attn(self.ln_1(x))
+    def forward(self, x, cache=None):
+        x = x + self.attn(self.ln_1(x), cache)
         x = x + self.mlp(self.ln_2(x))
         return x
 
@@ -142,12 +229,37 @@ class GPTConfig:
     )
     n_layer: int = 12
     n_head: int = 12
+    n_kv_head: int = (
+        0  # key/value heads: 0 (= n_head) is multi-head attention, 1 multi-query,
+        # in between grouped-query attention. Must divide n_head
+    )
     n_embd: int = 768
     dropout: float = 0.0
     bias: bool = (
         True  # True: bias in Linears and LayerNorms, like GPT-2.
         # False: a bit better and faster
     )
+    loss_chunk_size: int = (
+        0  # > 0: compute the training loss with the fused, chunked lm_head
+        # (ChunkedLMHeadLoss) over this many rows at a time. forward then
+        # returns logits=None whenever targets are given
+    )
+
+    def model_args(self):
+        """The fields that define the weights, saved as a checkpoint's model_args."""
+        return {k: getattr(self, k) for k in MODEL_ARGS}
+
+
+# keep in sync with the fields of GPTConfig that change the weights' shapes
+MODEL_ARGS = (
+    "n_layer",
+    "n_head",
+    "n_kv_head",
+    "n_embd",
+    "block_size",
+    "bias",
+    "vocab_size",
+)
 
 
 class GPT(nn.Module):
@@ -203,24 +315,45 @@ class GPT(nn.Module):
         elif isinstance(module, nn.Embedding):
             torch.nn.init.normal_(module.weight, mean=0.0, std=0.02)
 
-    def forward(self, idx, targets=None):
+    def hidden_states(self, idx, kv=None):
+        """
+        The trunk: final ln_f hidden states of shape (b, t, n_embd).
+        With a kv cache step (see kv_cache.py), idx are new tokens that follow
+        the ones already cached, at the positions kv.positions (b, t).
+        """
         device = idx.device
         b, t = idx.size()
-        assert (
-            t <= self.config.block_size
-        ), (
-            f"Cannot forward sequence of length {t}, "
-            f"block size is only {self.config.block_size}"
-        )
-        pos = torch.arange(0, t, dtype=torch.long, device=device)  # shape (t)
+        if kv is None:
+            assert (
+                t <= self.config.block_size
+            ), (
+                f"Cannot forward sequence of length {t}, "
+                f"block size is only {self.config.block_size}"
+            )
+            pos = torch.arange(0, t, dtype=torch.long, device=device)  # shape (t)
+        else:
+            pos = kv.positions  # shape (b, t)
         # forward the GPT model itself
         tok_emb = self.transformer.wte(idx)  # token embeddings of shape (b, t, n_embd)
-        pos_emb = self.transformer.wpe(pos)  # position embeddings of shape (t, n_embd)
+        pos_emb = self.transformer.wpe(pos)  # position embeddings, (t or b, t, n_embd)
         x = self.transformer.drop(tok_emb + pos_emb)
-        for block in self.transformer.h:
-            x = block(x)
-        x = self.transformer.ln_f(x)
-        if targets is not None:
+        for i, block in enumerate(self.transformer.h):
+            x = block(x, None if kv is None else kv.layer(i))
+        return self.transformer.ln_f(x)
+
+    def forward(self, idx, targets=None, kv=None):
+        x = self.hidden_states(idx, kv)
+        if targets is not None and self.config.loss_chunk_size > 0:
+            # fused lm_head + cross-entropy, the full logits are never materialized
+            logits = None
+            loss = ChunkedLMHeadLoss.apply(
+                x.view(-1, x.size(-1)),
+                self.lm_head.weight,
+                targets.view(-1),
+                self.config.loss_chunk_size,
+                torch.is_grad_enabled(),
+            )
+        elif targets is not None:
             # if we are given some desired targets also calculate the loss
             logits = self.lm_head(x)
             loss = F.cross_entropy(
@@ -362,9 +495,9 @@ class GPT(nn.Module):
 
         return optimizer
 
-    def estimate_mfu(self, fwdbwd_per_iter, dt):
-        """estimate model flops utilization (MFU) in units of A100 bfloat16 peak
-        FLOPS"""
+    def estimate_mfu(self, fwdbwd_per_iter, dt, flops_promised=312e12):
+        """estimate model flops utilization (MFU) in units of flops_promised, the
+        peak FLOPS of the device (default: A100 bfloat16 peak)"""
         # first estimate the number of flops we do per iteration.
         # see PaLM paper Appendix B as ref: https://arxiv.org/abs/2204.02311
         N = self.get_num_params()
@@ -373,21 +506,111 @@ class GPT(nn.Module):
         flops_per_token = 6 * N + 12 * L * H * Q * T
         flops_per_fwdbwd = flops_per_token * T
         flops_per_iter = flops_per_fwdbwd * fwdbwd_per_iter
-        # express our flops throughput as ratio of A100 bfloat16 peak flops
+        # express our flops throughput as ratio of the device's peak flops
         flops_achieved = flops_per_iter * (1.0 / dt)  # per second
-        flops_promised = 312e12  # A100 GPU bfloat16 peak flops is 312 TFLOPS
         mfu = flops_achieved / flops_promised
         return mfu
 
     @torch.no_grad()
-    def generate(self, idx, max_new_tokens, temperature=1.0, top_k=None):
+    def embed(self, idx, lengths=None):
+        """
+        Sentence embeddings from the already loaded weights, no extra parameters:
+        the ln_f hidden states mean-pooled over the first lengths[i] positions of
+        each row of idx (b, t), then L2-normalized. Rows may be right-padded with
+        any token, with causal attention the real positions never see the padding.
+        Returns a (b, n_embd) float tensor. Call model.eval() first.
+        """
+        x = self.hidden_states(idx).float()
+        b, t, _ = x.size()
+        if lengths is None:
+            lengths = torch.full((b,), t, device=idx.device)
+        lengths = torch.as_tensor(lengths, device=idx.device)
+        mask = torch.arange(t, device=idx.device)[None, :] < lengths[:, None]
+        pooled = (x * mask[..., None]).sum(dim=1) / lengths.clamp(min=1)[:, None]
+        return F.normalize(pooled, dim=-1)
+
+    @torch.no_grad()
+    def target_logprobs(self, idx, targets):
+        """
+        The log-probs of the targets (b, t) that are not -1, flattened in row
+        major order. The lm_head only runs over those positions, ~4M logits at
+        a time, so a gpt2 vocab never materializes a (b, t, vocab) tensor.
+        """
+        valid = targets != -1
+        x = self.hidden_states(idx)[valid]
+        y = targets[valid]
+        chunk = max(1, 2**22 // self.config.vocab_size)
+        logprobs = torch.empty(len(y), device=x.device)
+        for c in range(0, len(y), chunk):
+            logits = self.lm_head(x[c : c + chunk]).float()
+            picked = logits.gather(1, y[c : c + chunk, None])[:, 0]
+            logprobs[c : c + chunk] = picked - torch.logsumexp(logits, dim=-1)
+        return logprobs
+
+    @torch.no_grad()
+    def score(self, sequences, batch_size=32, stride=None):
+        """
+        Log-probabilities of token sequences (lists of ids) under the model,
+        without generating. Returns one tensor per sequence with the log-prob of
+        every token given the ones before it (len - 1 values, the first token
+        has no context); its NLL is minus the sum.
+        Sequences longer than block_size + 1 are scored in strided_windows
+        advanced by stride (default block_size // 2): every token once, with
+        at least block_size - stride tokens of context. The windows of all
+        sequences are sorted by length and packed into padded batches, one
+        forward per batch. Make sure to be in model.eval() mode.
+        """
+        block_size = self.config.block_size
+        stride = stride or block_size // 2
+        device = self.lm_head.weight.device
+        # (sequence, offset, targets to skip, length) of every window
+        windows = []
+        for i, seq in enumerate(sequences):
+            n = len(seq)
+            if n > block_size + 1:
+                offsets, skip = strided_windows(n, block_size, stride)
+                windows.extend(
+                    (i, int(o), int(k), block_size) for o, k in zip(offsets, skip)
+                )
+            elif n > 1:
+                windows.append((i, 0, 0, n - 1))
+        windows.sort(key=lambda w: w[3])
+        pieces = [[] for _ in sequences]
+        for start in range(0, len(windows), batch_size):
+            batch = windows[start : start + batch_size]
+            t = batch[-1][3]  # the longest, right padding is causally invisible
+            idx = torch.zeros((len(batch), t), dtype=torch.long)
+            targets = torch.full((len(batch), t), -1, dtype=torch.long)
+            for row, (i, offset, skip, length) in enumerate(batch):
+                seq = torch.as_tensor(sequences[i][offset : offset + length + 1])
+                idx[row, :length] = seq[:-1]
+                targets[row, skip:length] = seq[1 + skip :]
+            logprobs = self.target_logprobs(idx.to(device), targets.to(device))
+            rows = logprobs.cpu().split((targets != -1).sum(dim=1).tolist())
+            for (i, offset, skip, _), row in zip(batch, rows):
+                pieces[i].append((offset + skip, row))
+        return [
+            torch.cat([row for _, row in sorted(p, key=lambda x: x[0])])
+            if p
+            else torch.empty(0)
+            for p in pieces
+        ]
+
+    @torch.no_grad()
+    def generate(self, idx, max_new_tokens, temperature=1.0, top_k=None, timings=None):
         """
         Take a conditioning sequence of indices idx (LongTensor of shape (b,t)) and
         complete the sequence max_new_tokens times, feeding the predictions back
         into the model each time. Most likely you'll want to make sure to be in
         model.eval() mode of operation for this.
+        If a timings dict is given, the seconds of the first step (prefill, the
+        whole prompt) go to timings["prefill"] and those of every later step to
+        the list timings["decode"].
         """
-        for _ in range(max_new_tokens):
+        if timings is not None:
+            timings["decode"] = []
+            t0 = time.perf_counter()
+        for step in range(max_new_tokens):
             # if the sequence context is growing too long we must crop it at block_size
             idx_cond = (
                 idx
@@ -408,4 +631,67 @@ class GPT(nn.Module):
             idx_next = torch.multinomial(probs, num_samples=1)
             # append sampled index to the running sequence and continue
             idx = torch.cat((idx, idx_next), dim=1)
+            if timings is not None:
+                t1 = time.perf_counter()
+                if step == 0:
+                    timings["prefill"] = t1 - t0
+                else:
+                    timings["decode"].append(t1 - t0)
+                t0 = t1
+        return idx
+
+    @torch.no_grad()
+    def generate_rolling(
+        self, idx, max_new_tokens, temperature=1.0, top_k=None, shift=None, timings=None
+    ):
+        """
+        Like generate(), but with a KV cache of the last block_size positions
+        (kv_cache.RollingKVCache), so a step costs the same however long the
+        sequence gets instead of a forward over the whole window.
+        When the window is full, the oldest `shift` tokens (default a quarter
+        of block_size) are dropped and the rest are re-encoded from position
+        0: exact, the model sees between block_size - shift and block_size
+        tokens, and the re-encode is amortized over shift steps. shift=0
+        never re-encodes, new tokens overwrite the oldest ones at the last
+        position instead (constant cost, approximate positions).
+        """
+        block_size = self.config.block_size
+        shift = block_size // 4 if shift is None else shift
+        assert 0 <= shift < block_size
+        cache = RollingKVCache(
+            self.config,
+            idx.size(0),
+            clamp=shift == 0,
+            dtype=cache_dtype(idx.device, self.lm_head.weight.dtype),
+            device=idx.device,
+        )
+        if timings is not None:
+            timings["decode"] = []
+            t0 = time.perf_counter()
+        idx_cond = idx[:, -block_size:]
+        logits, _ = self(idx_cond, kv=cache.step(idx_cond.size(1)))
+        for step in range(max_new_tokens):
+            logits = logits[:, -1, :] / temperature
+            if top_k is not None:
+                v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
+                logits[logits < v[:, [-1]]] = -float("Inf")
+            probs = F.softmax(logits, dim=-1)
+            idx_next = torch.multinomial(probs, num_samples=1)
+            idx = torch.cat((idx, idx_next), dim=1)
+            if timings is not None:
+                t1 = time.perf_counter()
+                if step == 0:
+                    timings["prefill"] = t1 - t0
+                else:
+                    timings["decode"].append(t1 - t0)
+                t0 = t1
+            if step == max_new_tokens - 1:
+                break
+            if cache.full and shift > 0:
+                # slide the window: re-encode its newest tokens from position 0
+                cache.reset()
+                idx_cond = idx[:, -(block_size - shift) :]
+                logits, _ = self(idx_cond, kv=cache.step(idx_cond.size(1)))
+            else:
+                logits, _ = self(idx_next, kv=cache.step(1))
         return idx
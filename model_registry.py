@@ -0,0 +1,138 @@
+"""
+Hot reloading of the serving model.
+
+ModelRegistry.current is the ModelVersion (model + vocab + version id) that new
+requests are served with. A new checkpoint is loaded and warmed up off the
+request path, then published with a single reference assignment: requests that
+already took a reference to the old version finish on it, and its weights are
+freed when the last of them is done. If loading or warmup fails, the current
+version simply stays.
+
+The version id is a hash of the weights file, so it identifies the weights
+across restarts and reloading an unchanged file is a no-op.
+"""
+
+import hashlib
+import logging
+import os
+import threading
+import time
+import weakref
+
+logger = logging.getLogger("void-z1")
+
+
+def file_version(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()[:12]
+
+
+class ModelVersion:
+
+    def __init__(
+        self, model, stoi, itos, version, path=None, tokenizer=None, adapter_base=None
+    ):
+        self.model = model
+        self.stoi = stoi
+        self.itos = itos
+        self.tokenizer = tokenizer  # a bpe.Tokenizer, encodes and decodes text
+        self.adapter_base = adapter_base  # lora.base_of(model), for users' adapters
+        self.version = version
+        self.path = path
+        self.loaded_at = time.time()
+
+    def info(self):
+        return {
+            "version": self.version,
+            "path": self.path,
+            "loaded_at": self.loaded_at,
+        }
+
+
+class ModelRegistry:
+
+    def __init__(self, loader, warmup=None, on_publish=None):
+        self.loader = loader  # (path, version) -> ModelVersion
+        self.warmup = warmup  # ModelVersion -> None, run before publishing
+        self.on_publish = on_publish  # ModelVersion -> None, run after
+        self.current = None
+        self.last_error = None
+        self._load_lock = threading.Lock()  # one load at a time
+        self._watcher = None
+
+    def load(self, path):
+        """
+        Load, warm up and publish the checkpoint at path. Returns the version
+        served afterwards, which is the old one if the load failed.
+        """
+        with self._load_lock:
+            try:
+                version = file_version(path)
+                if self.current is not None and self.current.version == version:
+                    return self.current
+                t0 = time.perf_counter()
+                candidate = self.loader(path, version)
+                if self.warmup is not None:
+                    self.warmup(candidate)
+            except Exception as e:
+                self.last_error = f"{type(e).__name__}: {e}"
+                logger.error(f"Loading model from {path} failed: {e}", exc_info=True)
+                return self.current
+            self.last_error = None
+            self.publish(candidate)
+            logger.info(
+                f"Serving model version {version} from {path} "
+                f"(loaded and warmed up in {time.perf_counter() - t0:.2f}s)"
+            )
+            return candidate
+
+    def load_async(self, path):
+        thread = threading.Thread(
+            target=self.load, args=(path,), name="model-load", daemon=True
+        )
+        thread.start()
+        return thread
+
+    def publish(self, candidate):
+        old, self.current = self.current, candidate
+        if self.on_publish is not None:
+            try:
+                self.on_publish(candidate)
+            except Exception as e:
+                logger.error(f"Publishing version {candidate.version}: {e}")
+        if old is not None:
+            weakref.finalize(
+                old.model, logger.info, f"Freed model version {old.version}"
+            )
+
+    def watch(self, path, interval=5.0):
+        """Reload path in the background whenever the file changes."""
+
+        def run():
+            last = seen = None
+            while True:
+                time.sleep(interval)
+                try:
+                    st = os.stat(path)
+                    sig = (st.st_mtime_ns, st.st_size)
+                except OSError:
+                    continue
+                # reload once the file has stopped changing for an interval,
+                # not halfway through a copy
+                if sig == seen and sig != last:
+                    last = sig
+                    self.load(path)
+                seen = sig
+
+        self._watcher = threading.Thread(target=run, name="model-watch", daemon=True)
+        self._watcher.start()
+
+    def info(self):
+        current = self.current
+        return {
+            "current": current.info() if current is not None else None,
+            "last_error": self.last_error,
+        }
@@ -0,0 +1,257 @@
+"""
+Layer-by-layer weight paging: run a GPT whose blocks do not fit in memory.
+
+write_layout() stores a model's weights as one file, weights.bin, plus a
+layout.json index: the embeddings and final LayerNorm first, then every Block
+as one contiguous, page aligned region. It streams: tensors are read from the
+source (a GPT-2 checkpoint through import_gpt2.read_gpt2, or a train.py
+checkpoint loaded with mmap) and written one at a time, so gpt2-xl converts on
+a machine that could not hold it.
+
+load_paged() builds the GPT with only the embeddings and ln_f in memory and
+the Blocks' parameters as placeholders. A forward pre-hook on Block i swaps its
+weights in, copied out of the mmapped file in one read of its region, and a
+forward hook swaps them out again (and tells the kernel the mapped pages are
+no longer needed). Meanwhile a background thread reads Block i + 1, so its I/O
+overlaps Block i's compute, and after the last Block it reads the first one
+for the next forward. The Blocks take two buffers of the largest one's size,
+allocated once: the one computing, and the one being read.
+
+Every forward reads the whole model once, whatever the batch: page with large
+batches (batch_infer.py's, which loads layouts through eval_ppl.load_model),
+where the read is amortized over many rows. A paged model is for one forward
+at a time, in one thread.
+
+$ python paging.py ~/gpt2-xl/model.safetensors out-gpt2-xl-paged
+$ python batch_infer.py in.jsonl out.jsonl --model=out-gpt2-xl-paged --vocab=""
+"""
+
+import argparse
+import json
+import mmap
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+import torch.nn as nn
+
+from model import GPT, GPTConfig
+
+# regions start on a page (of any size up to 64K), so that each can be advised
+# on its own
+ALIGN = 1 << 16
+
+
+def _align(offset):
+    return -(-offset // ALIGN) * ALIGN
+
+
+def write_layout(named, config, out_dir, dtype=None):
+    """
+    Write the tensors of named (our names -> tensors, which may be lazy views
+    of a mapped file) as a layout for load_paged, converted to dtype if given.
+    """
+    dtype = dtype or next(iter(named.values())).dtype
+    itemsize = dtype.itemsize
+    resident, layers = {}, [{"tensors": {}} for _ in range(config.n_layer)]
+    offset = 0
+    for name, tensor in named.items():
+        if not name.startswith("transformer.h."):
+            resident[name] = [offset, list(tensor.shape)]
+            offset += tensor.numel() * itemsize
+    for i, layer in enumerate(layers):
+        offset = layer["offset"] = _align(offset)
+        prefix = f"transformer.h.{i}."
+        for name, tensor in named.items():
+            if name.startswith(prefix):
+                relative = offset - layer["offset"]
+                layer["tensors"][name[len(prefix) :]] = [relative, list(tensor.shape)]
+                offset += tensor.numel() * itemsize
+        layer["nbytes"] = offset - layer["offset"]
+
+    os.makedirs(out_dir, exist_ok=True)
+    offsets = {name: entry[0] for name, entry in resident.items()}
+    for i, layer in enumerate(layers):
+        for name, (relative, _) in layer["tensors"].items():
+            offsets[f"transformer.h.{i}.{name}"] = layer["offset"] + relative
+    with open(os.path.join(out_dir, "weights.bin"), "wb") as f:
+        f.truncate(offset)
+        for name, tensor in named.items():
+            # one tensor in memory at a time
+            data = tensor.detach().to(dtype).contiguous()
+            f.seek(offsets[name])
+            f.write(data.view(torch.uint8).numpy().data)
+    layout = {
+        "model_args": config.model_args(),
+        "dtype": str(dtype).removeprefix("torch."),
+        "resident": resident,
+        "layers": layers,
+    }
+    with open(os.path.join(out_dir, "layout.json"), "w") as f:
+        json.dump(layout, f)
+
+
+def read_source(path, n_head=None):
+    """(named tensors, config) of a train.py checkpoint or a GPT-2 checkpoint."""
+    if path.endswith(".pt") or os.path.exists(os.path.join(path, "ckpt.pt")):
+        if os.path.isdir(path):
+            path = os.path.join(path, "ckpt.pt")
+        checkpoint = torch.load(path, map_location="cpu", mmap=True)
+        named = {
+            k.removeprefix("_orig_mod."): v for k, v in checkpoint["model"].items()
+        }
+        named.pop("lm_head.weight", None)  # tied to wte
+        named = {k: v for k, v in named.items() if not k.endswith(".attn.bias")}
+        config = GPTConfig(**dict(checkpoint["model_args"], dropout=0.0))
+        return named, config
+    from import_gpt2 import read_gpt2
+
+    return read_gpt2(path, n_head)
+
+
+def _placeholder(shape, dtype):
+    # the right shape for everything that inspects parameters, but one element
+    # of memory (a stride 0 view), and on the CPU, so model.to("cpu") works
+    return nn.Parameter(
+        torch.empty(1, dtype=dtype).expand(shape), requires_grad=False
+    )
+
+
+class LayerPager:
+    """Swaps the Blocks of model in and out of memory around their forwards."""
+
+    def __init__(self, model, out_dir, layout, prefetch=True):
+        self.dtype = getattr(torch, layout["dtype"])
+        self.layers = layout["layers"]
+        with open(os.path.join(out_dir, "weights.bin"), "rb") as f:
+            # private: writable, so torch maps it without copying, never written
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        self.file = torch.frombuffer(self.buffer, dtype=torch.uint8)
+        self.blocks = model.transformer.h
+        self.block_size = model.config.block_size
+        self.executor = ThreadPoolExecutor(1, "pager") if prefetch else None
+        self.pending = None  # (layer, Future of its tensors), being read
+        # two buffers taken in turns: the layer computing has one, the layer
+        # being read the other. Allocated once, so the memory of the Blocks
+        # is bounded by them (freed per-layer copies tend to stay with malloc)
+        largest = max(layer["nbytes"] for layer in self.layers)
+        self.slots = [torch.empty(largest, dtype=torch.uint8) for _ in range(2)]
+        self.turn = 0
+        self.lock = threading.Lock()
+        self.stats = {"layers_read": 0, "bytes_read": 0, "wait_seconds": 0.0}
+        for i, block in enumerate(self.blocks):
+            self._swap_out(i)
+            block.register_forward_pre_hook(lambda m, args, i=i: self._before(i))
+            block.register_forward_hook(lambda m, args, out, i=i: self._after(i))
+
+    def read(self, i, slot):
+        """Block i's tensors by name, copied out of the file in one read."""
+        layer = self.layers[i]
+        start, nbytes = layer["offset"], layer["nbytes"]
+        region = self.slots[slot][:nbytes]
+        region.copy_(self.file[start : start + nbytes])
+        tensors = {}
+        for name, (relative, shape) in layer["tensors"].items():
+            n = self.dtype.itemsize * torch.Size(shape).numel()
+            tensors[name] = region[relative : relative + n].view(self.dtype).view(shape)
+        # the copy is made, the mapped pages can go
+        length = min(_align(nbytes), len(self.buffer) - start)
+        self.buffer.madvise(mmap.MADV_DONTNEED, start, length)
+        with self.lock:
+            self.stats["layers_read"] += 1
+            self.stats["bytes_read"] += nbytes
+        return tensors
+
+    def _install(self, i, tensors):
+        block = self.blocks[i]
+        for name, tensor in tensors.items():
+            module_name, _, leaf = name.rpartition(".")
+            module = block.get_submodule(module_name)
+            module._parameters[leaf] = nn.Parameter(tensor, requires_grad=False)
+        attn = block.attn
+        if isinstance(getattr(attn, "bias", None), torch.Tensor) and attn.bias.is_meta:
+            # the slow attention path's mask, a buffer not in the layout
+            T = self.block_size
+            attn.bias = torch.tril(torch.ones(T, T)).view(1, 1, T, T)
+
+    def _swap_out(self, i):
+        tensors = {
+            name: _placeholder(shape, self.dtype)
+            for name, (_, shape) in self.layers[i]["tensors"].items()
+        }
+        self._install(i, tensors)
+
+    def _next_slot(self):
+        self.turn ^= 1
+        return self.turn
+
+    def _before(self, i):
+        t0 = time.perf_counter()
+        tensors = None
+        if self.pending is not None:
+            # another layer's read (left by a forward that raised) is waited
+            # for and discarded: the next read reuses the slot it writes into
+            j, future = self.pending
+            self.pending = None
+            tensors = future.result()
+            if j != i:
+                tensors = None
+        if tensors is None:
+            tensors = self.read(i, self._next_slot())
+        self.stats["wait_seconds"] += time.perf_counter() - t0
+        self._install(i, tensors)
+        if self.executor is not None:
+            # the next Block, or the first one of the next forward
+            j = (i + 1) % len(self.blocks)
+            future = self.executor.submit(self.read, j, self._next_slot())
+            self.pending = (j, future)
+
+    def _after(self, i):
+        self._swap_out(i)
+
+
+def load_paged(out_dir, prefetch=True):
+    """A GPT of the layout in out_dir, its Blocks paged in by a LayerPager."""
+    with open(os.path.join(out_dir, "layout.json")) as f:
+        layout = json.load(f)
+    config = GPTConfig(**dict(layout["model_args"], dropout=0.0))
+    dtype = getattr(torch, layout["dtype"])
+    with torch.device("meta"):
+        model = GPT(config)
+    # the resident weights, read once
+    with open(os.path.join(out_dir, "weights.bin"), "rb") as f:
+        for name, (offset, shape) in layout["resident"].items():
+            f.seek(offset)
+            tensor = torch.empty(shape, dtype=dtype)
+            f.readinto(tensor.view(torch.uint8).numpy().data)
+            module_name, _, leaf = name.rpartition(".")
+            module = model.get_submodule(module_name)
+            module._parameters[leaf] = nn.Parameter(tensor, requires_grad=False)
+    model.lm_head.weight = model.transformer.wte.weight
+    model.pager = LayerPager(model, out_dir, layout, prefetch)
+    return model.eval()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("source", help="train.py ckpt/out dir or GPT-2 checkpoint")
+    parser.add_argument("out_dir")
+    parser.add_argument("--dtype", type=str, default=None, help="default: source's")
+    parser.add_argument("--n_head", type=int, default=None)
+    args = parser.parse_args()
+
+    t0 = time.time()
+    named, config = read_source(args.source, args.n_head)
+    dtype = getattr(torch, args.dtype) if args.dtype else None
+    write_layout(named, config, args.out_dir, dtype)
+    size = os.path.getsize(os.path.join(args.out_dir, "weights.bin"))
+    print(
+        f"{config.n_layer} layers, {size / 2**20:.0f}MB, "
+        f"wrote {args.out_dir} in {time.time() - t0:.1f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
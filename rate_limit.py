@@ -0,0 +1,213 @@
+"""
+Token bucket rate limiting with bounded memory.
+
+Every client has a bucket of `capacity` tokens that refills at capacity / window
+tokens per second; a request takes one token or is rejected. A bucket that has
+been idle for a whole window is full again, i.e. the same as no bucket at all,
+so state only needs to be kept for clients seen within the last window.
+
+Two backends with the same allow() interface:
+- LocalLimiter: an LRU OrderedDict of buckets for one process. Buckets idle for
+  a window expire, and at most max_keys are kept (least recently used first out)
+- SharedLimiter: a fixed size hash table in a memory-mapped file (/dev/shm by
+  default) that all gunicorn workers on the host open, so they enforce a single
+  limit. Keys hash into groups of slots; a new key takes an empty or expired
+  slot of its group, or else evicts the least recently used one. Groups are
+  guarded by striped fcntl byte-range locks, so workers rarely contend. The
+  first process sizes the file from its max_keys; later ones use the file as
+  it is (resizing it would crash the others with SIGBUS).
+
+$ python rate_limit.py  # per-request overhead benchmark
+"""
+
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger("void-z1")
+
+
+class LocalLimiter:
+
+    def __init__(self, capacity, window, max_keys=100000):
+        self.capacity = float(capacity)
+        self.rate = capacity / window  # tokens per second
+        self.window = window
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> [tokens, last], oldest first
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def allow(self, key, now=None):
+        """Take a token for key. Returns (allowed, seconds until the next token)."""
+        now = time.time() if now is None else now
+        with self._lock:
+            buckets = self._buckets
+            # least recently used first, so expired buckets are at the front
+            while buckets and now - next(iter(buckets.values()))[1] >= self.window:
+                buckets.popitem(last=False)
+            bucket = buckets.pop(key, None)
+            if bucket is None:
+                bucket = [self.capacity, now]
+            else:
+                elapsed = max(0.0, now - bucket[1])
+                bucket[0] = min(self.capacity, bucket[0] + elapsed * self.rate)
+                bucket[1] = now
+            buckets[key] = bucket
+            if len(buckets) > self.max_keys:
+                buckets.popitem(last=False)
+            if bucket[0] >= 1.0:
+                bucket[0] -= 1.0
+                return True, 0.0
+            return False, (1.0 - bucket[0]) / self.rate
+
+
+SLOT_SIZE = 24  # key hash (uint64, 0 for empty), tokens, last (float64)
+
+
+class SharedLimiter:
+
+    def __init__(
+        self,
+        capacity,
+        window,
+        max_keys=100000,
+        path=None,
+        group_size=8,
+        lock_stripes=64,
+    ):
+        self.capacity = float(capacity)
+        self.rate = capacity / window
+        self.window = window
+        self.group_size = group_size
+        self.num_groups = max(1, -(-max_keys // group_size))
+        self.lock_stripes = lock_stripes
+        if path is None:
+            shm = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+            path = os.path.join(shm, "void-z1-rate-limit")
+        self.path = path
+        size = self.num_groups * group_size * SLOT_SIZE
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            size = self._size_file(size, max_keys)
+        except Exception:
+            os.close(self._fd)
+            raise
+        self._mmap = mmap.mmap(self._fd, size)
+        # slot s is (key, tokens, last) at [3s, 3s+3) of both views; plain
+        # memoryviews are faster than numpy for a handful of scalars
+        self._u64 = memoryview(self._mmap).cast("Q")
+        self._f64 = memoryview(self._mmap).cast("d")
+        # fcntl locks are per process, they don't exclude threads of one worker
+        self._thread_locks = [threading.Lock() for _ in range(lock_stripes)]
+
+    def _size_file(self, size, max_keys):
+        """Size a fresh file, or adopt the size of one in use. Returns it."""
+        path, group_size = self.path, self.group_size
+        # one process at a time sizes a fresh file
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            existing = os.fstat(self._fd).st_size
+            if existing == 0:
+                os.ftruncate(self._fd, size)  # zeros are empty slots
+            elif existing != size:
+                group_bytes = group_size * SLOT_SIZE
+                if existing % group_bytes:
+                    raise ValueError(
+                        f"{path} has {existing} bytes, not groups of {group_size} "
+                        f"slots: another configuration uses it, remove it first"
+                    )
+                # the other processes use it, and must hash keys to the same
+                # groups: take its size rather than our own
+                self.num_groups = existing // group_bytes
+                logger.warning(
+                    f"{path} holds {self.num_groups * group_size} keys, not "
+                    f"max_keys={max_keys}: using it as it is"
+                )
+                size = existing
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return size
+
+    def _hash(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=8).digest()
+        return int.from_bytes(digest, "little") or 1  # 0 marks an empty slot
+
+    def allow(self, key, now=None):
+        """Take a token for key. Returns (allowed, seconds until the next token)."""
+        now = time.time() if now is None else now
+        h = self._hash(key)
+        g = h % self.num_groups
+        stripe = g % self.lock_stripes
+        with self._thread_locks[stripe]:
+            # lock byte `stripe` of the file, beyond the slots' bytes
+            offset = self._mmap.size() + stripe
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, offset)
+            try:
+                u64, f64 = self._u64, self._f64
+                first = 3 * g * self.group_size
+                slots = range(first, first + 3 * self.group_size, 3)
+                for i in slots:
+                    if u64[i] == h:
+                        elapsed = max(0.0, now - f64[i + 2])
+                        tokens = min(self.capacity, f64[i + 1] + elapsed * self.rate)
+                        break
+                else:
+                    # empty slots have last 0, so they are the least recently used
+                    i = min(slots, key=lambda j: f64[j + 2])
+                    tokens = self.capacity
+                allowed = tokens >= 1.0
+                if allowed:
+                    tokens -= 1.0
+                u64[i], f64[i + 1], f64[i + 2] = h, tokens, now
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, offset)
+        return allowed, 0.0 if allowed else (1.0 - tokens) / self.rate
+
+    def close(self):
+        self._u64.release()
+        self._f64.release()
+        self._mmap.close()
+        os.close(self._fd)
+
+
+if __name__ == "__main__":
+    import random
+    from collections import defaultdict
+
+    n, clients = 200000, 50000
+    rng = random.Random(0)
+    ips = [f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}" for i in range(clients)]
+    keys = [ips[rng.randrange(clients)] for _ in range(n)]
+
+    # the previous implementation: sha256 of the ip, an unbounded defaultdict
+    counts = defaultdict(lambda: {"count": 0, "window_start": time.time()})
+
+    def old_allow(key):
+        data = counts[hashlib.sha256(key.encode()).hexdigest()]
+        if time.time() - data["window_start"] > 3600:
+            data["count"], data["window_start"] = 0, time.time()
+        data["count"] += 1
+        return data["count"] <= 100
+
+    path = os.path.join(tempfile.gettempdir(), "void-z1-rate-limit-bench")
+    for name, allow in [
+        ("sha256 + defaultdict", old_allow),
+        ("local LRU", LocalLimiter(100, 3600, max_keys=10000).allow),
+        ("shared mmap", SharedLimiter(100, 3600, max_keys=10000, path=path).allow),
+    ]:
+        t0 = time.perf_counter()
+        for key in keys:
+            allow(key)
+        dt = time.perf_counter() - t0
+        print(f"{name:>22}: {dt / n * 1e6:5.2f} us/request")
+    print(f"{len(counts)} entries in the unbounded dict, the limiters keep <= 10000")
+    os.remove(path)
@@ -6,6 +6,7 @@ import pickle
 from contextlib import nullcontext
 import torch
 import tiktoken
+from bpe import load_vocab
 from model import GPTConfig, GPT
 
 # -----------------------------------------------------------------------------
@@ -86,13 +87,17 @@ if load_meta and meta_path is not None:
     print(f"Loading meta from {meta_path}...")
     with open(meta_path, 'rb') as f:
         meta = pickle.load(f)
-    stoi, itos = meta['stoi'], meta['itos']
+    if 'tokenizer' in meta:  # a BPE tokenizer (bpe.py) next to it
+        tokenizer = load_vocab(meta_path)
+        _encode_fn, _decode_fn = tokenizer.encode, tokenizer.decode
+    else:
+        stoi, itos = meta['stoi'], meta['itos']
 
-    def _encode_fn(s):
-        return [stoi[c] for c in s]
+        def _encode_fn(s):
+            return [stoi[c] for c in s]
 
-    def _decode_fn(indices):
-        return "".join([itos[i] for i in indices])
+        def _decode_fn(indices):
+            return "".join([itos[i] for i in indices])
 else:
     print("No meta.pkl found, assuming GPT-2 encodings...")
     enc = tiktoken.get_encoding("gpt2")
@@ -0,0 +1,160 @@
+"""
+Deterministic, resumable sampling of training windows from a token .bin file.
+
+get_batch in train.py used to draw window offsets with torch.randint, i.e. with
+replacement, so there was no way to tell how much of train.bin a run had seen
+and a resumed run restarted the RNG from scratch. EpochSampler instead visits
+every non-overlapping block_size window exactly once per epoch, in an order that
+is a pure function of (seed, epoch). That makes the position in the stream a
+tiny cursor that can be stored in the checkpoint.
+
+The permutation is block-shuffled so it never has to be materialized: windows
+are grouped into chunks of `shuffle_block`, the chunk order is permuted, and
+each chunk is permuted internally on demand. Memory is O(n_windows /
+shuffle_block + shuffle_block) instead of O(n_windows).
+"""
+
+import numpy as np
+
+
+class EpochSampler:
+    """
+    Yields batches of window offsets into a token stream of length data_len.
+    Each epoch starts at a random phase in [0, block_size) so successive epochs
+    see different window boundaries. The global order is sharded across DDP
+    ranks round-robin; every rank sees the same number of windows per epoch so
+    that all ranks stay in lockstep (the ragged tail is dropped).
+    """
+
+    def __init__(
+        self,
+        data_len,
+        block_size,
+        batch_size,
+        seed=1337,
+        rank=0,
+        world_size=1,
+        shuffle_block=4096,
+    ):
+        # every window needs block_size inputs plus one shifted target
+        assert data_len > block_size + 1, "dataset is smaller than one window"
+        assert 0 <= rank < world_size
+        self.data_len = data_len
+        self.block_size = block_size
+        self.batch_size = batch_size
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.shuffle_block = shuffle_block
+        self.epoch = 0
+        self.cursor = 0  # windows already consumed by this rank in this epoch
+        self._start_epoch()
+
+    def _start_epoch(self):
+        rng = np.random.default_rng([self.seed, self.epoch])
+        max_shift = min(self.block_size, self.data_len - self.block_size)
+        self._shift = int(rng.integers(max_shift))
+        self.num_windows = (self.data_len - 1 - self._shift) // self.block_size
+        self.windows_per_rank = self.num_windows // self.world_size
+        assert self.windows_per_rank > 0, "too few windows for the world size"
+        S = self.shuffle_block
+        num_chunks = -(-self.num_windows // S)
+        sizes = np.full(num_chunks, S, dtype=np.int64)
+        sizes[-1] = self.num_windows - (num_chunks - 1) * S
+        self._chunk_order = rng.permutation(num_chunks)
+        # start of each (permuted) chunk within the epoch's global order
+        self._chunk_starts = np.concatenate(
+            ([0], np.cumsum(sizes[self._chunk_order])[:-1])
+        )
+        self._chunk_sizes = sizes
+        self._cached_chunk = (None, None)
+
+    def _chunk_perm(self, chunk):
+        # only the chunk currently being read is kept around
+        if self._cached_chunk[0] != chunk:
+            rng = np.random.default_rng([self.seed, self.epoch, int(chunk) + 1])
+            self._cached_chunk = (chunk, rng.permutation(self._chunk_sizes[chunk]))
+        return self._cached_chunk[1]
+
+    def _offset(self, position):
+        # position within this epoch's global order -> token offset
+        k = int(np.searchsorted(self._chunk_starts, position, side="right")) - 1
+        chunk = self._chunk_order[k]
+        within = self._chunk_perm(chunk)[position - self._chunk_starts[k]]
+        window = chunk * self.shuffle_block + within
+        return self._shift + int(window) * self.block_size
+
+    def next_batch(self):
+        """Return the next batch_size offsets and advance the cursor."""
+        ix = np.empty(self.batch_size, dtype=np.int64)
+        for b in range(self.batch_size):
+            if self.cursor >= self.windows_per_rank:
+                self.epoch += 1
+                self.cursor = 0
+                self._start_epoch()
+            ix[b] = self._offset(self.cursor * self.world_size + self.rank)
+            self.cursor += 1
+        return ix
+
+    @property
+    def progress(self):
+        """Fractional number of epochs consumed so far, e.g. 1.25."""
+        return self.epoch + self.cursor / self.windows_per_rank
+
+    def state_dict(self):
+        return {
+            "epoch": self.epoch,
+            "cursor": self.cursor,
+            "seed": self.seed,
+            "world_size": self.world_size,
+            "data_len": self.data_len,
+            "block_size": self.block_size,
+            "shuffle_block": self.shuffle_block,
+        }
+
+    def load_state_dict(self, state):
+        same_stream = all(
+            state[k] == getattr(self, k)
+            for k in ["seed", "data_len", "block_size", "shuffle_block"]
+        )
+        self.epoch = state["epoch"]
+        self._start_epoch()
+        if not same_stream:
+            # the permutation no longer matches, the best we can do is keep the
+            # epoch count and start that epoch over
+            print("WARNING: sampler state is for different data, restarting epoch")
+            self.cursor = 0
+            return
+        # the global order is identical for any world size, so a resumed run on a
+        # different number of ranks continues from the same global position
+        consumed = state["cursor"] * state["world_size"]
+        self.cursor = min(consumed // self.world_size, self.windows_per_rank)
+
+
+def fixed_windows(data_len, block_size, num_windows, seed=0):
+    """
+    Offsets of num_windows windows drawn uniformly at random, but identical on
+    every call with the same seed. Used for evals that are comparable over time.
+    """
+    rng = np.random.default_rng(seed)
+    return rng.integers(data_len - block_size, size=num_windows)
+
+
+def strided_windows(data_len, block_size, stride):
+    """
+    Cover a whole token stream with block_size windows advanced by stride, the
+    last one aligned to the end of the stream. Returns (offsets, skip) where the
+    first skip[i] targets of window i were already scored by the previous window
+    and should be masked out, so that every token is scored exactly once and
+    (except at the very start) with at least block_size - stride of context.
+    """
+    assert 0 < stride <= block_size
+    last = data_len - 1 - block_size
+    assert last >= 0, "dataset is smaller than one window"
+    offsets = np.arange(0, last + 1, stride, dtype=np.int64)
+    if offsets[-1] != last:
+        offsets = np.append(offsets, last)
+    # targets of window at offset o cover stream positions o+1 .. o+block_size
+    skip = np.zeros_like(offsets)
+    skip[1:] = offsets[:-1] + block_size - offsets[1:]
+    return offsets, skip
@@ -0,0 +1,151 @@
+"""
+In-memory serving of the built frontend (frontend/dist/public).
+
+The directory is indexed once, at startup: every file is read, hashed for its
+ETag and compressed (gzip, plus brotli if the brotli package is installed) at
+the highest level, since that cost is paid only once. Compressed files the
+build already produced next to the original (app.js.gz, app.js.br) are used as
+they are. A request is then a dict lookup, no filesystem access:
+- the best encoding the client accepts is served, with Vary: Accept-Encoding
+- If-None-Match with a current ETag gets a 304
+- Vite's content-hashed files (assets/index-3f9a1c2b.js) never change under
+  their name, so they are cached for a year as immutable; everything else
+  (index.html, favicons, ...) is revalidated on every use, cheaply via the ETag
+- unknown paths outside assets/ are client-side routes of the SPA and get
+  index.html; a missing assets/ file is a 404, not HTML in place of a script
+"""
+
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+
+from flask import Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Vite names bundles <name>-<hash>.<ext>, the hash being 8+ url-safe chars
+HASHED_NAME = re.compile(r"-[A-Za-z0-9_-]{8,}\.[A-Za-z0-9]+$")
+COMPRESSIBLE = (
+    ".html",
+    ".js",
+    ".mjs",
+    ".css",
+    ".json",
+    ".svg",
+    ".txt",
+    ".map",
+    ".xml",
+    ".ico",
+    ".webmanifest",
+    ".wasm",
+)
+PRECOMPRESSED = {".br": "br", ".gz": "gzip"}
+
+
+class Asset:
+
+    def __init__(self, path, body, variants):
+        self.path = path
+        self.mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        digest = hashlib.blake2b(body, digest_size=12).hexdigest()
+        self.variants = {"identity": (body, f'"{digest}"')}
+        for encoding, data in variants.items():
+            # smaller than the original or not worth it
+            if len(data) < len(body):
+                self.variants[encoding] = (data, f'"{digest}-{encoding}"')
+        self.etags = {etag for _, etag in self.variants.values()}
+        immutable = path.startswith("assets/") and HASHED_NAME.search(path)
+        self.cache_control = (
+            "public, max-age=31536000, immutable" if immutable else "no-cache"
+        )
+
+
+def accepted_encodings(header):
+    """
+    The encodings of an Accept-Encoding header, without the q=0 ones and those
+    with a malformed q, which are not accepted either.
+    """
+    accepted = set()
+    for part in (header or "").split(","):
+        name, _, params = part.strip().partition(";")
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:] or 0) == 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(name.strip().lower())
+    return accepted
+
+
+class StaticAssets:
+
+    def __init__(self, root, index="index.html"):
+        self.root = root
+        self.index = index
+        self.assets = {}
+        if os.path.isdir(root):
+            self._build()
+
+    def _build(self):
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                full = os.path.join(dirpath, filename)
+                path = os.path.relpath(full, self.root).replace(os.sep, "/")
+                if os.path.splitext(path)[1] in PRECOMPRESSED:
+                    if os.path.exists(os.path.splitext(full)[0]):
+                        continue  # a variant, picked up with its original
+                with open(full, "rb") as f:
+                    body = f.read()
+                variants = {}
+                for ext, encoding in PRECOMPRESSED.items():
+                    if os.path.exists(full + ext):
+                        with open(full + ext, "rb") as f:
+                            variants[encoding] = f.read()
+                if path.endswith(COMPRESSIBLE):
+                    if "gzip" not in variants:
+                        variants["gzip"] = gzip.compress(body, 9, mtime=0)
+                    if "br" not in variants and brotli is not None:
+                        variants["br"] = brotli.compress(body, quality=11)
+                self.assets[path] = Asset(path, body, variants)
+
+    def __len__(self):
+        return len(self.assets)
+
+    def response(self, path, headers):
+        """The Response for path, None if there is nothing to serve."""
+        asset = self.assets.get(path)
+        if asset is None:
+            if path.startswith("assets/"):
+                return None
+            asset = self.assets.get(self.index)  # SPA route
+            if asset is None:
+                return None
+        response_headers = {
+            "Cache-Control": asset.cache_control,
+            "Vary": "Accept-Encoding",
+        }
+        accepted = accepted_encodings(headers.get("Accept-Encoding"))
+        for encoding in ("br", "gzip", "identity"):
+            if encoding in asset.variants and (
+                encoding in accepted or encoding == "identity"
+            ):
+                break
+        body, etag = asset.variants[encoding]
+        # the 304 carries the ETag the 200 would have
+        response_headers["ETag"] = etag
+        if_none_match = headers.get("If-None-Match", "")
+        if if_none_match and (
+            if_none_match.strip() == "*"
+            or any(tag.strip() in asset.etags for tag in if_none_match.split(","))
+        ):
+            return Response(status=304, headers=response_headers)
+        if encoding != "identity":
+            response_headers["Content-Encoding"] = encoding
+        return Response(body, mimetype=asset.mimetype, headers=response_headers)
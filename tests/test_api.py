@@ -86,3 +86,38 @@ def test_error_handling(client):
         content_type="application/json",
     )
     assert rv.status_code == 400
+
+
+def test_reload_frees_old_version_and_moves_the_memory_to_it(tmp_path):
+    import gc
+    import weakref
+    import chat_api
+
+    registry, store = chat_api.model_registry, chat_api.memory_store
+    if registry.current is None:
+        pytest.skip("no model to serve")
+    store.wait_for_rebuild()  # which embeds with the first version
+    first = weakref.ref(registry.current.model)
+    state = {k: v.clone() for k, v in registry.current.model.state_dict().items()}
+    next(iter(state.values())).add_(0.01)
+    path = str(tmp_path / "model.pt")
+    torch.save(state, path)
+    try:
+        assert registry.load(path).path == path
+        store.wait_for_rebuild()
+        gc.collect()
+        assert first() is None
+        # the memory embeds with the new weights, into their own index
+        assert store.version == registry.current.version
+        version, embedding = store.encode("hello")
+        assert version == store.version
+        assert embedding.shape == (registry.current.model.config.n_embd,)
+    finally:
+        registry.load(chat_api.MODEL_PATH)
+
+
+def test_train_rejects_a_session_id_that_is_not_a_uuid(client):
+    data = {"text": "some text", "session_id": "../../../tmp/x"}
+    rv = client.post("/train", data=json.dumps(data), content_type="application/json")
+    assert rv.status_code == 400
+    assert "session_id" in json.loads(rv.data)["error"]
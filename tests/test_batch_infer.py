@@ -0,0 +1,123 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import json
+import pickle
+import torch
+import batch_infer
+import bpe
+from model import GPT, GPTConfig
+
+MODEL_ARGS = dict(
+    n_layer=2, n_head=2, n_embd=16, block_size=16, bias=True, vocab_size=20
+)
+
+
+def make_model():
+    torch.manual_seed(0)
+    return GPT(GPTConfig(**MODEL_ARGS)).eval()
+
+
+def test_greedy_matches_generate_rolling():
+    model = make_model()
+    lengths = [1, 5, 5, 9, 14, 16, 20]
+    prompts = [[(3 * i + j) % 20 for j in range(n)] for i, n in enumerate(lengths)]
+    with torch.no_grad():
+        out = {
+            i: tokens
+            for i, tokens, _ in batch_infer.generate(
+                model, prompts, 24, batch_size=3, temperature=0, shift=4
+            )
+        }
+        for i, prompt in enumerate(prompts):
+            idx = torch.tensor([prompt])
+            expected = model.generate_rolling(idx, 24, top_k=1, shift=4)
+            assert out[i] == expected[0, len(prompt) :].tolist()
+
+
+def test_rows_stop_early():
+    model = make_model()
+    prompts = [[1, 2, 3], [4, 5], [6]]
+    # two chars a token, so the stop straddles a token boundary and is no
+    # sequence of ids of its own
+    pieces = [chr(97 + i) + chr(97 + 7 * i % 20) for i in range(20)]
+
+    def decode(ids):
+        return "".join(pieces[i] for i in ids)
+
+    with torch.no_grad():
+        greedy = {
+            i: tokens
+            for i, tokens, _ in batch_infer.generate(
+                model, prompts, 10, temperature=0
+            )
+        }
+        stop = [decode(greedy[0][2:4])[1:3]]
+        finished = list(
+            batch_infer.generate(
+                model, prompts, [10, 3, 0], temperature=0, stop=stop, decode=decode
+            )
+        )
+    results = {i: (tokens, reason) for i, tokens, reason in finished}
+    end = batch_infer.find_stop(decode(greedy[0]), stop) + len(stop[0])
+    assert results[0] == (greedy[0][: -(-end // 2)], "stop")
+    assert results[1] == (greedy[1][:3], "length")
+    assert results[2] == ([], "length")
+
+
+def test_codec_from_the_meta_that_names_a_tokenizer(tmp_path):
+    chars = [chr(97 + i) for i in range(20)]
+    with open(tmp_path / "vocab.pkl", "wb") as f:
+        pickle.dump((chars, {c: i for i, c in enumerate(chars)}), f)
+    bpe.train("abcab abc " * 20, 24).save(str(tmp_path / "tokenizer.json"))
+    with open(tmp_path / "meta.pkl", "wb") as f:
+        pickle.dump({"vocab_size": 24, "tokenizer": "tokenizer.json"}, f)
+    with open(tmp_path / "char_meta.pkl", "wb") as f:
+        pickle.dump({"vocab_size": 20}, f)
+    vocab = str(tmp_path / "vocab.pkl")
+    codec = batch_infer.load_codec(str(tmp_path / "meta.pkl"), vocab)
+    assert codec.tokenizer.merges and len(codec.encode("abcab")) < 5
+    codec = batch_infer.load_codec(str(tmp_path / "char_meta.pkl"), vocab)
+    assert codec.encode("abcab") == [0, 1, 2, 0, 1]
+
+
+def test_cli_resumes_interrupted_run(tmp_path, monkeypatch):
+    chars = [chr(97 + i) for i in range(20)]
+    with open(tmp_path / "vocab.pkl", "wb") as f:
+        pickle.dump((chars, {c: i for i, c in enumerate(chars)}), f)
+    torch.save(
+        {"model": make_model().state_dict(), "model_args": MODEL_ARGS},
+        tmp_path / "ckpt.pt",
+    )
+    prompts = ["abc", "ddddddd", "", "qrst" * 5, "hello", "ab"]
+    with open(tmp_path / "in.jsonl", "w") as f:
+        for i, prompt in enumerate(prompts):
+            f.write(json.dumps({"id": f"p{i}", "prompt": prompt}) + "\n")
+
+    def run(out):
+        argv = [
+            "batch_infer.py",
+            str(tmp_path / "in.jsonl"),
+            str(out),
+            f"--model={tmp_path / 'ckpt.pt'}",
+            f"--vocab={tmp_path / 'vocab.pkl'}",
+            "--max_new_tokens=12",
+            "--batch_size=2",
+            "--chunk_size=2",
+            "--workers=1",
+        ]
+        monkeypatch.setattr(sys, "argv", argv)
+        batch_infer.main()
+        lines = out.read_text().splitlines()
+        return {r["id"]: r for r in map(json.loads, lines)}, len(lines)
+
+    full, _ = run(tmp_path / "full.jsonl")
+    assert sorted(full) == [f"p{i}" for i in range(len(prompts))]
+    assert all(r["completion_tokens"] == 12 for r in full.values())
+
+    # two results made it to disk, the third was cut off mid-line
+    lines = (tmp_path / "full.jsonl").read_text().splitlines(keepends=True)
+    (tmp_path / "resumed.jsonl").write_text("".join(lines[:2]) + lines[2][:10])
+    resumed, n_lines = run(tmp_path / "resumed.jsonl")
+    assert n_lines == len(prompts)
+    assert resumed == full
@@ -0,0 +1,67 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import pickle
+import re
+from collections import Counter
+from bpe import PATTERN, Tokenizer, load_vocab, merge, train
+
+TEXT = (
+    "The void hums. It's the hum of the void, and the void's hum is "
+    "older than the stars: 1999 stars, 2001 stars... _all_ of them!\n\n"
+) * 5 + "A last line, with odd chars: ~é\t\n"
+
+
+def naive_merges(text, vocab_size, min_frequency=2):
+    """The merges of train(), recounting every pair of the corpus each time."""
+    chars = sorted(set(text))
+    stoi = {c: i for i, c in enumerate(chars)}
+    words = [[stoi[c] for c in chunk] for chunk in re.findall(PATTERN, text)]
+    merges = []
+    while len(chars) + len(merges) < vocab_size:
+        counts = Counter(p for ids in words for p in zip(ids, ids[1:]))
+        if not counts:
+            break
+        # the most frequent pair, the smallest of equally frequent ones
+        pair = min(counts, key=lambda p: (-counts[p], p))
+        if counts[pair] < min_frequency:
+            break
+        merges.append(pair)
+        words = [merge(ids, pair, len(chars) + len(merges) - 1) for ids in words]
+    return merges
+
+
+def test_train_matches_naive_recount_and_round_trips():
+    tokenizer = train(TEXT, 120)
+    assert tokenizer.merges == naive_merges(TEXT, 120)
+    assert 0 < len(tokenizer.merges) and tokenizer.vocab_size <= 120
+    ids = tokenizer.encode(TEXT)
+    assert tokenizer.decode(ids) == TEXT
+    assert len(ids) < len(TEXT) / 2
+    # unseen text of known chars round trips too, unknown chars are dropped
+    assert tokenizer.decode(tokenizer.encode("the stars hum")) == "the stars hum"
+    assert tokenizer.decode(tokenizer.encode("the Zvoid")) == "the void"
+
+
+def test_without_merges_it_is_the_char_vocab(tmp_path):
+    chars = sorted(set(TEXT))
+    stoi = {c: i for i, c in enumerate(chars)}
+    tokenizer = train(TEXT, len(chars))
+    assert tokenizer.merges == [] and tokenizer.stoi == stoi
+    assert tokenizer.encode(TEXT) == [stoi[c] for c in TEXT]
+    # the pickled char vocabs load as the same tokenizer
+    with open(tmp_path / "vocab.pkl", "wb") as f:
+        pickle.dump((chars, stoi), f)
+    assert load_vocab(str(tmp_path / "vocab.pkl")).stoi == stoi
+
+
+def test_save_and_load_through_meta(tmp_path):
+    tokenizer = train(TEXT, 100)
+    tokenizer.save(str(tmp_path / "tokenizer.json"))
+    with open(tmp_path / "meta.pkl", "wb") as f:
+        pickle.dump({"vocab_size": 100, "tokenizer": "tokenizer.json"}, f)
+    for path in ("tokenizer.json", "meta.pkl"):
+        loaded = load_vocab(str(tmp_path / path))
+        assert isinstance(loaded, Tokenizer)
+        assert loaded.merges == tokenizer.merges and loaded.itos == tokenizer.itos
+        assert loaded.encode(TEXT) == tokenizer.encode(TEXT)
@@ -0,0 +1,47 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from capabilities import CapabilityProbe
+
+
+def test_probe_is_cached_per_fingerprint(tmp_path):
+    cache = str(tmp_path / "capabilities.json")
+    calls = []
+
+    def check():
+        calls.append(1)
+        return True
+
+    probe = CapabilityProbe({"chats.embedding": check}, cache, fingerprint="db1")
+    probe.start()
+    assert probe.wait(5)
+    assert probe.get("chats.embedding") and probe.status()["source"] == "probe"
+
+    again = CapabilityProbe({"chats.embedding": check}, cache, fingerprint="db1")
+    again.start()
+    assert again.wait(5) and again.status()["source"] == "cache"
+    assert len(calls) == 1
+
+    other = CapabilityProbe({"chats.embedding": check}, cache, fingerprint="db2")
+    other.start()
+    assert other.wait(5) and other.status()["source"] == "probe"
+    assert len(calls) == 2
+
+
+def test_undecided_checks_are_retried_and_not_cached(tmp_path):
+    cache = str(tmp_path / "capabilities.json")
+    outcomes = [ConnectionError("offline"), False]
+
+    def check():
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    probe = CapabilityProbe({"x": check}, cache, retry=0.01)
+    probe.start()
+    assert probe.wait(5)  # ready, even though the check could not tell yet
+    probe._thread.join(5)
+    assert probe.status()["capabilities"] == {"x": False}
+    assert probe.status()["errors"] == {}
+    assert os.path.exists(cache)
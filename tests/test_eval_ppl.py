@@ -0,0 +1,61 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import json
+import math
+import pickle
+import numpy as np
+import torch
+import eval_ppl
+from model import GPT, GPTConfig
+
+MODEL_ARGS = dict(
+    n_layer=2, n_head=2, n_embd=16, block_size=16, bias=True, vocab_size=20
+)
+
+
+def make_model(seed):
+    torch.manual_seed(seed)
+    return GPT(GPTConfig(**MODEL_ARGS)).eval()
+
+
+def test_evaluate_scores_every_token_once():
+    data = np.random.default_rng(0).integers(20, size=301).astype(np.uint16)
+    models = [make_model(0), make_model(1)]
+    nll, n_tokens, n_units = eval_ppl.evaluate(
+        models, data, block_size=16, stride=5, batch_size=4, lengths=np.full(20, 2)
+    )
+    assert n_tokens == 300
+    assert n_units == 600
+    for model, total in zip(models, nll):
+        expected = -model.score([data.tolist()], stride=5)[0].double().sum().item()
+        assert math.isclose(total, expected, rel_tol=1e-5)
+
+
+def test_cli_reports_bits_per_char(tmp_path, monkeypatch, capsys):
+    data = np.random.default_rng(0).integers(20, size=200).astype(np.uint16)
+    data.tofile(tmp_path / "val.bin")
+    with open(tmp_path / "meta.pkl", "wb") as f:
+        pickle.dump({"vocab_size": 20, "itos": {i: chr(97 + i) for i in range(20)}}, f)
+    for name in ("a", "b"):
+        model = make_model(0)
+        (tmp_path / name).mkdir()
+        torch.save(
+            {"model": model.state_dict(), "model_args": MODEL_ARGS},
+            tmp_path / name / "ckpt.pt",
+        )
+    out = tmp_path / "results.json"
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        ["eval_ppl.py", f"--data={tmp_path / 'val.bin'}", f"--out={out}"]
+        + [str(tmp_path / "a"), str(tmp_path / "b" / "ckpt.pt")],
+    )
+    eval_ppl.main()
+    results = json.loads(out.read_text())["results"]
+    assert [r["tokens"] for r in results] == [199, 199]
+    a, b = results
+    # one char per token
+    assert math.isclose(a["bits_per_char"], a["bits_per_token"], rel_tol=1e-9)
+    assert math.isclose(a["perplexity"], b["perplexity"], rel_tol=1e-9)
+    assert "bits/char" in capsys.readouterr().out
@@ -0,0 +1,93 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import threading
+import uuid
+import torch
+from finetune import FinetuneQueue
+from lora import AdapterStore, base_of, inject
+from model import GPT, GPTConfig
+
+
+def test_job_finetunes_and_swaps_in_new_weights(tmp_path):
+    text = "the quick brown fox jumps over the lazy dog\n"
+    stoi = {c: i for i, c in enumerate(sorted(set(text)))}
+    torch.manual_seed(0)
+    config = GPTConfig(
+        block_size=16, vocab_size=len(stoi), n_layer=1, n_head=2, n_embd=16, dropout=0.0
+    )
+    serving = {"model": GPT(config).eval()}
+    statuses = []
+    done = threading.Event()
+
+    def on_model(model):
+        serving["model"] = model
+
+    def on_status(job):
+        statuses.append(job.status)
+        if job.status in ("completed", "failed"):
+            done.set()
+
+    queue = FinetuneQueue(
+        str(tmp_path),
+        stoi,
+        get_model=lambda: serving["model"],
+        on_model=on_model,
+        on_status=on_status,
+        iters=3,
+        batch_size=2,
+        learning_rate=1e-2,
+    )
+    before = {k: v.clone() for k, v in serving["model"].state_dict().items()}
+    session_id = str(uuid.uuid4())
+    job = queue.submit("user/1", text * 3, session_id)
+    # the job's directory is named by the server, the client's id is kept
+    assert job.id != session_id and job.to_dict()["session_id"] == session_id
+    assert done.wait(300), statuses
+    assert statuses == ["pending", "training", "completed"], job.message
+    after = serving["model"].state_dict()
+    assert any(not torch.equal(before[k], after[k]) for k in before)
+    assert open(queue.corpus_path("user/1")).read() == text * 3
+    assert not os.path.exists(tmp_path / "jobs" / job.id)
+
+
+def test_job_with_adapter_store_trains_the_users_adapter(tmp_path):
+    text = "the quick brown fox jumps over the lazy dog\n"
+    stoi = {c: i for i, c in enumerate(sorted(set(text)))}
+    torch.manual_seed(0)
+    config = GPTConfig(
+        block_size=16, vocab_size=len(stoi), n_layer=1, n_head=2, n_embd=16, dropout=0.0
+    )
+    model = inject(GPT(config).eval())
+    before = {k: v.clone() for k, v in model.state_dict().items()}
+    statuses = []
+    done = threading.Event()
+
+    def on_status(job):
+        statuses.append(job.status)
+        if job.status in ("completed", "failed"):
+            done.set()
+
+    store = AdapterStore(str(tmp_path / "adapters"))
+    queue = FinetuneQueue(
+        str(tmp_path),
+        stoi,
+        get_model=lambda: model,
+        on_model=None,
+        on_status=on_status,
+        iters=3,
+        batch_size=2,
+        learning_rate=1e-2,
+        adapters=store,
+    )
+    queue.submit("user/1", text * 3)
+    assert done.wait(300), statuses
+    assert statuses == ["pending", "training", "completed"]
+    # trained against, and so applied to, the served weights
+    adapter = store.get("user/1", base=base_of(model))
+    assert adapter is not None
+    assert os.path.exists(store.path("user/1"))
+    assert any(B.abs().sum() > 0 for _, B in adapter.weights.values())
+    after = model.state_dict()
+    assert all(torch.equal(before[k], after[k]) for k in before)
+    assert store.get("user/2") is None
@@ -0,0 +1,78 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import json
+import struct
+import torch
+import eval_ppl
+from import_gpt2 import TRANSPOSED, import_gpt2
+from model import GPT, GPTConfig
+
+
+def make_model():
+    torch.manual_seed(0)
+    config = GPTConfig(
+        n_layer=2, n_head=4, n_embd=32, block_size=16, vocab_size=50, dropout=0.0
+    )
+    return GPT(config).eval()
+
+
+def to_hf(model):
+    """The state dict as GPT2LMHeadModel's: Conv1D weights, masks, lm_head."""
+    state = {}
+    for name, tensor in model.state_dict().items():
+        if name.endswith(TRANSPOSED):
+            tensor = tensor.t()
+        state[name] = tensor.contiguous()
+    for i in range(model.config.n_layer):
+        state[f"transformer.h.{i}.attn.bias"] = torch.ones(1, 1, 16, 16)
+    return state
+
+
+def write_safetensors(path, state):
+    header, blobs, offset = {}, [], 0
+    for name, tensor in state.items():
+        data = tensor.numpy().tobytes()
+        header[name] = {
+            "dtype": "F32",
+            "shape": list(tensor.shape),
+            "data_offsets": [offset, offset + len(data)],
+        }
+        blobs.append(data)
+        offset += len(data)
+    header["__metadata__"] = {"format": "pt"}
+    header_bytes = json.dumps(header).encode()
+    with open(path, "wb") as f:
+        f.write(struct.pack("<Q", len(header_bytes)) + header_bytes)
+        f.write(b"".join(blobs))
+
+
+@torch.no_grad()
+def test_imports_safetensors_and_bin(tmp_path):
+    model = make_model()
+    idx = torch.randint(50, (2, 16))
+    expected, _ = model(idx, idx)
+    state = to_hf(model)
+
+    # the hub's model.safetensors is a GPT2Model: no prefix, no lm_head
+    hub = tmp_path / "hub"
+    hub.mkdir()
+    write_safetensors(
+        hub / "model.safetensors",
+        {
+            k.removeprefix("transformer."): v
+            for k, v in state.items()
+            if k != "lm_head.weight"
+        },
+    )
+    (hub / "config.json").write_text(json.dumps({"n_head": 4}))
+    torch.save(state, tmp_path / "pytorch_model.bin")
+
+    for imported in [
+        import_gpt2(str(hub)),
+        import_gpt2(str(tmp_path / "pytorch_model.bin"), n_head=4),
+        eval_ppl.load_model(str(hub / "model.safetensors")),
+    ]:
+        assert imported.config.n_head == 4 and imported.config.n_layer == 2
+        assert imported.lm_head.weight is imported.transformer.wte.weight
+        assert torch.allclose(imported(idx, idx)[0], expected, atol=1e-6)
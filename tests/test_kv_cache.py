@@ -0,0 +1,150 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import pytest
+import torch
+from kv_cache import OutOfBlocks, PagedKVCache, RollingKVCache, generate
+from model import GPT, GPTConfig
+
+
+@pytest.fixture
+def model():
+    torch.manual_seed(0)
+    config = GPTConfig(
+        block_size=64, vocab_size=32, n_layer=2, n_head=2, n_embd=16, dropout=0.0
+    )
+    return GPT(config).eval()
+
+
+def full_logits(model, ids):
+    with torch.no_grad():
+        logits, _ = model(torch.tensor([ids]))
+    return logits[0, -1]
+
+
+def test_paged_decode_matches_full_forward(model):
+    cache = PagedKVCache(model.config, num_blocks=16, page_size=4)
+    seqs = {"a": [1, 2, 3, 4, 5, 6, 7], "b": [8, 9]}
+    with torch.no_grad():
+        for seq_id, ids in seqs.items():
+            cache.add_sequence(seq_id)
+            logits, _ = model(torch.tensor([ids]), kv=cache.step([seq_id], len(ids)))
+            assert torch.allclose(logits[0, -1], full_logits(model, ids), atol=1e-5)
+        # sequences of different lengths decode as one batch
+        for token in [10, 11, 12, 13, 14, 15]:
+            step = cache.step(["a", "b"], 1)
+            logits, _ = model(torch.tensor([[token], [token]]), kv=step)
+            for row, seq_id in enumerate(["a", "b"]):
+                seqs[seq_id].append(token)
+                expected = full_logits(model, seqs[seq_id])
+                assert torch.allclose(logits[row, -1], expected, atol=1e-5)
+    assert cache.lengths == {"a": 13, "b": 8}
+    assert cache.stats()["blocks_used"] == 4 + 2
+
+
+def test_fork_copies_on_write(model):
+    cache = PagedKVCache(model.config, num_blocks=8, page_size=4)
+    prompt = [1, 2, 3, 4, 5, 6]
+    with torch.no_grad():
+        cache.add_sequence("parent")
+        model(torch.tensor([prompt]), kv=cache.step(["parent"], len(prompt)))
+        cache.fork("parent", "child")
+        assert cache.tables["child"] == cache.tables["parent"]
+        assert cache.stats()["blocks_used"] == 2
+        step = cache.step(["parent", "child"], 1)
+        logits, _ = model(torch.tensor([[7], [9]]), kv=step)
+    # the full first block stays shared, the partially filled one was copied
+    assert cache.tables["child"][0] == cache.tables["parent"][0]
+    assert cache.tables["child"][1] != cache.tables["parent"][1]
+    assert torch.allclose(logits[0, -1], full_logits(model, prompt + [7]), atol=1e-5)
+    assert torch.allclose(logits[1, -1], full_logits(model, prompt + [9]), atol=1e-5)
+    cache.free("parent")
+    cache.free("child")
+    assert cache.stats()["blocks_used"] == 0
+    assert sorted(cache.free_blocks) == list(range(8))
+
+
+def test_out_of_blocks_reserves_nothing(model):
+    cache = PagedKVCache(model.config, num_blocks=3, page_size=4)
+    cache.add_sequence("a")
+    cache.add_sequence("b")
+    cache.step(["a"], 8)
+    with pytest.raises(OutOfBlocks):
+        cache.step(["a", "b"], 4)
+    assert cache.lengths == {"a": 8, "b": 0}
+    assert len(cache.free_blocks) == 1
+    with pytest.raises(ValueError):
+        cache.step(["b"], 65)  # beyond the position embeddings
+
+
+def test_generate_greedy_matches_gpt_generate(model):
+    cache = PagedKVCache(model.config, num_blocks=32, page_size=4)
+    prompts = [[1, 2, 3], [4, 5, 6, 7, 8]]
+    out = generate(model, cache, prompts, 10, top_k=1, num_samples=2)
+    for prompt, samples in zip(prompts, out):
+        with torch.no_grad():
+            expected = model.generate(torch.tensor([prompt]), 10, top_k=1)[0].tolist()
+        assert samples == [expected, expected]
+    assert cache.tables == {}
+    assert cache.stats()["blocks_used"] == 0
+
+
+def test_rolling_matches_generate_within_the_window(model):
+    idx = torch.tensor([[1, 2, 3], [4, 5, 6]])
+    with torch.no_grad():
+        expected = model.generate(idx, 20, top_k=1)
+    assert torch.equal(model.generate_rolling(idx, 20, top_k=1), expected)
+
+
+def test_rolling_reencodes_the_window(model):
+    block_size, shift = model.config.block_size, 16
+    idx = torch.randint(0, 32, (1, 50))
+    out = model.generate_rolling(idx, 100, top_k=1, shift=shift)
+    # the reference: a full forward over the window the rolling decode keeps,
+    # which drops `shift` tokens whenever it would exceed block_size
+    ref, start = idx, 0
+    with torch.no_grad():
+        for _ in range(100):
+            if ref.size(1) - start > block_size:
+                start = ref.size(1) - (block_size - shift)
+            logits, _ = model(ref[:, start:])
+            ref = torch.cat((ref, logits[:, -1].argmax(-1, keepdim=True)), dim=1)
+    assert torch.equal(out, ref)
+
+
+def test_rolling_clamp_never_reencodes(model):
+    calls = []
+    hook = model.transformer.wte.register_forward_hook(
+        lambda module, args, output: calls.append(args[0].size(1))
+    )
+    idx = torch.randint(0, 32, (2, 60))
+    out = model.generate_rolling(idx, 40, top_k=1, shift=0)
+    hook.remove()
+    assert out.shape == (2, 100)
+    assert calls == [60] + [1] * 39
+
+
+def test_rolling_under_bf16_autocast(model):
+    idx = torch.randint(0, 32, (2, 50))
+    with torch.autocast("cpu", dtype=torch.bfloat16):
+        for shift in (16, 0):  # re-encoding and clamped
+            out = model.generate_rolling(idx, 30, top_k=1, shift=shift)
+            assert out.shape == (2, 80)
+        # a float32 cache made outside the autocast region takes bf16 keys
+        cache = RollingKVCache(model.config, 2)
+        with torch.no_grad():
+            logits, _ = model(idx, kv=cache.step(idx.size(1)))
+            logits, _ = model(idx[:, -1:], kv=cache.step(1))
+    assert cache.k.dtype == torch.float32 and cache.length == 51
+    assert torch.isfinite(logits).all()
+
+
+def test_paged_under_bf16_autocast(model):
+    prompts = [[1, 2, 3], [4, 5, 6, 7, 8]]
+    float_cache = PagedKVCache(model.config, num_blocks=32, page_size=4)
+    with torch.autocast("cpu", dtype=torch.bfloat16):
+        cache = PagedKVCache(model.config, num_blocks=32, page_size=4)
+        for c in (cache, float_cache):
+            out = generate(model, c, prompts, 10, top_k=1, num_samples=2)
+            assert [len(s) for samples in out for s in samples] == [13, 13, 15, 15]
+    assert cache.k.dtype == torch.bfloat16 and float_cache.k.dtype == torch.float32
@@ -0,0 +1,118 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import numpy as np
+import torch
+from lora import (
+    Adapter,
+    AdapterBank,
+    AdapterStore,
+    LoRALinear,
+    base_of,
+    inject,
+    train,
+)
+from model import GPT, GPTConfig
+
+CONFIG = dict(n_layer=2, n_head=2, n_embd=16, block_size=16, vocab_size=20)
+
+
+def make_model():
+    torch.manual_seed(0)
+    return GPT(GPTConfig(**CONFIG, dropout=0.0)).eval()
+
+
+def random_adapter(model, rank, seed):
+    torch.manual_seed(seed)
+    adapter = Adapter.new(model, rank=rank, alpha=2 * rank)
+    for _, B in adapter.weights.values():
+        B.normal_(std=0.1)
+    return adapter
+
+
+def merged(adapter):
+    """A plain GPT with the adapter's update added into its weights."""
+    model = make_model()
+    state = model.state_dict()
+    for name, (A, B) in adapter.weights.items():
+        state[name + ".weight"] += adapter.scale * B @ A
+    model.load_state_dict(state)
+    return model
+
+
+@torch.no_grad()
+def test_inject_keeps_weights_and_outputs():
+    model = make_model()
+    idx = torch.randint(20, (2, 8))
+    before, _ = model(idx)
+    keys = list(model.state_dict())
+    inject(model)
+    assert sum(isinstance(m, LoRALinear) for m in model.modules()) == 4 * 2
+    assert list(model.state_dict()) == keys
+    assert torch.equal(model(idx)[0], before)
+    # a new adapter starts as a no-op
+    with Adapter.new(model).bank.rows(1):
+        assert torch.allclose(model(idx)[0], before)
+
+
+@torch.no_grad()
+def test_rows_of_a_batch_use_their_own_adapter():
+    model = inject(make_model())
+    a, b = random_adapter(model, 4, 1), random_adapter(model, 8, 2)
+    idx = torch.randint(20, (3, 8))
+    targets = torch.zeros_like(idx)  # for the logits of every position
+    with AdapterBank([a, b]).rows([1, 2, 0]):
+        logits, _ = model(idx, targets)
+    rows = [(merged(a), 0), (merged(b), 1), (make_model(), 2)]
+    for reference, i in rows:
+        expected, _ = reference(idx[i : i + 1], targets[i : i + 1])
+        assert torch.allclose(logits[i], expected[0], atol=1e-5)
+    # outside the block, the base model again
+    expected, _ = make_model()(idx, targets)
+    assert torch.equal(model(idx, targets)[0], expected)
+
+
+def test_train_fits_adapter_and_store_reloads_it(tmp_path):
+    model = inject(make_model())
+    base = {k: v.clone() for k, v in model.state_dict().items()}
+    data = np.tile(np.arange(10, dtype=np.uint16), 20)
+    torch.manual_seed(0)
+    adapter = Adapter.new(model, rank=4)
+    losses = train(model, adapter, data, iters=30, batch_size=4, learning_rate=1e-2)
+    assert losses[-1] < losses[0]
+    assert all(torch.equal(base[k], v) for k, v in model.state_dict().items())
+
+    store = AdapterStore(str(tmp_path / "adapters"), capacity=1)
+    assert store.get("user/1") is None
+    store.save("user/1", adapter)
+    store.save("user/2", Adapter.new(model, rank=4))
+    assert len(store) == 1 and not store.in_memory("user/1")
+    assert os.path.dirname(store.path("../x")) == str(tmp_path / "adapters")
+    reloaded = store.get("user/1")
+    assert store.in_memory("user/1") and not store.in_memory("user/2")
+    idx = torch.randint(10, (2, 8))
+    with torch.no_grad():
+        with adapter.bank.rows(1):
+            expected, _ = model(idx)
+        with reloaded.bank.rows(1):
+            assert torch.equal(model(idx)[0], expected)
+
+
+def test_adapters_apply_only_to_their_base(tmp_path):
+    model = inject(make_model())
+    base = base_of(model)
+    assert base == base_of(make_model())  # the same weights, LoRA or not
+    store = AdapterStore(str(tmp_path))
+    store.save("user/1", Adapter.new(model, rank=4, base=base))
+    store.save("user/2", Adapter.new(model, rank=4))  # from before bases
+    assert store.get("user/1", base) is not None
+    assert store.get("user/2", base) is None
+    # reloaded to other weights of the same shape: its adapters are stale
+    other = make_model()
+    with torch.no_grad():
+        other.transformer.h[0].mlp.c_fc.weight[0, 0] += 1
+    other_base = base_of(other)
+    assert other_base["model_args"] == base["model_args"]
+    assert store.get("user/1", other_base) is None
+    # the base is saved with the adapter
+    assert AdapterStore(str(tmp_path)).get("user/1", base).base == base
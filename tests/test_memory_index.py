@@ -0,0 +1,195 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import multiprocessing
+import re
+import numpy as np
+from memory_index import MemoryStore, MemorySync, UserMemoryIndex
+
+
+def test_search_matches_sql_semantics(tmp_path):
+    """similarity > threshold, best first, at most count."""
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((50, 16)).astype(np.float32)
+    index = UserMemoryIndex(str(tmp_path / "user"))
+    for i, v in enumerate(vectors):
+        assert index.add(f"id{i}", v, f"m{i}", f"r{i}")
+    assert not index.add("id0", vectors[0], "m0", "r0")  # already indexed
+
+    query = vectors[3] + 0.1 * rng.standard_normal(16).astype(np.float32)
+    unit = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    sims = unit @ (query / np.linalg.norm(query))
+    for threshold, count in [(0.0, 5), (0.3, 50), (0.99, 5)]:
+        expected = [i for i in np.argsort(-sims) if sims[i] > threshold][:count]
+        matches = index.search(query, threshold, count)
+        assert [m["id"] for m in matches] == [f"id{i}" for i in expected]
+    assert index.search(query, 0.0, 1)[0]["message"] == "m3"
+
+
+def test_persistence_and_ivf(tmp_path):
+    rng = np.random.default_rng(1)
+    vectors = rng.standard_normal((300, 8)).astype(np.float32)
+    store = MemoryStore(str(tmp_path), ivf_min_rows=100, nprobe=100)
+    for i, v in enumerate(vectors):
+        store.add("user/1", i, v, "m", "r")
+    # built in the background, the rows past it are scanned flat meanwhile
+    store.index("user/1").wait_for_ivf()
+    assert store.index("user/1").ivf is not None
+    # probing every list is exact
+    flat = UserMemoryIndex(str(tmp_path / "user_1"))
+    assert len(flat) == 300 and flat.ivf is None
+    for q in vectors[:10]:
+        matches, expected = store.search("user/1", q, 0.2, 5), flat.search(q, 0.2, 5)
+        # the same rows; the similarities up to float rounding (other matmuls)
+        assert [m["id"] for m in matches] == [m["id"] for m in expected]
+        for m, e in zip(matches, expected):
+            assert abs(m["similarity"] - e["similarity"]) < 1e-5
+    assert store.search("someone else", vectors[0]) == []
+
+
+def _add_rows(prefix, ids):
+    index = UserMemoryIndex(prefix)
+    for i in ids:
+        vector = np.random.default_rng(i).standard_normal(8).astype(np.float32)
+        index.add(i, vector, f"m{i}", f"r{i}")
+
+
+def test_workers_append_to_the_same_user(tmp_path):
+    prefix = str(tmp_path / "user")
+    # two instances of one process, as after an LRU eviction
+    first, second = UserMemoryIndex(prefix), UserMemoryIndex(prefix)
+    first.add(0, np.ones(8), "m0", "r0")
+    assert second.add(1, -np.ones(8), "m1", "r1")
+    assert not second.add(0, np.ones(8), "m0", "r0")  # the other's row
+    assert [m["id"] for m in first.search(-np.ones(8), 0.5, 5)] == [1]
+    # and workers adding at once, the files growing under each other
+    ctx = multiprocessing.get_context("fork")
+    workers = [
+        ctx.Process(target=_add_rows, args=(prefix, range(start, 400, 4)))
+        for start in range(2, 6)
+    ]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+        assert w.exitcode == 0
+    index = UserMemoryIndex(prefix)
+    assert sorted(r[0] for r in index.rows) == list(range(400))
+    for i in range(2, 400, 37):
+        vector = np.random.default_rng(i).standard_normal(8).astype(np.float32)
+        best = index.search(vector, 0.0, 1)[0]
+        assert best["id"] == i and best["message"] == f"m{i}"
+        assert abs(best["similarity"] - 1.0) < 1e-5
+
+
+class FakeChats:
+    """The `chats` table, for the PostgREST filters MemorySync uses."""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.filters = []
+
+    def table(self, name):
+        self.filters = []
+        return self
+
+    def select(self, columns):
+        return self
+
+    @property
+    def not_(self):
+        return self
+
+    def is_(self, column, value):
+        return self
+
+    def order(self, column):
+        return self
+
+    def limit(self, n):
+        self.n = n
+        return self
+
+    def gte(self, column, value):
+        self.filters.append(lambda r: r[column] >= value)
+        return self
+
+    def or_(self, expr):
+        at, at_too, row_id = re.findall(r'"([^"]*)"', expr)
+        assert at == at_too
+        key = (at, row_id)
+        self.filters.append(lambda r: (r["created_at"], r["id"]) > key)
+        return self
+
+    def execute(self):
+        rows = sorted(self.rows, key=lambda r: (r["created_at"], r["id"]))
+        rows = [r for r in rows if all(f(r) for f in self.filters)]
+
+        class Result:
+            data = rows[: self.n]
+
+        return Result
+
+
+def test_sync_pages_past_rows_sharing_a_timestamp(tmp_path):
+    rng = np.random.default_rng(2)
+    rows = [
+        {
+            "id": f"{i:04d}",
+            "user_id": "user",
+            # a bulk insert: more than a page of rows at one timestamp
+            "created_at": "2024-01-01T00:00:00+00:00" if i < 7 else f"2024-01-0{i - 5}",
+            "message": f"m{i}",
+            "response": "r",
+            "embedding": rng.standard_normal(4).tolist(),
+        }
+        for i in range(10)
+    ]
+    table = FakeChats(rows[:8])
+    store = MemoryStore(str(tmp_path))
+    sync = MemorySync(store, table, page_size=3)
+    assert sync.sync_once() == 8
+    table.rows = rows
+    assert sync.sync_once() == 2
+    # a restart picks up from the saved key
+    table.rows.append(dict(rows[0], id="0010", created_at="2024-02-01"))
+    assert MemorySync(store, table, page_size=3).sync_once() == 1
+    assert len(store.index("user")) == 11
+
+
+def test_new_model_version_gets_its_index_rebuilt(tmp_path):
+    def embedder(seed):
+        # a different embedding of the same texts for every version
+        table = np.random.default_rng(seed).standard_normal((128, 8))
+
+        def embed(texts):
+            return np.stack([table[[ord(c) for c in t]].sum(axis=0) for t in texts])
+
+        return embed
+
+    store = MemoryStore(str(tmp_path))
+    store.set_version("v1", embedder(1))
+    messages = [f"message {i}" for i in range(100)]
+    for i, message in enumerate(messages):
+        version, embedding = store.encode(message)
+        assert store.add("user/1", i, embedding, message, "r", version=version)
+    store.set_version("v2", embedder(2))
+    # searched before the background rebuild got to the user, or after
+    query = embedder(2)(["message 7"])[0]
+    assert store.search("user/1", query, 0.99, 1, version="v2")[0]["id"] == 7
+    store.wait_for_rebuild()
+    assert os.path.exists(tmp_path / "v2" / ".rebuilt")
+    index = UserMemoryIndex(str(tmp_path / "v2" / "user_1"))
+    assert sorted(r[0] for r in index.rows) == list(range(100))
+    expected = embedder(2)(messages)
+    expected /= np.linalg.norm(expected, axis=1, keepdims=True)
+    order = [r[0] for r in index.rows]
+    assert np.allclose(index.vectors[: len(order)], expected[order], atol=1e-5)
+    # embeddings of the old version are embedded again, not mixed in
+    assert store.add("user/1", 100, embedder(1)(["late"])[0], "late", "r", "v1")
+    assert store.search("user/1", embedder(2)(["late"])[0], 0.99, 1, "v2")
+    assert store.search("user/1", query, 0.5, 1, version="v1") == []
+    # a restart on v2 finds it complete
+    again = MemoryStore(str(tmp_path))
+    again.set_version("v2", embedder(2))
+    assert again.search("user/1", query, 0.99, 1, version="v2")[0]["id"] == 7
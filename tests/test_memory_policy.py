@@ -0,0 +1,33 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import time
+from memory_policy import MemoryPolicy
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_collects_only_under_pressure_or_when_idle():
+    calm = MemoryPolicy(high_watermark=None, idle_seconds=0.1)
+    calm.start()
+    for _ in range(100):
+        calm.after_request()
+    assert calm.stats["collections"] == {"pressure": 0, "idle": 0}
+    # one idle collection once requests stop, not one per idle period
+    assert wait_for(lambda: calm.stats["collections"]["idle"] == 1)
+    time.sleep(0.3)
+    assert calm.stats["collections"]["idle"] == 1
+
+    pressured = MemoryPolicy(high_watermark=1, idle_seconds=60, check_interval=0)
+    pressured.start()
+    for _ in range(100):
+        pressured.after_request()
+    assert wait_for(lambda: pressured.stats["collections"]["pressure"] == 1)
+    assert pressured.stats["pause_seconds_total"] > 0
+    snapshot = pressured.snapshot()
+    assert snapshot["rss_bytes"] > 0 and snapshot["collections"]["pressure"] == 1
@@ -0,0 +1,69 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import pytest
+from metrics import MetricsRegistry
+
+
+def test_counter_and_labels():
+    registry = MetricsRegistry()
+    plain = registry.counter("void_test_total", "Plain.")
+    labelled = registry.counter("void_lookups_total", "Labelled.", ["cache", "result"])
+    plain.inc()
+    plain.inc(2)
+    labelled.labels("memory", "hit").inc()
+    labelled.labels("memory", "hit").inc()
+    labelled.labels("static", 'say "hi"').inc()
+    text = registry.render()
+    assert "# TYPE void_test_total counter" in text
+    assert "void_test_total 3\n" in text
+    assert 'void_lookups_total{cache="memory",result="hit"} 2' in text
+    assert 'void_lookups_total{cache="static",result="say \\"hi\\""} 1' in text
+    with pytest.raises(ValueError):
+        labelled.labels("memory")
+    with pytest.raises(ValueError):
+        registry.counter("void_test_total", "Again.")
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = MetricsRegistry()
+    h = registry.histogram("void_wait_seconds", "Wait.", buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 2.0):
+        h.observe(value)
+    lines = registry.render().splitlines()
+    assert 'void_wait_seconds_bucket{le="0.1"} 2' in lines  # le is inclusive
+    assert 'void_wait_seconds_bucket{le="1"} 3' in lines
+    assert 'void_wait_seconds_bucket{le="+Inf"} 4' in lines
+    assert "void_wait_seconds_count 4" in lines
+    assert "void_wait_seconds_sum 2.65" in lines
+
+
+def test_gauges():
+    registry = MetricsRegistry()
+    active = registry.gauge("void_active", "Active.")
+    active.inc()
+    active.inc()
+    active.dec()
+    assert active.get() == 1
+    registry.gauge("void_model_bytes", "Model.", ["version"]).set_function(
+        lambda: {("abc",): 1024}
+    )
+    registry.gauge("void_unknown", "Skipped.").set_function(lambda: None)
+    registry.gauge("void_broken", "Broken.").set_function(lambda: 1 / 0)
+    text = registry.render()
+    assert "void_active 1\n" in text
+    assert 'void_model_bytes{version="abc"} 1024' in text
+    assert "\nvoid_unknown " not in text
+    assert "# TYPE void_broken gauge" in text
+
+
+def test_counter_computed_when_scraped():
+    registry = MetricsRegistry()
+    totals = {"idle": 2, "pressure": 0}
+    registry.counter("void_runs_total", "Runs.", ["reason"]).set_function(
+        lambda: {(k,): v for k, v in totals.items()}
+    )
+    totals["idle"] += 1
+    text = registry.render()
+    assert "# TYPE void_runs_total counter" in text
+    assert 'void_runs_total{reason="idle"} 3' in text
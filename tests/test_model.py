@@ -0,0 +1,120 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import torch
+from model import GPT, GPTConfig
+
+
+def tiny_config(**kwargs):
+    args = dict(block_size=16, vocab_size=50, n_layer=2, n_head=2, n_embd=32)
+    args.update(kwargs)
+    return GPTConfig(**args)
+
+
+def test_chunked_loss_matches_cross_entropy():
+    """The fused, chunked loss gives the same loss and gradients."""
+    torch.manual_seed(0)
+    model = GPT(tiny_config())
+    idx = torch.randint(50, (3, 16))
+    targets = torch.randint(50, (3, 16))
+    targets[:, :4] = -1  # ignored positions
+
+    _, loss = model(idx, targets)
+    loss.backward()
+    expected = [p.grad.clone() for p in model.parameters()]
+    model.zero_grad()
+
+    model.config.loss_chunk_size = 7
+    logits, chunked_loss = model(idx, targets)
+    chunked_loss.backward()
+    assert logits is None
+    assert torch.allclose(loss, chunked_loss, atol=1e-6)
+    for p, g in zip(model.parameters(), expected):
+        assert torch.allclose(p.grad, g, atol=1e-6)
+
+
+def test_embed_ignores_padding():
+    """Right padding does not change a row's embedding, rows are unit norm."""
+    torch.manual_seed(0)
+    model = GPT(tiny_config()).eval()
+    idx = torch.randint(50, (2, 16))
+    alone = model.embed(idx[:1, :9])
+    padded = model.embed(idx, lengths=[9, 16])
+    assert torch.allclose(alone[0], padded[0], atol=1e-5)
+    assert torch.allclose(padded.norm(dim=-1), torch.ones(2), atol=1e-5)
+
+
+def test_gqa_conversion_is_exact_for_equal_heads():
+    """Pooling key/value heads that are already equal within a group is lossless."""
+    from convert_gqa import convert
+
+    torch.manual_seed(0)
+    config = tiny_config(n_head=4)
+    model = GPT(config).eval()
+    hs = config.n_embd // config.n_head
+    with torch.no_grad():
+        for block in model.transformer.h:
+            w, b = block.attn.c_attn.weight, block.attn.c_attn.bias
+            for t in (w, b):
+                for part in (1, 2):  # k, v
+                    heads = t[part * config.n_embd : (part + 1) * config.n_embd]
+                    heads[hs : 2 * hs] = heads[:hs]
+                    heads[3 * hs :] = heads[2 * hs : 3 * hs]
+    model_args = dict(
+        n_layer=2, n_head=4, n_embd=32, block_size=16, bias=True, vocab_size=50
+    )
+    state_dict, gqa_args = convert(model.state_dict(), model_args, n_kv_head=2)
+    gqa = GPT(GPTConfig(**gqa_args)).eval()
+    gqa.load_state_dict(state_dict)
+    assert gqa.transformer.h[0].attn.c_attn.weight.shape == (32 + 2 * 2 * hs, 32)
+    idx = torch.randint(50, (2, 16))
+    assert torch.allclose(model(idx)[0], gqa(idx)[0], atol=1e-5)
+
+
+def test_gqa_cached_decode():
+    """Multi-query attention decodes the same with and without the KV cache."""
+    torch.manual_seed(0)
+    model = GPT(tiny_config(n_head=4, n_kv_head=1)).eval()
+    idx = torch.randint(50, (2, 5))
+    with torch.no_grad():
+        expected = model.generate(idx, 10, top_k=1)
+    assert torch.equal(model.generate_rolling(idx, 10, top_k=1), expected)
+    for block in model.transformer.h:
+        block.attn.flash_gqa = False  # the repeat_interleave path of older torch
+    with torch.no_grad():
+        assert torch.equal(model.generate(idx, 10, top_k=1), expected)
+
+
+def test_score_matches_forward():
+    """Batched, padded and windowed scoring gives each token's log-prob once."""
+    torch.manual_seed(0)
+    model = GPT(tiny_config()).eval()
+    seqs = [torch.randint(50, (n,)).tolist() for n in (1, 5, 17, 40, 12)]
+    scores = model.score(seqs, batch_size=2)
+    assert [len(s) for s in scores] == [0, 4, 16, 39, 11]
+    for seq, score in zip(seqs, scores):
+        if len(seq) > 17:
+            continue  # longer than one window
+        idx = torch.tensor([seq])
+        x = model.hidden_states(idx[:, :-1])
+        expected = torch.log_softmax(model.lm_head(x), dim=-1)[0]
+        expected = expected.gather(1, idx[0, 1:, None])[:, 0]
+        assert torch.allclose(score, expected, atol=1e-5)
+    # the long one: the first window as is, later tokens with >= 8 of context
+    long = torch.tensor([seqs[3]])
+    with torch.no_grad():
+        x = model.hidden_states(long[:, :16])
+        first = torch.log_softmax(model.lm_head(x), dim=-1)[0]
+    first = first.gather(1, long[0, 1:17, None])[:, 0]
+    assert torch.allclose(scores[3][:16], first, atol=1e-5)
+    one_by_one = model.score([seqs[3]], batch_size=1)[0]
+    assert torch.allclose(scores[3], one_by_one, atol=1e-5)
+
+
+def test_model_args_rebuild_the_same_weights():
+    config = tiny_config(n_head=4, n_kv_head=2, bias=False, loss_chunk_size=8)
+    state = GPT(config).state_dict()
+    rebuilt = GPT(GPTConfig(**config.model_args())).state_dict()
+    assert {k: v.shape for k, v in rebuilt.items()} == {
+        k: v.shape for k, v in state.items()
+    }
@@ -0,0 +1,42 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import gc
+import weakref
+import torch
+from model import GPT, GPTConfig
+from model_registry import ModelRegistry, ModelVersion
+
+CONFIG = dict(block_size=8, vocab_size=10, n_layer=1, n_head=1, n_embd=8)
+
+
+def loader(path, version):
+    model = GPT(GPTConfig(**CONFIG))
+    model.load_state_dict(torch.load(path))
+    return ModelVersion(model.eval(), {}, {}, version, path)
+
+
+def test_reload_swaps_and_frees_old_version(tmp_path):
+    path = str(tmp_path / "model.pt")
+    torch.save(GPT(GPTConfig(**CONFIG)).state_dict(), path)
+    warmed = []
+    registry = ModelRegistry(loader, warmup=lambda v: warmed.append(v.version))
+    first = registry.load(path)
+    assert registry.current is first and warmed == [first.version]
+    assert registry.load(path) is first  # unchanged file, no reload
+
+    in_flight = registry.current  # a request holding the old version
+    freed = weakref.ref(first.model)
+    torch.save(GPT(GPTConfig(**CONFIG)).state_dict(), path)
+    second = registry.load(path)
+    assert registry.current is second and second.version != first.version
+    assert in_flight.model is freed()  # still usable by that request
+    del first, in_flight
+    gc.collect()
+    assert freed() is None
+
+    # a broken checkpoint leaves the current version in place
+    with open(path, "wb") as f:
+        f.write(b"not a checkpoint")
+    assert registry.load(path) is second
+    assert registry.info()["last_error"]
@@ -0,0 +1,80 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import torch
+import eval_ppl
+from model import GPT, GPTConfig
+from paging import load_paged, read_source, write_layout
+
+MODEL_ARGS = dict(
+    n_layer=3, n_head=2, n_embd=16, block_size=16, bias=True, vocab_size=20
+)
+
+
+def write_checkpoint(tmp_path):
+    torch.manual_seed(0)
+    model = GPT(GPTConfig(**MODEL_ARGS, dropout=0.0)).eval()
+    torch.save(
+        {"model": model.state_dict(), "model_args": MODEL_ARGS}, tmp_path / "ckpt.pt"
+    )
+    return model
+
+
+@torch.no_grad()
+def test_paged_model_matches_resident_one(tmp_path):
+    model = write_checkpoint(tmp_path)
+    named, config = read_source(str(tmp_path))
+    write_layout(named, config, str(tmp_path / "paged"))
+    idx = torch.randint(20, (4, 16))
+    expected, _ = model(idx, idx)
+    torch.manual_seed(1)
+    generated = model.generate_rolling(idx[:, :4], 20, top_k=1)
+
+    for paged in [
+        load_paged(str(tmp_path / "paged"), prefetch=False),
+        eval_ppl.load_model(str(tmp_path / "paged")).to("cpu"),
+    ]:
+        assert torch.equal(paged(idx, idx)[0], expected)
+        torch.manual_seed(1)
+        assert torch.equal(paged.generate_rolling(idx[:, :4], 20, top_k=1), generated)
+        # between forwards, no Block holds its weights
+        for p in paged.transformer.h.parameters():
+            assert p.stride() == (0,) * p.dim()
+        assert paged.lm_head.weight is paged.transformer.wte.weight
+        assert paged.pager.stats["layers_read"] >= 3 * 21
+
+
+@torch.no_grad()
+def test_layout_in_half_precision(tmp_path):
+    model = write_checkpoint(tmp_path)
+    named, config = read_source(str(tmp_path / "ckpt.pt"))
+    write_layout(named, config, str(tmp_path / "paged"), torch.bfloat16)
+    paged = load_paged(str(tmp_path / "paged"))
+    assert paged.transformer.wte.weight.dtype == torch.bfloat16
+    size = os.path.getsize(tmp_path / "paged" / "weights.bin")
+    assert size < sum(t.numel() for t in named.values()) * 2 + 3 * (1 << 16)
+    idx = torch.randint(20, (2, 16))
+    logits, _ = paged(idx, idx)
+    expected, _ = model(idx, idx)
+    assert torch.allclose(logits.float(), expected, atol=0.1)
+
+
+@torch.no_grad()
+def test_forward_after_one_that_raised(tmp_path):
+    model = write_checkpoint(tmp_path)
+    named, config = read_source(str(tmp_path))
+    write_layout(named, config, str(tmp_path / "paged"))
+    paged = load_paged(str(tmp_path / "paged"))
+    idx = torch.randint(20, (2, 16))
+
+    def fail(module, args):
+        raise RuntimeError("interrupted")
+
+    handle = paged.transformer.h[1].register_forward_pre_hook(fail)
+    try:
+        paged(idx)
+    except RuntimeError:
+        pass
+    handle.remove()
+    # the prefetch of layer 2 is dropped, the next forward reads from layer 0
+    assert torch.equal(paged(idx, idx)[0], model(idx, idx)[0])
@@ -0,0 +1,73 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import pytest
+from rate_limit import LocalLimiter, SharedLimiter
+
+
+@pytest.fixture(params=["local", "shared"])
+def make_limiter(request, tmp_path):
+    limiters = []
+
+    def make(capacity, window, max_keys):
+        if request.param == "local":
+            limiter = LocalLimiter(capacity, window, max_keys=max_keys)
+        else:
+            path = str(tmp_path / "rate-limit")
+            limiter = SharedLimiter(capacity, window, max_keys=max_keys, path=path)
+        limiters.append(limiter)
+        return limiter
+
+    yield make
+    for limiter in limiters:
+        if isinstance(limiter, SharedLimiter):
+            limiter.close()
+
+
+def test_token_bucket(make_limiter):
+    limiter = make_limiter(3, 30, 100)  # 3 requests, one token back per 10s
+    assert [limiter.allow("1.2.3.4", now=0)[0] for _ in range(4)] == [
+        True, True, True, False
+    ]
+    allowed, retry_after = limiter.allow("1.2.3.4", now=5)
+    assert not allowed and retry_after == pytest.approx(5)
+    assert limiter.allow("1.2.3.4", now=10.5)[0]
+    assert limiter.allow("5.6.7.8", now=10.5)[0]  # other clients are separate
+    assert [limiter.allow("1.2.3.4", now=100)[0] for _ in range(4)] == [
+        True, True, True, False
+    ]
+
+
+def test_memory_is_bounded():
+    limiter = LocalLimiter(1, 60, max_keys=100)
+    for i in range(1000):
+        limiter.allow(f"10.0.{i // 256}.{i % 256}", now=i * 0.01)
+    assert len(limiter) == 100
+    limiter.allow("10.0.0.1", now=1000)  # everything else has expired
+    assert len(limiter) == 1
+
+
+def test_shared_between_instances(tmp_path):
+    path = str(tmp_path / "rate-limit")
+    worker1 = SharedLimiter(2, 60, max_keys=64, path=path)
+    worker2 = SharedLimiter(2, 60, max_keys=64, path=path)
+    assert worker1.allow("1.2.3.4", now=0)[0]
+    assert worker2.allow("1.2.3.4", now=0)[0]
+    assert not worker1.allow("1.2.3.4", now=0)[0]
+    worker1.close()
+    worker2.close()
+
+
+def test_existing_file_is_never_resized(tmp_path):
+    path = str(tmp_path / "rate-limit")
+    worker1 = SharedLimiter(1, 60, max_keys=64, path=path)
+    size = os.path.getsize(path)
+    worker2 = SharedLimiter(1, 60, max_keys=1024, path=path)  # configured apart
+    assert os.path.getsize(path) == size
+    assert worker2.num_groups == worker1.num_groups
+    assert worker1.allow("1.2.3.4", now=0)[0]
+    assert not worker2.allow("1.2.3.4", now=0)[0]
+    worker1.close()
+    worker2.close()
+    with pytest.raises(ValueError):
+        SharedLimiter(1, 60, max_keys=64, path=path, group_size=5)
@@ -0,0 +1,81 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import gzip
+import pytest
+from static_assets import StaticAssets
+
+SCRIPT = "console.log('void');\n" * 200
+
+
+@pytest.fixture
+def assets(tmp_path):
+    (tmp_path / "assets").mkdir()
+    (tmp_path / "index.html").write_text("<html>" + "<p>void</p>" * 100 + "</html>")
+    (tmp_path / "assets" / "index-3f9a1c2b.js").write_text(SCRIPT)
+    (tmp_path / "assets" / "app.css").write_text("body { color: red; }\n" * 50)
+    (tmp_path / "assets" / "app.css.br").write_bytes(b"prebuilt")
+    (tmp_path / "favicon.png").write_bytes(b"\x89PNG" + bytes(200))
+    return StaticAssets(str(tmp_path))
+
+
+def test_indexes_originals_only(assets):
+    assert sorted(assets.assets) == [
+        "assets/app.css",
+        "assets/index-3f9a1c2b.js",
+        "favicon.png",
+        "index.html",
+    ]
+    assert assets.assets["assets/app.css"].variants["br"][0] == b"prebuilt"
+    assert "gzip" not in assets.assets["favicon.png"].variants
+
+
+def test_hashed_asset_is_immutable_and_compressed(assets):
+    r = assets.response("assets/index-3f9a1c2b.js", {"Accept-Encoding": "gzip, br"})
+    assert r.status_code == 200
+    assert r.headers["Cache-Control"] == "public, max-age=31536000, immutable"
+    assert r.headers["Content-Encoding"] == "gzip"  # no brotli variant built here
+    assert r.headers["Vary"] == "Accept-Encoding"
+    assert gzip.decompress(r.get_data()).decode() == SCRIPT
+    assert r.mimetype in ("application/javascript", "text/javascript")
+
+
+def test_encoding_negotiation(assets):
+    r = assets.response("assets/app.css", {"Accept-Encoding": "gzip, br"})
+    assert r.headers["Content-Encoding"] == "br"
+    assert r.get_data() == b"prebuilt"
+    assert r.headers["Cache-Control"] == "no-cache"  # not content-hashed
+    r = assets.response("assets/app.css", {"Accept-Encoding": "br;q=0, gzip"})
+    assert r.headers["Content-Encoding"] == "gzip"
+    r = assets.response("assets/app.css", {})
+    assert "Content-Encoding" not in r.headers
+    assert r.get_data().startswith(b"body")
+    # a malformed q is not accepted, and no reason for a 500
+    r = assets.response("assets/app.css", {"Accept-Encoding": "br;q=x, gzip"})
+    assert r.headers["Content-Encoding"] == "gzip"
+
+
+def test_etag_revalidation(assets):
+    r = assets.response("index.html", {"Accept-Encoding": "gzip"})
+    etag = r.headers["ETag"]
+    assert r.headers["Cache-Control"] == "no-cache"
+    headers = {"If-None-Match": etag, "Accept-Encoding": "gzip"}
+    r = assets.response("index.html", headers)
+    assert r.status_code == 304
+    assert r.get_data() == b""
+    assert r.headers["ETag"] == etag
+    r = assets.response("index.html", {"If-None-Match": '"stale"'})
+    assert r.status_code == 200
+
+
+def test_spa_fallback_and_missing_assets(assets):
+    r = assets.response("settings/profile", {})
+    assert r.status_code == 200
+    assert r.get_data().startswith(b"<html>")
+    assert assets.response("assets/index-deadbeef.js", {}) is None
+
+
+def test_missing_build_dir(tmp_path):
+    assets = StaticAssets(str(tmp_path / "missing"))
+    assert len(assets) == 0
+    assert assets.response("index.html", {}) is None
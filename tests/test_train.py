@@ -0,0 +1,43 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import pickle
+import subprocess
+import numpy as np
+import torch
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+def test_optimizer_steps_once_per_iteration(tmp_path):
+    rng = np.random.default_rng(0)
+    for split in ("train", "val"):
+        rng.integers(0, 32, 2000, dtype=np.uint16).tofile(tmp_path / f"{split}.bin")
+    with open(tmp_path / "meta.pkl", "wb") as f:
+        pickle.dump({"vocab_size": 32}, f)
+    iters = 4
+    cmd = [
+        sys.executable,
+        os.path.join(ROOT, "train.py"),
+        f"--out_dir={tmp_path / 'out'}",
+        f"--dataset={tmp_path}",  # absolute, so data_dir is tmp_path
+        "--device=cpu",
+        "--dtype=float32",
+        "--always_save_checkpoint",
+        "--n_layer=1",
+        "--n_head=2",
+        "--n_embd=16",
+        "--block_size=8",
+        "--batch_size=2",
+        "--gradient_accumulation_steps=4",
+        f"--max_iters={iters}",
+        f"--eval_interval={iters}",
+        "--eval_iters=1",
+    ]
+    subprocess.run(cmd, cwd=tmp_path, check=True, capture_output=True, timeout=300)
+    # saved at the last eval, before that iteration's step
+    checkpoint = torch.load(tmp_path / "out" / "ckpt.pt", map_location="cpu")
+    assert checkpoint["iter_num"] == iters
+    # one AdamW step per iteration, not one per micro-batch
+    steps = {int(s["step"]) for s in checkpoint["optimizer"]["state"].values()}
+    assert steps == {iters}
@@ -0,0 +1,65 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import json
+import threading
+from write_behind import JSONLSink, WriteBehindQueue
+
+
+class FlakySink:
+    """Records batches, fails the first `failures` calls."""
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.batches = []
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def __call__(self, rows):
+        self.gate.wait()
+        if self.failures > 0:
+            self.failures -= 1
+            raise ConnectionError("database unavailable")
+        self.batches.append(list(rows))
+
+
+def test_batches_and_flush(tmp_path):
+    path = tmp_path / "chats.jsonl"
+    queue = WriteBehindQueue(JSONLSink(str(path)), batch_size=4, flush_interval=60)
+    for i in range(10):
+        assert queue.put({"id": i})
+    assert queue.flush(timeout=5)
+    with open(path) as f:
+        assert [json.loads(line)["id"] for line in f] == list(range(10))
+    assert queue.stats["written"] == 10
+    queue.close()
+
+
+def test_retry_bound_and_close():
+    sink = FlakySink(failures=2)
+    queue = WriteBehindQueue(sink, batch_size=2, flush_interval=60, backoff=0.01)
+    queue.put({"id": 0})
+    queue.put({"id": 1})
+    assert queue.flush(timeout=5)
+    assert sink.batches == [[{"id": 0}, {"id": 1}]]
+
+    # rows beyond max_pending are dropped while the sink is stuck
+    sink.gate.clear()
+    queue.max_pending = 3
+    results = [queue.put({"id": i}) for i in range(2, 10)]
+    assert results.count(False) >= 3 and queue.stats["dropped"] >= 3
+    sink.gate.set()
+    queue.close(timeout=5)
+    assert not queue.put({"id": 10})
+    written = [r["id"] for b in sink.batches for r in b]
+    assert written == sorted(written) and len(queue) == 0
+    assert queue.stats["written"] == len(written)
+
+
+def test_gives_up_after_max_retries():
+    sink = FlakySink(failures=100)
+    queue = WriteBehindQueue(sink, batch_size=1, max_retries=3, backoff=0.01)
+    queue.put({"id": 0})
+    assert queue.flush(timeout=5)
+    assert queue.stats["failed"] == 1 and sink.failures == 97
+    queue.close()
@@ -0,0 +1,126 @@
+"""
+Lightweight per-phase instrumentation of the training loop.
+
+StepTimeline records how long each phase of an iteration (data loading,
+forward, backward, clipping, optimizer, eval, checkpointing) takes and exports
+the timings in two forms:
+- a JSONL file with one record per iteration: {"iter": 12, "total_ms": ...,
+  "phases_ms": {"forward": ..., ...}, ...extra fields like loss and mfu}
+- a Chrome trace (open in chrome://tracing or https://ui.perfetto.dev) with one
+  event per phase, written incrementally in the JSON array format so that memory
+  stays bounded however long the run is.
+
+On CUDA the kernels run asynchronously, so pass sync=torch.cuda.synchronize to
+attribute time to the phase that actually spent it (at the cost of losing some
+CPU/GPU overlap). On CPU the timings are exact without it.
+"""
+
+import json
+import time
+from contextlib import contextmanager
+
+import torch
+
+# dense bf16/fp16 tensor core peak FLOPS of common GPUs, matched on device name
+GPU_PEAK_FLOPS = {
+    "H100": 989e12,
+    "A100": 312e12,
+    "A10G": 125e12,
+    "L4": 121e12,
+    "V100": 125e12,
+    "T4": 65e12,
+}
+
+
+class StepTimeline:
+
+    def __init__(self, jsonl_path=None, trace_path=None, sync=None, rank=0):
+        self.sync = sync
+        self.rank = rank
+        self.phases = {}  # phase name -> accumulated seconds in the current step
+        self._step_start = time.perf_counter()
+        self._jsonl = open(jsonl_path, "a") if jsonl_path else None
+        self._trace = None
+        if trace_path:
+            self._trace = open(trace_path, "w")
+            # the closing ] is optional in the Chrome trace JSON array format
+            self._trace.write("[\n")
+        # trace timestamps are microseconds since the timeline was created
+        self._t_origin = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name):
+        """Time the enclosed block as phase `name` of the current step."""
+        if self.sync is not None:
+            self.sync()
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.sync is not None:
+                self.sync()
+            t1 = time.perf_counter()
+            self.phases[name] = self.phases.get(name, 0.0) + (t1 - t0)
+            if self._trace is not None:
+                event = {
+                    "name": name,
+                    "ph": "X",
+                    "ts": (t0 - self._t_origin) * 1e6,
+                    "dur": (t1 - t0) * 1e6,
+                    "pid": self.rank,
+                    "tid": 0,
+                }
+                self._trace.write(json.dumps(event) + ",\n")
+
+    def step(self, iter_num, **extra):
+        """Close the current step, export its record and return it."""
+        now = time.perf_counter()
+        record = {
+            "iter": iter_num,
+            "rank": self.rank,
+            "total_ms": (now - self._step_start) * 1000,
+            "phases_ms": {k: v * 1000 for k, v in self.phases.items()},
+        }
+        record.update(extra)
+        if self._jsonl is not None:
+            self._jsonl.write(json.dumps(record) + "\n")
+            self._jsonl.flush()
+        self.phases = {}
+        self._step_start = now
+        return record
+
+    def close(self):
+        for f in (self._jsonl, self._trace):
+            if f is not None:
+                f.close()
+        self._jsonl = self._trace = None
+
+
+def detect_peak_flops(device, seconds=0.5):
+    """
+    Peak FLOPS of `device` (e.g. 'cpu', 'cuda:1') to measure MFU against. GPUs
+    are looked up in GPU_PEAK_FLOPS by name. For CPUs (and unknown GPUs) there is
+    no spec sheet number we can rely on, so the peak is calibrated instead: the
+    throughput of a large float32 matmul, i.e. the best this device practically
+    does on the op that dominates training.
+    """
+    is_cuda = "cuda" in device
+    if is_cuda:
+        name = torch.cuda.get_device_name(device)
+        for key, flops in GPU_PEAK_FLOPS.items():
+            if key in name:
+                return flops
+    n = 1024
+    a = torch.randn(n, n, device=device)
+    b = torch.randn(n, n, device=device)
+    a @ b  # warmup
+    iters = 0
+    t0 = time.perf_counter()
+    while True:
+        a @ b
+        iters += 1
+        if is_cuda:
+            torch.cuda.synchronize(device)
+        dt = time.perf_counter() - t0
+        if dt > seconds:
+            return 2 * n**3 * iters / dt
@@ -31,12 +31,17 @@ from torch.distributed import destroy_process_group, init_process_group
 from torch.nn.parallel import DistributedDataParallel as DDP
 
 from model import GPT, GPTConfig
+from sampler import EpochSampler, fixed_windows, strided_windows
+from timeline import StepTimeline, detect_peak_flops
 
 # I/O
 out_dir = 'out'
 eval_interval = 2000
 log_interval = 1
 eval_iters = 200
+eval_mode = "fixed"  # 'random' (fresh batches), 'fixed' (same windows every eval)
+# or 'full' (like 'fixed', but val is the whole of val.bin in strided windows)
+eval_stride = 0  # stride of the 'full' val windows, 0 means block_size // 2
 eval_only = False  # if True, script exits right after the first eval
 always_save_checkpoint = True  # if True, always save a checkpoint after each eval
 init_from = "scratch"  # 'scratch' or 'resume' or 'gpt2*'
@@ -49,12 +54,16 @@ dataset = "openwebtext"
 gradient_accumulation_steps = 5 * 8  # used to simulate larger batch sizes
 batch_size = 12  # if gradient_accumulation_steps > 1, this is the micro-batch size
 block_size = 1024
+sampler = "epoch"  # 'epoch' (each window once per epoch, resumable) or 'random'
+sampler_seed = 1337  # shared by all ranks, the sampler shards the order itself
 # model
 n_layer = 12
 n_head = 12
+n_kv_head = 0  # grouped-query attention: key/value heads, 0 for n_head
 n_embd = 768
 dropout = 0.0  # for pretraining 0 is good, for finetuning try 0.1+
 bias = False  # do we use bias inside LayerNorm and Linear layers?
+loss_chunk_size = 0  # > 0: fused lm_head + loss over chunks of this many tokens
 # adamw optimizer
 learning_rate = 6e-4  # max learning rate
 max_iters = 600000  # total number of training iterations
@@ -77,9 +86,18 @@ dtype = (
     else "float16"
 )  # 'float32', 'bfloat16', or 'float16', the latter will auto-disable aamp
 compile = True  # use PyTorch 2.0 to compile the model to be faster
+# instrumentation
+timeline = False  # per-phase timings to out_dir/timeline_rank*.jsonl + Chrome trace
+timeline_sync = True  # sync CUDA around phases, exact attribution but less overlap
+peak_flops = 0.0  # device peak FLOPS for MFU, 0 = look up (GPU) or calibrate (CPU)
 # -----------------------------------------------------------------------------
 config = {}
 
+def str2bool(v):
+    # flags default to True, so they must be settable to False: --compile=False
+    return v.lower() in ("1", "true", "yes")
+
+
 def setup_config():
     parser = argparse.ArgumentParser(description='Train a GPT model.')
     # Add arguments for every variable defined above
@@ -90,12 +108,14 @@ def setup_config():
     parser.add_argument('--eval_interval', type=int, default=eval_interval)
     parser.add_argument('--log_interval', type=int, default=log_interval)
     parser.add_argument('--eval_iters', type=int, default=eval_iters)
-    parser.add_argument('--eval_only', action='store_true', default=eval_only)
-    parser.add_argument('--always_save_checkpoint', action='store_true', default=always_save_checkpoint)
+    parser.add_argument('--eval_mode', type=str, default=eval_mode)
+    parser.add_argument('--eval_stride', type=int, default=eval_stride)
+    parser.add_argument('--eval_only', type=str2bool, nargs='?', const=True, default=eval_only)
+    parser.add_argument('--always_save_checkpoint', type=str2bool, nargs='?', const=True, default=always_save_checkpoint)
     parser.add_argument('--init_from', type=str, default=init_from)
     
     # wandb logging
-    parser.add_argument('--wandb_log', action='store_true', default=wandb_log)
+    parser.add_argument('--wandb_log', type=str2bool, nargs='?', const=True, default=wandb_log)
     parser.add_argument('--wandb_project', type=str, default=wandb_project)
     parser.add_argument('--wandb_run_name', type=str, default=wandb_run_name)
     
@@ -104,13 +124,17 @@ def setup_config():
     parser.add_argument('--gradient_accumulation_steps', type=int, default=gradient_accumulation_steps)
     parser.add_argument('--batch_size', type=int, default=batch_size)
     parser.add_argument('--block_size', type=int, default=block_size)
+    parser.add_argument('--sampler', type=str, default=sampler)
+    parser.add_argument('--sampler_seed', type=int, default=sampler_seed)
     
     # model
     parser.add_argument('--n_layer', type=int, default=n_layer)
     parser.add_argument('--n_head', type=int, default=n_head)
+    parser.add_argument('--n_kv_head', type=int, default=n_kv_head)
     parser.add_argument('--n_embd', type=int, default=n_embd)
     parser.add_argument('--dropout', type=float, default=dropout)
-    parser.add_argument('--bias', action='store_true', default=bias)
+    parser.add_argument('--bias', type=str2bool, nargs='?', const=True, default=bias)
+    parser.add_argument('--loss_chunk_size', type=int, default=loss_chunk_size)
     
     # adamw optimizer
     parser.add_argument('--learning_rate', type=float, default=learning_rate)
@@ -121,7 +145,7 @@ def setup_config():
     parser.add_argument('--grad_clip', type=float, default=grad_clip)
     
     # learning rate decay settings
-    parser.add_argument('--decay_lr', action='store_true', default=decay_lr)
+    parser.add_argument('--decay_lr', type=str2bool, nargs='?', const=True, default=decay_lr)
     parser.add_argument('--warmup_iters', type=int, default=warmup_iters)
     parser.add_argument('--lr_decay_iters', type=int, default=lr_decay_iters)
     parser.add_argument('--min_lr', type=float, default=min_lr)
@@ -132,7 +156,12 @@ def setup_config():
     # system
     parser.add_argument('--device', type=str, default=device)
     parser.add_argument('--dtype', type=str, default=dtype)
-    parser.add_argument('--compile', action='store_true', default=compile)
+    parser.add_argument('--compile', type=str2bool, nargs='?', const=True, default=compile)
+
+    # instrumentation
+    parser.add_argument('--timeline', type=str2bool, nargs='?', const=True, default=timeline)
+    parser.add_argument('--timeline_sync', type=str2bool, nargs='?', const=True, default=timeline_sync)
+    parser.add_argument('--peak_flops', type=float, default=peak_flops)
     
     args = parser.parse_args()
 
@@ -180,6 +209,7 @@ else:
     # if not ddp, we are running on a single gpu, and one process
     master_process = True
     seed_offset = 0
+    ddp_rank = 0
     ddp_world_size = 1
 tokens_per_iter = gradient_accumulation_steps * ddp_world_size * batch_size * block_size
 print(f"tokens per iteration will be: {tokens_per_iter:,}")
@@ -206,14 +236,16 @@ ctx = (
 data_dir = os.path.join("data", dataset)
 
 
-def get_batch(split):
+def get_batch(split, ix=None):
+    # ix are the window offsets to read, drawn uniformly at random if not given
     # We recreate np.memmap every batch to avoid a memory leak, as per
     # https://stackoverflow.com/questions/45132940/numpy-memmap-memory-usage-want-to-iterate-once/61472122#61472122
     if split == "train":
         data = np.memmap(os.path.join(data_dir, "train.bin"), dtype=np.uint16, mode="r")
     else:
         data = np.memmap(os.path.join(data_dir, "val.bin"), dtype=np.uint16, mode="r")
-    ix = torch.randint(len(data) - block_size, (batch_size,))
+    if ix is None:
+        ix = torch.randint(len(data) - block_size, (batch_size,))
     x = torch.stack(
         [torch.from_numpy((data[i : i + block_size]).astype(np.int64)) for i in ix]
     )
@@ -234,6 +266,56 @@ def get_batch(split):
     return x, y
 
 
+train_sampler = None
+sampler_state = None  # sampler position of the pending (prefetched) train batch
+if sampler == "epoch":
+    train_len = len(
+        np.memmap(os.path.join(data_dir, "train.bin"), dtype=np.uint16, mode="r")
+    )
+    train_sampler = EpochSampler(
+        train_len,
+        block_size,
+        batch_size,
+        seed=sampler_seed,
+        rank=ddp_rank,
+        world_size=ddp_world_size,
+    )
+
+
+def get_train_batch():
+    global sampler_state
+    # remember where the pending batch starts, so that a checkpoint written
+    # before it is consumed resumes exactly on it
+    if train_sampler is None:
+        return get_batch("train")
+    sampler_state = train_sampler.state_dict()
+    return get_batch("train", train_sampler.next_batch())
+
+
+def build_eval_batches(split):
+    # the windows estimate_loss uses in 'fixed' and 'full' mode are computed once,
+    # so every eval sees the same data and runs are comparable with each other
+    data = np.memmap(os.path.join(data_dir, f"{split}.bin"), dtype=np.uint16, mode="r")
+    if split == "val" and eval_mode == "full":
+        stride = eval_stride or block_size // 2
+        offsets, skip = strided_windows(len(data), block_size, stride)
+    else:
+        seed = [sampler_seed, 0 if split == "train" else 1]
+        offsets = fixed_windows(len(data), block_size, eval_iters * batch_size, seed)
+        skip = np.zeros_like(offsets)
+    batches = [
+        (offsets[i : i + batch_size], skip[i : i + batch_size])
+        for i in range(0, len(offsets), batch_size)
+    ]
+    # shard the batches over the ranks, the losses are all-reduced afterwards
+    return batches[ddp_rank::ddp_world_size]
+
+
+eval_batches = None
+if eval_mode != "random":
+    eval_batches = {split: build_eval_batches(split) for split in ["train", "val"]}
+
+
 # init these up here, can override if init_from='resume' (i.e. from a checkpoint)
 iter_num = 0
 best_val_loss = 1e9
@@ -251,6 +333,7 @@ if os.path.exists(meta_path):
 model_args = {
     "n_layer": n_layer,
     "n_head": n_head,
+    "n_kv_head": n_kv_head,
     "n_embd": n_embd,
     "block_size": block_size,
     "bias": bias,
@@ -279,6 +362,8 @@ elif init_from == "resume":
     # the rest of the attributes (e.g. dropout) can stay as desired from command line
     for k in ["n_layer", "n_head", "n_embd", "block_size", "bias", "vocab_size"]:
         model_args[k] = checkpoint_model_args[k]
+    # absent from checkpoints from before grouped-query attention
+    model_args["n_kv_head"] = checkpoint_model_args.get("n_kv_head", 0)
     # create the model
     gptconf = GPTConfig(**model_args)
     model = GPT(gptconf)
@@ -291,6 +376,9 @@ elif init_from == "resume":
     model.load_state_dict(state_dict)
     iter_num = checkpoint["iter_num"]
     best_val_loss = checkpoint["best_val_loss"]
+    # None in checkpoints written with --sampler=random, start a fresh epoch
+    if train_sampler is not None and checkpoint.get("sampler"):
+        train_sampler.load_state_dict(checkpoint["sampler"])
 elif init_from.startswith("gpt2"):
     print(f"Initializing from OpenAI GPT-2 weights: {init_from}")
     # initialize from OpenAI GPT-2 weights
@@ -299,11 +387,14 @@ elif init_from.startswith("gpt2"):
     # read off the created config params, so we can store them into checkpoint correctly
     for k in ["n_layer", "n_head", "n_embd", "block_size", "bias", "vocab_size"]:
         model_args[k] = getattr(model.config, k)
+    model_args["n_kv_head"] = model.config.n_kv_head
 # crop down the model block size if desired, using model surgery
 if block_size < model.config.block_size:
     model.crop_block_size(block_size)
     model_args["block_size"] = block_size  # so that the checkpoint will have the
     # right value
+# the fused loss is not part of the architecture, so it applies to any init_from
+model.config.loss_chunk_size = loss_chunk_size
 model.to(device)
 
 # initialize a GradScaler. If enabled=False scaler is a no-op
@@ -331,6 +422,8 @@ if ddp:
 # helps estimate an arbitrarily accurate loss over either split using many batches
 @torch.no_grad()
 def estimate_loss():
+    if eval_batches is not None:
+        return estimate_loss_fixed()
     out = {}
     model.eval()
     # Redefinition warnings: use unique variable names in estimate_loss
@@ -346,6 +439,31 @@ def estimate_loss():
     return out
 
 
+# same, but over the precomputed eval_batches. The loss stays on device and is
+# weighted by the number of scored targets, with a single sync at the very end
+@torch.no_grad()
+def estimate_loss_fixed():
+    raw_model.eval()
+    totals = torch.zeros(2, 2, device=device)  # (split, [loss sum, num targets])
+    positions = torch.arange(block_size, device=device)
+    for k, split in enumerate(["train", "val"]):
+        for ix, skip in eval_batches[split]:
+            batch_X, batch_Y = get_batch(split, ix)
+            if skip.any():
+                # these targets were already scored by the previous window
+                skip = torch.from_numpy(skip).to(device)
+                batch_Y = batch_Y.masked_fill(positions < skip[:, None], -1)
+            with ctx:
+                _, batch_loss = raw_model(batch_X, batch_Y)
+            n = (batch_Y != -1).sum()
+            totals[k] += torch.stack([batch_loss.float() * n, n.float()])
+    if ddp:
+        torch.distributed.all_reduce(totals)
+    raw_model.train()
+    losses = (totals[:, 0] / totals[:, 1]).tolist()
+    return {"train": losses[0], "val": losses[1]}
+
+
 # learning rate decay scheduler (cosine with warmup)
 def get_lr(it):
     # 1) linear warmup for warmup_iters steps
@@ -367,8 +485,21 @@ if wandb_log and master_process:
 
     wandb.init(project=wandb_project, name=wandb_run_name, config=config)
 
+# instrumentation: MFU is measured against the peak of the device we run on
+if peak_flops == 0.0:
+    peak_flops = detect_peak_flops(device)
+if master_process:
+    print(f"measuring MFU against a peak of {peak_flops / 1e12:.2f} TFLOPS")
+timer = StepTimeline(
+    os.path.join(out_dir, f"timeline_rank{ddp_rank}.jsonl") if timeline else None,
+    os.path.join(out_dir, f"trace_rank{ddp_rank}.json") if timeline else None,
+    sync=torch.cuda.synchronize if timeline_sync and device_type == "cuda" else None,
+    rank=ddp_rank,
+)
+
 # training loop
-X, Y = get_batch("train")  # fetch the very first batch
+with timer.phase("data"):
+    X, Y = get_train_batch()  # fetch the very first batch
 local_iter_num = 0  # number of iterations in the lifetime of this process
 raw_model = model.module if ddp else model  # unwrap DDP container if needed
 running_mfu = -1.0
@@ -381,11 +512,17 @@ while True:
         param_group["lr"] = lr
 
     # evaluate the loss on train/val sets and write checkpoints
+    if iter_num % eval_interval == 0 and (master_process or eval_batches):
+        # the fixed and full evals are sharded, so every rank takes part
+        with timer.phase("eval"):
+            losses = estimate_loss()
     if iter_num % eval_interval == 0 and master_process:
-        losses = estimate_loss()
+        epoch_info = (
+            f", epoch {train_sampler.progress:.3f}" if train_sampler is not None else ""
+        )
         print(
             f"step {iter_num}: train loss {losses['train']:.4f}, "
-            f"val loss {losses['val']:.4f}"
+            f"val loss {losses['val']:.4f}{epoch_info}"
         )
         if wandb_log:
             wandb.log(
@@ -407,9 +544,11 @@ while True:
                     "iter_num": iter_num,
                     "best_val_loss": best_val_loss,
                     "config": config,
+                    "sampler": sampler_state,
                 }
                 print(f"saving checkpoint to {out_dir}")
-                torch.save(checkpoint, os.path.join(out_dir, "ckpt.pt"))
+                with timer.phase("checkpoint"):
+                    torch.save(checkpoint, os.path.join(out_dir, "ckpt.pt"))
     if iter_num == 0 and eval_only:
         break
 
@@ -417,57 +556,60 @@ while True:
     # larger batch size
     # and using the GradScaler if data type is float16
     for micro_step in range(gradient_accumulation_steps):
-        X, Y = get_batch("train")
-        with ctx:
-            _, loss = model(X, Y)
         if ddp:
             # in DDP training we only need to sync gradients at the last micro step.
             # the official way to do this is with model.no_sync() context manager, but
             # I really dislike that this bloats the code and forces us to repeat code
             # looking at the source of that context manager,
-            # it just toggles this variable
+            # it just toggles this variable. DDP reads it in forward, so set it first
             model.require_backward_grad_sync = (
                 micro_step == gradient_accumulation_steps - 1
             )
-        # scale the loss to account for grad accumulation
-        loss = loss / gradient_accumulation_steps
+        with timer.phase("forward"):
+            with ctx:
+                _, loss = model(X, Y)
+                # scale the loss to account for grad accumulation
+                loss = loss / gradient_accumulation_steps
         # immediately async prefetch next batch while model is doing the forward pass
         # on the GPU
-        backward_pass, prefetch_next_batch = (
-            (scaler.scale(loss).backward(), get_batch("train"))
-            if micro_step == gradient_accumulation_steps - 1
-            else (scaler.scale(loss).backward(), None)
-        )
-        # clip the gradient
-        if grad_clip != 0.0:
+        with timer.phase("data"):
+            X, Y = get_train_batch()
+        # backward pass, with gradient scaling if training in fp16
+        with timer.phase("backward"):
+            scaler.scale(loss).backward()
+    # clip the gradient, once per iteration on the accumulated (and synced) grads
+    if grad_clip != 0.0:
+        with timer.phase("clip"):
             scaler.unscale_(optimizer)
             torch.nn.utils.clip_grad_norm_(model.parameters(), grad_clip)
+    with timer.phase("optimizer"):
         # step the optimizer and scaler if training in fp16
         scaler.step(optimizer)
         scaler.update()
         # flush the gradients as soon as we can, no need for this memory anymore
         optimizer.zero_grad(set_to_none=True)
 
-        # prefetch the next batch if not already done
-        if prefetch_next_batch is not None:
-            X, Y = prefetch_next_batch
-
     # timing and logging
     t1 = time.time()
     dt = t1 - t0
     t0 = t1
+    step_info = {"lr": lr}
     if iter_num % log_interval == 0 and master_process:
         # get loss as float. note: this is a CPU-GPU sync point
         # scale up to undo the division above, approximating the true total loss
         # (exact would have been a sum)
         lossf = loss.item() * gradient_accumulation_steps
         if local_iter_num >= 5:  # let the training loop settle a bit
-            mfu = raw_model.estimate_mfu(batch_size * gradient_accumulation_steps, dt)
+            mfu = raw_model.estimate_mfu(
+                batch_size * gradient_accumulation_steps, dt, peak_flops
+            )
             running_mfu = mfu if running_mfu == -1.0 else 0.9 * running_mfu + 0.1 * mfu
         print(
             f"iter {iter_num}: loss {lossf:.4f}, time {dt*1000:.2f}ms, "
             f"mfu {running_mfu*100:.2f}%"
         )
+        step_info.update(loss=lossf, mfu=running_mfu)
+    timer.step(iter_num, **step_info)
     iter_num += 1
     local_iter_num += 1
 
@@ -475,5 +617,6 @@ while True:
     if iter_num > max_iters:
         break
 
+timer.close()
 if ddp:
     destroy_process_group()
@@ -1,19 +1,19 @@
 import torch
 import pickle
+from bpe import load_vocab
 from model import GPTConfig, GPT
 
-# Load the vocabulary and meta information
-with open('data/void/vocab.pkl', 'rb') as f:
-    chars, stoi = pickle.load(f)
-
+# Load the meta information and the vocabulary: the BPE tokenizer it names
+# (prepare.py --bpe_vocab_size), or the chars
 with open('data/void/meta.pkl', 'rb') as f:
     meta = pickle.load(f)
+tokenizer = load_vocab('data/void/meta.pkl' if 'tokenizer' in meta else 'data/void/vocab.pkl')
 
 # Load and encode the input text
 with open('data/input.txt', 'r', encoding='utf-8') as f:
     text = f.read()
 
-data = torch.tensor([stoi[c] for c in text], dtype=torch.long)
+data = torch.tensor(tokenizer.encode(text), dtype=torch.long)
 
 # Train/val split
 n = int(0.9 * len(data))
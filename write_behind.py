@@ -0,0 +1,162 @@
+"""
+Write-behind persistence: rows are queued in memory by the request thread and
+written in bulk by a background worker, so request latency never includes a
+database write.
+
+- bounded: at most max_pending rows are held, further rows are dropped (and
+  counted) rather than growing memory while the database is down
+- batched: up to batch_size rows per insert, flushed at least every
+  flush_interval seconds
+- retried: a failed batch is retried with exponential backoff, and dropped
+  (counted, logged) after max_retries attempts
+- flushed on shutdown: close() drains the queue, and is registered with atexit
+
+A sink is any callable that takes a list of row dicts and raises on failure,
+e.g. SupabaseSink for production or JSONLSink as a local stand-in.
+"""
+
+import atexit
+import json
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger("void-z1")
+
+
+class SupabaseSink:
+
+    def __init__(self, client, table):
+        self.client = client
+        self.table = table
+
+    def __call__(self, rows):
+        self.client.table(self.table).insert(rows).execute()
+
+
+class JSONLSink:
+    """Appends rows to a local JSONL file, a stand-in for the database."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, rows):
+        with open(self.path, "a", encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps(row) + "\n")
+
+
+class WriteBehindQueue:
+
+    def __init__(
+        self,
+        sink,
+        batch_size=50,
+        flush_interval=1.0,
+        max_pending=10000,
+        max_retries=5,
+        backoff=0.5,
+        max_backoff=30.0,
+        name="write-behind",
+    ):
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.stats = {"queued": 0, "written": 0, "dropped": 0, "failed": 0}
+        self._pending = deque()
+        self._in_flight = 0
+        self._cond = threading.Condition()
+        self._closing = False
+        self._flushing = 0  # number of threads waiting in flush()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def put(self, row):
+        """Queue a row, never blocks. Returns False if it had to be dropped."""
+        with self._cond:
+            if self._closing or len(self._pending) >= self.max_pending:
+                self.stats["dropped"] += 1
+                if self.stats["dropped"] & (self.stats["dropped"] - 1) == 0:
+                    # log at powers of two, not for every row during an outage
+                    logger.warning(
+                        f"Write-behind queue dropped {self.stats['dropped']} rows"
+                    )
+                return False
+            self._pending.append(row)
+            self.stats["queued"] += 1
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify_all()
+            return True
+
+    def __len__(self):
+        with self._cond:
+            return len(self._pending) + self._in_flight
+
+    def _write(self, batch):
+        delay = self.backoff
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                self.sink(batch)
+                return True
+            except Exception as e:
+                if attempt == self.max_retries:
+                    logger.error(
+                        f"Dropping {len(batch)} rows after {attempt} attempts: {e}"
+                    )
+                    return False
+                logger.warning(
+                    f"Write of {len(batch)} rows failed (attempt {attempt}): {e}"
+                )
+                with self._cond:
+                    # a close() cuts the wait short, but the retries still happen
+                    self._cond.wait_for(lambda: self._closing, timeout=delay)
+                delay = min(2 * delay, self.max_backoff)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self._closing
+                    or (self._flushing and self._pending)
+                    or len(self._pending) >= self.batch_size,
+                    timeout=self.flush_interval,
+                )
+                if not self._pending:
+                    if self._closing:
+                        return
+                    continue
+                n = min(self.batch_size, len(self._pending))
+                batch = [self._pending.popleft() for _ in range(n)]
+                self._in_flight = n
+            ok = self._write(batch)
+            with self._cond:
+                self.stats["written" if ok else "failed"] += n
+                self._in_flight = 0
+                self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """Wait until everything queued so far is written. Returns True if so."""
+        with self._cond:
+            self._flushing += 1
+            self._cond.notify_all()
+            try:
+                return self._cond.wait_for(
+                    lambda: not self._pending and not self._in_flight, timeout=timeout
+                )
+            finally:
+                self._flushing -= 1
+
+    def close(self, timeout=30.0):
+        """Stop accepting rows and drain the queue, waiting up to timeout seconds."""
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        atexit.unregister(self.close)
+        self._thread.join(timeout)
+        if self._thread.is_alive() or self._pending:
+            logger.error(f"Write-behind queue closed with {len(self)} rows unwritten")